@@ -0,0 +1,69 @@
+"""
+Compares sending one message per provider api call with the bulk http email backend.
+
+Messages are sent to a local fake provider that waits a few milliseconds before answering each request to
+simulate a remote api, e.g.:
+
+    python benchmarks/http_backend.py
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from settings import configure_settings
+
+
+configure_settings()
+
+import django
+django.setup()
+
+from django.core import mail
+
+from entity_emailer.backends.http import EmailBackend
+from entity_emailer.tests.fake_provider import FakeProviderServer
+
+
+NUM_MESSAGES = 2000
+PROVIDER_LATENCY = 0.005
+CONFIGURATIONS = [
+    # (description, batch size, concurrency)
+    ('one message per request', 1, 1),
+    ('bulk requests', 100, 1),
+    ('concurrent bulk requests', 100, 4),
+]
+
+
+def get_messages():
+    return [
+        mail.EmailMessage(
+            subject='Benchmark {0}'.format(i),
+            body='Hello recipient {0}'.format(i),
+            from_email='from@example.com',
+            to=['to{0}@example.com'.format(i)],
+        )
+        for i in range(NUM_MESSAGES)
+    ]
+
+
+def main():
+    messages = get_messages()
+    print('{0:>26} {1:>10} {2:>12} {3:>10}'.format('', 'requests', 'connections', 'msgs/sec'))
+    for description, batch_size, concurrency in CONFIGURATIONS:
+        with FakeProviderServer(latency=PROVIDER_LATENCY) as provider:
+            backend = EmailBackend(
+                url=provider.url, api_key=provider.api_key, batch_size=batch_size, concurrency=concurrency
+            )
+            start = time.perf_counter()
+            backend.send_messages_with_results(messages)
+            elapsed = time.perf_counter() - start
+
+        print('{0:>26} {1:>10} {2:>12} {3:>10.0f}'.format(
+            description, len(provider.requests), provider.num_connections, NUM_MESSAGES / elapsed
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""
+Compares building and serializing the MIME messages of a fan out email with django's message builder and with
+the shared body builder used by the send pipeline.
+
+Every copy of the email has the same rendered text and html bodies and only differs in its recipient, as when
+an email is split into one message per recipient. Messages are serialized the way the smtp backend does, e.g.:
+
+    python benchmarks/mime_builder.py
+"""
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from settings import configure_settings
+
+
+configure_settings()
+
+import django
+django.setup()
+
+from entity_emailer.mime import SharedBodyMIMEBuilder
+from entity_emailer.utils import create_email_message, split_email_message
+
+
+NUM_RECIPIENTS = 2000
+TEXT = u'Hello, this is the text of a fairly typical notification email. Regards, the team.\n' * 50
+HTML = u'<p>Hello, this is the html of a fairly typical notification email. Regards, the team.</p>\n' * 100
+
+
+def get_messages():
+    message = create_email_message(
+        to_emails=['to{0}@example.com'.format(i) for i in range(NUM_RECIPIENTS)],
+        from_email='from@example.com',
+        subject='Benchmark',
+        text=TEXT,
+        html=HTML,
+    )
+    return [chunk_message for chunk_message, addresses in split_email_message(message, recipient_mode='individual')]
+
+
+def serialize(messages, mime_builder):
+    for message in messages:
+        message.mime_builder = mime_builder
+        message.message().as_bytes(linesep='\r\n')
+
+
+def main():
+    print('{0:>10} {1:>12} {2:>14} {3:>16}'.format('builder', 'msgs/sec', 'usec/message', 'peak KiB'))
+    for description, get_builder in [('django', lambda: None), ('shared', SharedBodyMIMEBuilder)]:
+        messages = get_messages()
+        start = time.perf_counter()
+        serialize(messages, get_builder())
+        elapsed = time.perf_counter() - start
+
+        # Measure allocations in a separate run since tracing slows everything down
+        messages = get_messages()
+        tracemalloc.start()
+        serialize(messages, get_builder())
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        print('{0:>10} {1:>12.0f} {2:>14.1f} {3:>16.0f}'.format(
+            description, NUM_RECIPIENTS / elapsed, elapsed / NUM_RECIPIENTS * 1e6, peak / 1024.0
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""
+Measures how long EmailView takes to look up an email by its view_uid as the email table grows.
+
+The view_uid lookup uses the unique index on that column. Lookups on the unindexed subject column are timed
+alongside it to show the sequential scan that view_uid lookups did before the index existed.
+
+Runs against a throwaway test database created from the DB_SETTINGS or DB environment variables, e.g.:
+
+    DB_SETTINGS='{"ENGINE": "django.db.backends.sqlite3", "NAME": ":memory:"}' python benchmarks/view_uid_lookup.py
+"""
+import os
+import sys
+import timeit
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from settings import configure_settings
+
+
+configure_settings()
+
+import django
+django.setup()
+
+from django.db import connection
+from django_dynamic_fixture import G
+from entity_event.models import Event
+
+from entity_emailer.models import Email
+from entity_emailer.views import EmailView
+
+
+TABLE_SIZES = [1000, 10000, 100000]
+NUM_LOOKUPS = 200
+
+
+def grow_table(event, size):
+    """
+    Add emails until the table has size rows
+    """
+    num_to_create = size - Email.objects.count()
+    Email.objects.bulk_create(
+        [
+            Email(event=event, view_uid=uuid.uuid4(), subject=str(uuid.uuid4()), scheduled=None)
+            for i in range(num_to_create)
+        ],
+        batch_size=5000,
+    )
+
+
+def time_lookup(lookup):
+    """
+    Returns the average number of milliseconds a lookup takes
+    """
+    return timeit.timeit(lookup, number=NUM_LOOKUPS) / NUM_LOOKUPS * 1000
+
+
+def main():
+    connection.creation.create_test_db(verbosity=0)
+    event = G(Event, context={})
+
+    print('{0:>10} {1:>22} {2:>22}'.format('emails', 'view_uid lookup (ms)', 'unindexed lookup (ms)'))
+    for size in TABLE_SIZES:
+        grow_table(event, size)
+        email = Email.objects.order_by('?').first()
+        view = EmailView(args=[str(email.view_uid)])
+
+        indexed_ms = time_lookup(view.get_email)
+        unindexed_ms = time_lookup(lambda: Email.objects.select_related('event').get(subject=email.subject))
+        print('{0:>10} {1:>22.3f} {2:>22.3f}'.format(size, indexed_ms, unindexed_ms))
+
+
+if __name__ == '__main__':
+    main()
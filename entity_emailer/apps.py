@@ -1,6 +1,27 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_save
 
 
 class EntityEmailerConfig(AppConfig):
     name = 'entity_emailer'
     verbose_name = 'Django Entity Emailer'
+
+    def ready(self):
+        from activatable_model.signals import model_activations_changed
+        from entity.models import Entity
+        from entity_event.models import Event
+        from manager_utils import post_bulk_operation
+
+        from entity_emailer.cache import clear_entity_addresses, invalidate_entity_address
+        from entity_emailer.models import queue_created_event
+
+        post_save.connect(queue_created_event, sender=Event, dispatch_uid='entity_emailer_queue_created_event')
+
+        # Keep the entity address cache from returning addresses that changed
+        post_save.connect(invalidate_entity_address, sender=Entity, dispatch_uid='entity_emailer_invalidate_address')
+        model_activations_changed.connect(
+            invalidate_entity_address, sender=Entity, dispatch_uid='entity_emailer_invalidate_activated_address'
+        )
+        post_bulk_operation.connect(
+            clear_entity_addresses, sender=Entity, dispatch_uid='entity_emailer_clear_addresses'
+        )
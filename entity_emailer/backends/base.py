@@ -0,0 +1,88 @@
+import os
+import threading
+
+from django.core import mail
+
+
+# The persistent connection of each process and thread, see get_persistent_connection
+persistent_connections = {}
+
+
+class BatchResultsMixin(object):
+    """
+    Mixin for email backends that can send a whole batch of messages at once while still reporting the
+    outcome of every message, such as backends for provider bulk apis.
+    """
+    # The smallest number of messages that the backend needs at once to send at full speed, if it has one
+    results_chunk_size = None
+
+    def send_messages_with_results(self, email_messages):
+        """
+        Send the messages and return a list with one result per message, in the same order. Each result is
+        None if the message was sent or the exception that prevented it from being sent.
+        """
+        raise NotImplementedError
+
+
+def send_messages_with_results(connection, email_messages):
+    """
+    Send the messages over the connection and return a list of per message results. Backends that implement
+    BatchResultsMixin receive the whole batch, while plain django backends are sent one message at a time.
+    """
+    if isinstance(connection, BatchResultsMixin):
+        return connection.send_messages_with_results(email_messages)
+
+    results = []
+    for email_message in email_messages:
+        try:
+            connection.send_messages([email_message])
+            results.append(None)
+        except Exception as e:
+            results.append(e)
+    return results
+
+
+def has_keepalive(connection):
+    """
+    Returns True if the connection implements ``keepalive`` to detect and repair a connection that broke while it
+    was idle. Backends that send through other backends, like the routing backend, report with
+    ``supports_keepalive`` whether every one of those backends does.
+    """
+    supports_keepalive = getattr(connection, 'supports_keepalive', None)
+    if supports_keepalive is not None:
+        return supports_keepalive()
+    return hasattr(connection, 'keepalive')
+
+
+def get_persistent_connection():
+    """
+    Returns an email backend connection that is kept open across runs within the current process and thread, so
+    that the cost of connecting and authenticating is only paid once. The connection is opened if it is not open.
+
+    Only backends that implement ``keepalive``, such as the entity emailer smtp backend, can detect and repair a
+    connection that the server closed while it was idle. Other backends, such as the django smtp backend, would
+    fail every message sent over such a connection, so None is returned for them and every run opens its own.
+    """
+    key = (os.getpid(), threading.get_ident())
+    connection = persistent_connections.get(key)
+    if connection is None:
+        connection = mail.get_connection()
+        if not has_keepalive(connection):
+            return None
+        persistent_connections[key] = connection
+
+    try:
+        connection.open()
+    except Exception:
+        # Leave it to the backend to report the failure on every message it is then asked to send
+        pass
+    return connection
+
+
+def close_persistent_connection():
+    """
+    Close the persistent connection of the current process and thread, if there is one
+    """
+    connection = persistent_connections.pop((os.getpid(), threading.get_ident()), None)
+    if connection is not None:
+        connection.close()
@@ -0,0 +1,199 @@
+from concurrent.futures import ThreadPoolExecutor
+from http import client
+from urllib.parse import urlsplit
+import json
+import queue
+import threading
+
+from django.conf import settings
+from django.core.mail.backends.base import BaseEmailBackend
+
+from entity_emailer.backends.base import BatchResultsMixin
+
+
+class HTTPProviderError(Exception):
+    """
+    An error reported by the provider api. The provider's error payload is returned by to_dict so that it is
+    saved along with the exception on the email. ``status`` is the http status of a request that failed as a
+    whole, and None for a message that the provider rejected.
+    """
+    def __init__(self, message, payload=None, status=None):
+        super(HTTPProviderError, self).__init__(message)
+        self.payload = payload or {}
+        self.status = status
+
+    def to_dict(self):
+        return self.payload
+
+
+class EmailBackend(BatchResultsMixin, BaseEmailBackend):
+    """
+    Sends emails through a provider bulk api over http. Messages are packed into json requests of up to
+    ``batch_size`` messages, and up to ``concurrency`` requests are made at once over a pool of kept alive
+    connections.
+
+    Every request is a POST of ``{"messages": [...]}`` and the provider responds with ``{"results": [...]}``
+    holding one result per message. A result with a ``status`` of ``"sent"`` means the message was accepted.
+    Any other result is raised as an HTTPProviderError carrying the result, including per recipient errors.
+
+    Options are read from the ``ENTITY_EMAILER_HTTP_BACKEND`` setting, a dict with the keys ``URL``,
+    ``API_KEY``, ``BATCH_SIZE``, ``CONCURRENCY`` and ``TIMEOUT``, and may be overridden with keyword arguments.
+    """
+    def __init__(
+        self, url=None, api_key=None, batch_size=None, concurrency=None, timeout=None, fail_silently=False,
+        **kwargs
+    ):
+        super(EmailBackend, self).__init__(fail_silently=fail_silently, **kwargs)
+        options = getattr(settings, 'ENTITY_EMAILER_HTTP_BACKEND', {})
+        self.url = url or options.get('URL')
+        self.api_key = api_key or options.get('API_KEY')
+        self.batch_size = batch_size or options.get('BATCH_SIZE', 100)
+        self.concurrency = concurrency or options.get('CONCURRENCY', 4)
+        self.timeout = timeout or options.get('TIMEOUT', 30)
+
+        url_parts = urlsplit(self.url)
+        self.connection_class = client.HTTPSConnection if url_parts.scheme == 'https' else client.HTTPConnection
+        self.host = url_parts.netloc
+        self.path = url_parts.path or '/'
+
+        self.connections = None
+        self.executor = None
+        self._lock = threading.RLock()
+
+    @property
+    def results_chunk_size(self):
+        # Every connection of the pool sends a request of a full batch at once
+        return self.batch_size * self.concurrency
+
+    def open(self):
+        """
+        Create the connection pool. Returns True if it was created and False if it was already open.
+        """
+        with self._lock:
+            if self.connections is not None:
+                return False
+
+            # Connections are only established when first used and then kept alive
+            self.connections = queue.LifoQueue()
+            for i in range(self.concurrency):
+                self.connections.put(self.connection_class(self.host, timeout=self.timeout))
+            self.executor = ThreadPoolExecutor(max_workers=self.concurrency)
+            return True
+
+    def close(self):
+        with self._lock:
+            if self.connections is None:
+                return
+
+            self.executor.shutdown(wait=True)
+            while not self.connections.empty():
+                self.connections.get().close()
+            self.connections = None
+            self.executor = None
+
+    def send_messages(self, email_messages):
+        results = self.send_messages_with_results(email_messages)
+        exceptions = [exception for exception in results if exception is not None]
+        if exceptions and not self.fail_silently:
+            raise exceptions[0]
+        return len(results) - len(exceptions)
+
+    def send_messages_with_results(self, email_messages):
+        if not email_messages:
+            return []
+
+        with self._lock:
+            new_conn_created = self.open()
+
+            batches = [
+                email_messages[i:i + self.batch_size]
+                for i in range(0, len(email_messages), self.batch_size)
+            ]
+            results = []
+            for batch_results in self.executor.map(self.send_batch, batches):
+                results.extend(batch_results)
+
+            if new_conn_created:
+                self.close()
+
+        return results
+
+    def send_batch(self, email_messages):
+        """
+        Send one bulk request and return the results of its messages
+        """
+        try:
+            response = self.post({
+                'messages': [self.serialize_message(email_message) for email_message in email_messages],
+            })
+            results = response.get('results', [])
+            if len(results) != len(email_messages):
+                raise HTTPProviderError('Provider api returned {0} results for {1} messages'.format(
+                    len(results), len(email_messages)
+                ), response)
+        except Exception as e:
+            return [e] * len(email_messages)
+
+        return [
+            None if result.get('status') == 'sent' else HTTPProviderError('Provider api rejected message', result)
+            for result in results
+        ]
+
+    def serialize_message(self, email_message):
+        html = None
+        for content, mimetype in getattr(email_message, 'alternatives', []):
+            if mimetype == 'text/html':
+                html = content
+
+        return {
+            'from': email_message.from_email,
+            'to': email_message.to,
+            'cc': email_message.cc,
+            'bcc': email_message.bcc,
+            'reply_to': email_message.reply_to,
+            'subject': email_message.subject,
+            'text': email_message.body,
+            'html': html,
+            'headers': email_message.extra_headers,
+        }
+
+    def post(self, payload):
+        """
+        Post the payload on a pooled connection and return the decoded response
+        """
+        body = json.dumps(payload).encode('utf-8')
+        headers = {
+            'Content-Type': 'application/json',
+            'Authorization': 'Bearer {0}'.format(self.api_key),
+        }
+
+        connection = self.connections.get()
+        try:
+            status, data = self.request_with_reconnect(connection, body, headers)
+        except Exception:
+            # Reset the failed connection so that it reconnects the next time it is used
+            connection.close()
+            raise
+        finally:
+            self.connections.put(connection)
+
+        if status >= 400:
+            raise HTTPProviderError('Provider api returned status {0}'.format(status), data, status)
+        return data
+
+    def request_with_reconnect(self, connection, body, headers):
+        reused = connection.sock is not None
+        try:
+            return self.request(connection, body, headers)
+        except ConnectionError:
+            # The provider may have closed a kept alive connection while it was idle, so reconnect and try again
+            if not reused:
+                raise
+            connection.close()
+            return self.request(connection, body, headers)
+
+    def request(self, connection, body, headers):
+        connection.request('POST', self.path, body=body, headers=headers)
+        response = connection.getresponse()
+        data = response.read()
+        return response.status, json.loads(data.decode('utf-8')) if data else {}
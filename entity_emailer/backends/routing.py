@@ -0,0 +1,286 @@
+from email.utils import parseaddr
+import smtplib
+import threading
+import time
+
+from django.conf import settings
+from django.core import mail
+from django.core.exceptions import ImproperlyConfigured
+from django.core.mail.backends.base import BaseEmailBackend
+from django.utils.module_loading import import_string
+
+from entity_emailer.backends.base import BatchResultsMixin, send_messages_with_results
+from entity_emailer.backends.http import HTTPProviderError
+from entity_emailer.backends.smtp import is_connection_error
+from entity_emailer.signals import route_batch_sent
+
+
+class NoRouteError(Exception):
+    """
+    Raised for a message that no route accepts
+    """
+    pass
+
+
+def is_transport_error(exception):
+    """
+    Returns True if the message failed because it could not be handed over, such as when the connection broke or
+    the provider had a server error, so that another route may still deliver it. A message that was rejected, such
+    as for refused recipients, would be rejected by any route, so it is not.
+    """
+    if is_connection_error(exception) or isinstance(exception, smtplib.SMTPConnectError):
+        return True
+    if isinstance(exception, HTTPProviderError):
+        return exception.status is not None and exception.status >= 500
+    # Smtp errors are OSErrors too, and are only transport errors when they are connection errors
+    return isinstance(exception, OSError) and not isinstance(exception, smtplib.SMTPException)
+
+
+class RouteStats(object):
+    """
+    Counts what was sent through a route
+    """
+    def __init__(self):
+        self.sent = 0
+        self.failed = 0
+        self.rerouted = 0
+        self.batches = 0
+        self.seconds = 0.0
+        self.reconnects = 0
+
+    def as_dict(self):
+        return {
+            'sent': self.sent,
+            'failed': self.failed,
+            'rerouted': self.rerouted,
+            'batches': self.batches,
+            'seconds': self.seconds,
+            'reconnects': self.reconnects,
+            'messages_per_second': self.sent / self.seconds if self.seconds else 0.0,
+        }
+
+
+class Route(object):
+    """
+    An email backend along with the messages it is used for. A message matches the route when it matches every
+    criteria the route has. A route without any criteria matches every message.
+
+    :param sources: The names of the event sources of the emails sent through this route
+    :param priorities: The priorities of the emails sent through this route, read from the ``priority`` key of
+        the event context
+    :param domains: The recipient domains sent through this route. Every recipient of a message must be in one of
+        these domains for it to match
+    :param fallback: The name of the route that messages which failed on this route are sent through
+    """
+    def __init__(
+        self, name, backend=None, options=None, sources=None, priorities=None, domains=None, fallback=None
+    ):
+        self.name = name
+        self.backend = backend
+        self.options = options or {}
+        self.sources = set(sources) if sources is not None else None
+        self.priorities = set(priorities) if priorities is not None else None
+        self.domains = set(domain.lower() for domain in domains) if domains is not None else None
+        self.fallback = fallback
+        self.connection = None
+        self.stats = RouteStats()
+
+    def matches(self, email_message):
+        email_model = getattr(email_message, 'email_model', None)
+        if self.sources is not None:
+            if email_model is None or email_model.event.source.name not in self.sources:
+                return False
+
+        if self.priorities is not None:
+            if email_model is None or email_model.event.context.get('priority') not in self.priorities:
+                return False
+
+        if self.domains is not None:
+            domains = set(
+                parseaddr(recipient)[1].rpartition('@')[2].lower()
+                for recipient in email_message.recipients()
+            )
+            if not domains or not domains.issubset(self.domains):
+                return False
+
+        return True
+
+    def has_keepalive(self):
+        """
+        Returns True if the backend of the route implements ``keepalive``
+        """
+        return hasattr(import_string(self.backend or settings.EMAIL_BACKEND), 'keepalive')
+
+    def get_connection(self):
+        """
+        Returns the open connection of the route, which is kept open until the route is closed or until a message
+        fails because of a transport error
+        """
+        if self.connection is None:
+            self.connection = mail.get_connection(backend=self.backend, **self.options)
+            self.connection.open()
+        return self.connection
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+class EmailBackend(BatchResultsMixin, BaseEmailBackend):
+    """
+    Sends every message through the first route in ``ENTITY_EMAILER_ROUTES`` that matches it, so that traffic can be
+    split across several backends. Each route keeps its connection open until the backend is closed or until a
+    message fails on the route because of a transport error, such as a broken connection, an unreachable server or
+    a provider server error, after which the next batch opens a new connection. Messages that fail on a route with a
+    fallback because of a transport error are sent again through the fallback route. Messages that were rejected
+    are not.
+
+    The backend only supports keepalives, and is only kept open across runs, when the backends of all of its routes
+    implement ``keepalive``.
+
+    Each route is a dict with the keys ``NAME``, ``BACKEND`` and ``OPTIONS`` for the backend and its keyword
+    arguments, the optional matching criteria ``SOURCES``, ``PRIORITIES`` and ``DOMAINS``, and an optional
+    ``FALLBACK`` route name. Messages that match no route fail with a NoRouteError.
+
+    The number of messages sent and failed and the time spent sending are counted per route and returned by
+    get_stats. The route_batch_sent signal is also fired for every batch sent through a route.
+    """
+    def __init__(self, routes=None, fail_silently=False, **kwargs):
+        super(EmailBackend, self).__init__(fail_silently=fail_silently, **kwargs)
+        if routes is None:
+            routes = getattr(settings, 'ENTITY_EMAILER_ROUTES', [])
+
+        self.routes = [
+            Route(
+                name=route['NAME'],
+                backend=route.get('BACKEND'),
+                options=route.get('OPTIONS'),
+                sources=route.get('SOURCES'),
+                priorities=route.get('PRIORITIES'),
+                domains=route.get('DOMAINS'),
+                fallback=route.get('FALLBACK'),
+            )
+            for route in routes
+        ]
+        self.routes_by_name = {route.name: route for route in self.routes}
+        for route in self.routes:
+            if route.fallback is not None and route.fallback not in self.routes_by_name:
+                raise ImproperlyConfigured(
+                    'Unknown fallback route {0} of route {1}'.format(route.fallback, route.name)
+                )
+        self._lock = threading.RLock()
+
+    def open(self):
+        """
+        Route connections are opened when they are first used, so there is nothing to open up front
+        """
+        return False
+
+    def close(self):
+        with self._lock:
+            for route in self.routes:
+                route.close()
+
+    def supports_keepalive(self):
+        return all(route.has_keepalive() for route in self.routes)
+
+    def keepalive(self):
+        """
+        Keep the open connections of the routes alive when their backends support it
+        """
+        with self._lock:
+            for route in self.routes:
+                keepalive = getattr(route.connection, 'keepalive', None)
+                if keepalive is not None:
+                    keepalive()
+
+    def get_route(self, email_message):
+        for route in self.routes:
+            if route.matches(email_message):
+                return route
+        return None
+
+    def get_stats(self):
+        """
+        Returns a dict of the stats of each route keyed by route name
+        """
+        return {route.name: route.stats.as_dict() for route in self.routes}
+
+    def send_messages(self, email_messages):
+        results = self.send_messages_with_results(email_messages)
+        exceptions = [exception for exception in results if exception is not None]
+        if exceptions and not self.fail_silently:
+            raise exceptions[0]
+        return len(results) - len(exceptions)
+
+    def send_messages_with_results(self, email_messages):
+        results = [None] * len(email_messages)
+
+        # Group the messages by route while keeping track of their position in the results
+        pending = {}
+        for i, email_message in enumerate(email_messages):
+            route = self.get_route(email_message)
+            if route is None:
+                results[i] = NoRouteError('No email route matches the message')
+            else:
+                pending.setdefault(route.name, []).append(i)
+
+        with self._lock:
+            # The routes that each message was already sent through
+            attempted = {}
+            while pending:
+                name, indexes = pending.popitem()
+                route = self.routes_by_name[name]
+
+                route_results = self.send_route_batch(route, [email_messages[i] for i in indexes])
+
+                # Messages that failed to be handed over are sent again through the fallback route unless they
+                # already went through it
+                for i, exception in zip(indexes, route_results):
+                    results[i] = exception
+                    attempted.setdefault(i, set()).add(name)
+                    if route.fallback is None or route.fallback in attempted[i]:
+                        continue
+                    if exception is not None and is_transport_error(exception):
+                        route.stats.rerouted += 1
+                        pending.setdefault(route.fallback, []).append(i)
+
+        return results
+
+    def send_route_batch(self, route, email_messages):
+        """
+        Send the messages through the route and record the outcome in its stats
+        """
+        start = time.monotonic()
+        num_reconnects = 0
+        try:
+            connection = route.get_connection()
+            num_reconnects = getattr(connection, 'num_reconnects', 0)
+            results = send_messages_with_results(connection, email_messages)
+            num_reconnects = getattr(connection, 'num_reconnects', 0) - num_reconnects
+        except Exception as e:
+            # The connection of the route could not be opened
+            route.close()
+            results = [e] * len(email_messages)
+        else:
+            # A connection that broke is opened again for the next batch, since not every backend can repair it
+            if any(exception is not None and is_transport_error(exception) for exception in results):
+                route.close()
+        seconds = time.monotonic() - start
+
+        num_failed = sum(1 for exception in results if exception is not None)
+        route.stats.sent += len(results) - num_failed
+        route.stats.failed += num_failed
+        route.stats.batches += 1
+        route.stats.seconds += seconds
+        route.stats.reconnects += num_reconnects
+
+        route_batch_sent.send(
+            sender=EmailBackend,
+            route=route.name,
+            num_sent=len(results) - num_failed,
+            num_failed=num_failed,
+            seconds=seconds,
+        )
+        return results
@@ -0,0 +1,112 @@
+import smtplib
+import time
+
+from django.conf import settings
+from django.core.mail.backends import smtp
+
+from entity_emailer.backends.base import BatchResultsMixin
+
+
+def is_connection_error(exception):
+    """
+    Returns True if the exception means that the connection to the smtp server is broken, as opposed to the
+    server refusing a message
+    """
+    if isinstance(exception, (smtplib.SMTPServerDisconnected, ConnectionError, TimeoutError)):
+        return True
+    # 421 is the reply of a server that is closing the connection
+    return isinstance(exception, smtplib.SMTPResponseException) and exception.smtp_code == 421
+
+
+class EmailBackend(BatchResultsMixin, smtp.EmailBackend):
+    """
+    The django smtp backend, extended to send a whole batch over one connection while reporting the outcome of
+    every message instead of stopping at the first failure.
+
+    The backend is meant to be kept open between batches. Before a batch is sent over a connection that has been
+    idle for more than ``keepalive_interval`` seconds, a NOOP checks that the connection is still alive. A broken
+    connection is reopened, and a message that fails because the connection broke is retried once on the new
+    connection. The number of reconnects is counted in ``num_reconnects``.
+
+    ``keepalive_interval`` defaults to the ``ENTITY_EMAILER_SMTP_KEEPALIVE_INTERVAL`` setting, which is 30 seconds.
+    """
+    def __init__(self, keepalive_interval=None, **kwargs):
+        super(EmailBackend, self).__init__(**kwargs)
+        if keepalive_interval is None:
+            keepalive_interval = getattr(settings, 'ENTITY_EMAILER_SMTP_KEEPALIVE_INTERVAL', 30)
+        self.keepalive_interval = keepalive_interval
+        self.num_reconnects = 0
+        self.last_used = None
+
+    def open(self):
+        new_conn_created = super(EmailBackend, self).open()
+        if new_conn_created:
+            self.last_used = time.monotonic()
+        return new_conn_created
+
+    def reconnect(self):
+        try:
+            self.close()
+        except Exception:
+            # The connection is already broken, so there is nothing to cleanly close
+            self.connection = None
+        self.num_reconnects += 1
+        self.open()
+
+    def keepalive(self):
+        """
+        Send a NOOP over a connection that has been idle for longer than the keepalive interval and reconnect if
+        the connection turns out to be broken
+        """
+        with self._lock:
+            if self.connection is None or time.monotonic() - self.last_used < self.keepalive_interval:
+                return
+
+            try:
+                code = self.connection.noop()[0]
+            except Exception as e:
+                if not is_connection_error(e):
+                    raise
+                code = None
+
+            if code == 250:
+                self.last_used = time.monotonic()
+            else:
+                self.reconnect()
+
+    def send_messages_with_results(self, email_messages):
+        with self._lock:
+            try:
+                new_conn_created = self.open()
+                if not new_conn_created:
+                    self.keepalive()
+            except Exception as e:
+                return [e] * len(email_messages)
+
+            # Opening fails without raising when the backend fails silently
+            if new_conn_created is None:
+                return [smtplib.SMTPServerDisconnected('Could not connect to the smtp server')] * len(email_messages)
+
+            results = []
+            for email_message in email_messages:
+                try:
+                    self.send_with_reconnect(email_message)
+                    results.append(None)
+                except Exception as e:
+                    results.append(e)
+
+            if new_conn_created:
+                self.close()
+
+        return results
+
+    def send_with_reconnect(self, email_message):
+        try:
+            self._send(email_message)
+        except Exception as e:
+            if not is_connection_error(e):
+                raise
+            self.reconnect()
+            self._send(email_message)
+        finally:
+            self.last_used = time.monotonic()
@@ -0,0 +1,73 @@
+from django.conf import settings
+
+
+class BatchSizer(object):
+    """
+    Chooses how many emails are sent in each batch.
+
+    Without ``adaptive``, every batch has ``batch_size`` emails, and a ``batch_size`` of None sends every due email
+    in one batch. With ``adaptive``, the size is adjusted after every batch so that a batch takes about
+    ``target_seconds``. The time of a batch is modeled as a fixed cost, the time of its query, plus a cost per
+    email, the time spent rendering and sending it. Both are averaged over previous batches, and the next size
+    is the number of emails that fit in the target time, kept within ``min_batch_size`` and ``max_batch_size``.
+    """
+    # The weight of the newest observation in the averages of the batch costs
+    smoothing = 0.5
+
+    # The most that the batch size grows by from one batch to the next, so that one fast batch can't cause a spike
+    max_growth = 2.0
+
+    def __init__(self, batch_size=None, adaptive=False, target_seconds=5.0, min_batch_size=10, max_batch_size=5000):
+        self.adaptive = adaptive
+        self.target_seconds = target_seconds
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        if adaptive:
+            batch_size = self.clamp(batch_size or min_batch_size)
+        self.batch_size = batch_size
+        self.fixed_seconds = None
+        self.seconds_per_email = None
+
+    def clamp(self, batch_size):
+        return int(max(self.min_batch_size, min(self.max_batch_size, batch_size)))
+
+    def average(self, average, value):
+        return value if average is None else self.smoothing * value + (1 - self.smoothing) * average
+
+    def observe(self, num_emails, query_seconds, render_seconds, send_seconds):
+        """
+        Record the timings of a batch and return the size of the next batch
+        """
+        if not self.adaptive or not num_emails:
+            return self.batch_size
+
+        self.fixed_seconds = self.average(self.fixed_seconds, query_seconds)
+        self.seconds_per_email = self.average(self.seconds_per_email, (render_seconds + send_seconds) / num_emails)
+
+        if self.seconds_per_email > 0:
+            batch_size = (self.target_seconds - self.fixed_seconds) / self.seconds_per_email
+        else:
+            batch_size = self.max_batch_size
+        self.batch_size = self.clamp(min(batch_size, self.batch_size * self.max_growth))
+        return self.batch_size
+
+
+# The batch sizer of the current process for each configuration, so that adaptive sizes carry over between runs
+batch_sizers = {}
+
+
+def get_batch_sizer():
+    """
+    Get the batch sizer for the ENTITY_EMAILER_SEND_BATCH_SIZE, ENTITY_EMAILER_ADAPTIVE_BATCH_SIZE,
+    ENTITY_EMAILER_BATCH_TARGET_SECONDS, ENTITY_EMAILER_MIN_BATCH_SIZE and ENTITY_EMAILER_MAX_BATCH_SIZE settings.
+    """
+    options = (
+        getattr(settings, 'ENTITY_EMAILER_SEND_BATCH_SIZE', None),
+        getattr(settings, 'ENTITY_EMAILER_ADAPTIVE_BATCH_SIZE', False),
+        getattr(settings, 'ENTITY_EMAILER_BATCH_TARGET_SECONDS', 5.0),
+        getattr(settings, 'ENTITY_EMAILER_MIN_BATCH_SIZE', 10),
+        getattr(settings, 'ENTITY_EMAILER_MAX_BATCH_SIZE', 5000),
+    )
+    if options not in batch_sizers:
+        batch_sizers[options] = BatchSizer(*options)
+    return batch_sizers[options]
@@ -0,0 +1,236 @@
+from collections import OrderedDict
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from entity.models import Entity
+
+
+def get_entity_address(entity_meta):
+    """
+    Returns the (email address, excluded) pair of an entity from its metadata, using the ENTITY_EMAILER_EMAIL_KEY
+    and ENTITY_EMAILER_EXCLUDE_KEY settings. The email address is None when the entity does not have one.
+    """
+    email_key = getattr(settings, 'ENTITY_EMAILER_EMAIL_KEY', 'email')
+    exclude_entity_key = getattr(settings, 'ENTITY_EMAILER_EXCLUDE_KEY', None)
+    entity_meta = entity_meta or {}
+
+    # Empty strings are not email addresses
+    email_address = entity_meta.get(email_key, None) or None
+
+    # Entities are excluded when the exclude key is set and their value for it is not truthy
+    excluded = bool(exclude_entity_key) and not entity_meta.get(exclude_entity_key)
+    return email_address, excluded
+
+
+class EntityAddressCache(object):
+    """
+    A least recently used cache of the (email address, excluded) pair of entities by entity id, so that the
+    metadata of entities that are emailed often does not have to be read for every email.
+
+    Entries expire after ``timeout`` seconds and at most ``max_size`` entries are kept. When ``cache_alias`` is
+    given, entries that are not in the cache of this process are looked up in that django cache, which is shared
+    with other processes, before they are read from the database.
+
+    The keys of the shared cache include a generation that is also stored in the shared cache. Clearing the cache
+    replaces the generation, which drops every shared entry at once along with the entries of every process that
+    loaded them under the old generation.
+
+    The number of lookups answered by the cache of this process, by the shared cache and by the database are counted
+    in ``hits``, ``shared_hits`` and ``misses``.
+    """
+    key_prefix = 'entity_emailer_address'
+    generation_key = 'entity_emailer_address_generation'
+
+    def __init__(self, max_size=10000, cache_alias=None, timeout=300):
+        self.max_size = max_size
+        self.cache_alias = cache_alias
+        self.timeout = timeout
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.generation = None
+        self._lock = threading.Lock()
+
+    @property
+    def shared_cache(self):
+        return caches[self.cache_alias] if self.cache_alias else None
+
+    def get_key(self, entity_id, generation):
+        return '{0}_{1}_{2}'.format(self.key_prefix, generation, entity_id)
+
+    def get_generation(self):
+        """
+        Returns the generation of the shared cache, starting a new one when there is none, and clears this cache when
+        the generation changed since it was last read
+        """
+        shared_cache = self.shared_cache
+        generation = shared_cache.get(self.generation_key)
+        if generation is None:
+            generation = uuid.uuid4().hex
+            # Another process may have started a generation at the same time
+            if not shared_cache.add(self.generation_key, generation, None):
+                generation = shared_cache.get(self.generation_key, generation)
+
+        with self._lock:
+            if generation != self.generation:
+                self.entries.clear()
+                self.generation = generation
+        return generation
+
+    def resolve(self, entity_ids):
+        """
+        Returns a dict of the (email address, excluded) pair of each entity id that exists, in the order of the ids.
+        The entities that are not cached are read with one query. Like the recipients of an email, only active
+        entities are included.
+        """
+        entity_ids = list(entity_ids)
+        generation = self.get_generation() if self.shared_cache is not None else None
+        resolved = self.get_local(entity_ids)
+
+        missing_ids = [entity_id for entity_id in entity_ids if entity_id not in resolved]
+        if missing_ids and self.shared_cache is not None:
+            shared = self.get_shared(missing_ids, generation)
+            self.set_local(shared)
+            resolved.update(shared)
+            missing_ids = [entity_id for entity_id in missing_ids if entity_id not in shared]
+
+        if missing_ids:
+            loaded = {
+                entity_id: get_entity_address(entity_meta)
+                for entity_id, entity_meta in Entity.objects.filter(
+                    id__in=missing_ids
+                ).values_list(
+                    'id',
+                    'entity_meta'
+                )
+            }
+            with self._lock:
+                self.misses += len(missing_ids)
+            self.set_local(loaded)
+            if self.shared_cache is not None:
+                self.shared_cache.set_many(
+                    {self.get_key(entity_id, generation): value for entity_id, value in loaded.items()},
+                    self.timeout,
+                )
+            resolved.update(loaded)
+
+        return {entity_id: resolved[entity_id] for entity_id in entity_ids if entity_id in resolved}
+
+    def get_local(self, entity_ids):
+        now = time.monotonic()
+        found = {}
+        with self._lock:
+            for entity_id in entity_ids:
+                entry = self.entries.get(entity_id)
+                if entry is None:
+                    continue
+                if entry[1] <= now:
+                    del self.entries[entity_id]
+                    continue
+                self.entries.move_to_end(entity_id)
+                found[entity_id] = entry[0]
+            self.hits += len(found)
+        return found
+
+    def get_shared(self, entity_ids, generation):
+        keys = {self.get_key(entity_id, generation): entity_id for entity_id in entity_ids}
+        found = {
+            keys[key]: tuple(value)
+            for key, value in self.shared_cache.get_many(list(keys)).items()
+        }
+        with self._lock:
+            self.shared_hits += len(found)
+        return found
+
+    def set_local(self, values):
+        expires = time.monotonic() + self.timeout
+        with self._lock:
+            for entity_id, value in values.items():
+                self.entries[entity_id] = (value, expires)
+                self.entries.move_to_end(entity_id)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, entity_ids):
+        """
+        Remove the entities from this cache and from the shared cache
+        """
+        entity_ids = list(entity_ids)
+        with self._lock:
+            for entity_id in entity_ids:
+                self.entries.pop(entity_id, None)
+        if self.shared_cache is not None:
+            generation = self.get_generation()
+            self.shared_cache.delete_many([self.get_key(entity_id, generation) for entity_id in entity_ids])
+
+    def clear(self):
+        """
+        Remove every entity from this cache and start a new generation of the shared cache, so that the entries of
+        the shared cache and of other processes are not used anymore
+        """
+        with self._lock:
+            self.entries.clear()
+        if self.shared_cache is not None:
+            self.shared_cache.set(self.generation_key, uuid.uuid4().hex, None)
+
+    def get_stats(self):
+        return {
+            'hits': self.hits,
+            'shared_hits': self.shared_hits,
+            'misses': self.misses,
+            'size': len(self.entries),
+        }
+
+
+# The address cache of the current process for each configuration
+address_caches = {}
+
+
+def get_address_cache():
+    """
+    Get the entity address cache for the ENTITY_EMAILER_ADDRESS_CACHE_SIZE, ENTITY_EMAILER_ADDRESS_CACHE and
+    ENTITY_EMAILER_ADDRESS_CACHE_TIMEOUT settings, or None if ENTITY_EMAILER_ADDRESS_CACHE_SIZE is not set. Since
+    the cached pairs depend on ENTITY_EMAILER_EMAIL_KEY and ENTITY_EMAILER_EXCLUDE_KEY, a change to those also
+    gets a new cache.
+    """
+    max_size = getattr(settings, 'ENTITY_EMAILER_ADDRESS_CACHE_SIZE', None)
+    if not max_size:
+        return None
+
+    options = (
+        max_size,
+        getattr(settings, 'ENTITY_EMAILER_ADDRESS_CACHE', None),
+        getattr(settings, 'ENTITY_EMAILER_ADDRESS_CACHE_TIMEOUT', 300),
+        getattr(settings, 'ENTITY_EMAILER_EMAIL_KEY', 'email'),
+        getattr(settings, 'ENTITY_EMAILER_EXCLUDE_KEY', None),
+    )
+    if options not in address_caches:
+        address_caches[options] = EntityAddressCache(*options[:3])
+    return address_caches[options]
+
+
+def invalidate_entity_address(sender, instance=None, instance_ids=None, **kwargs):
+    """
+    Remove a saved entity, or the entities whose activation changed, from every address cache of this process and
+    from the shared caches
+    """
+    entity_ids = instance_ids if instance_ids is not None else [instance.id]
+    # Processes that do not send emails, such as web processes, still have to remove the entities from the shared
+    # cache of the configured address cache
+    get_address_cache()
+    for address_cache in address_caches.values():
+        address_cache.invalidate(entity_ids)
+
+
+def clear_entity_addresses(sender, **kwargs):
+    """
+    Clear every address cache of this process and start a new generation of the shared caches after entities were
+    bulk updated, such as when they are synced
+    """
+    get_address_cache()
+    for address_cache in address_caches.values():
+        address_cache.clear()
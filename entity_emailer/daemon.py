@@ -0,0 +1,205 @@
+from datetime import datetime
+import logging
+import select
+import signal
+import time
+
+from django.core import mail
+from django.db import DEFAULT_DB_ALIAS, close_old_connections, connections
+
+from entity_emailer.backends.base import has_keepalive
+from entity_emailer.interface import EntityEmailerInterface
+from entity_emailer.utils import get_medium, get_notify_channel
+
+
+logger = logging.getLogger(__name__)
+
+
+class EmailerDaemon(object):
+    """
+    Sends scheduled emails in a loop inside a single long running process.
+
+    The email medium is looked up once and reused by every run. The email backend connection is also reused when the
+    backend can detect and repair a connection that broke while idle, which backends do by implementing ``keepalive``
+    like the entity emailer smtp backend. Other backends get a new connection for every run. The time between runs
+    adapts to the amount of work: the daemon polls every ``min_interval`` seconds while emails are flowing and backs off
+    by ``backoff`` up to ``max_interval`` seconds while idle, but never sleeps past the time the next scheduled email is
+    due. When ``listen`` is set and the database is postgres, the daemon also wakes up as soon as a NOTIFY arrives on
+    ``ENTITY_EMAILER_NOTIFY_CHANNEL``. When ``time_budget`` is set, every run stops picking up new emails after that
+    many seconds, so that a large backlog does not delay a stop request, and the next run starts right away. When
+    ``shard`` is set to an ``(index, count)`` pair, the daemon only sends the emails of that shard, so that several
+    daemons can split the due emails between them.
+
+    A run that fails, for example because the database connection was lost, is logged and the daemon backs off
+    before the next run instead of exiting.
+
+    Stopping the daemon (for example with SIGTERM) never interrupts a run, so no email is left half sent.
+    """
+    # The longest time that is slept at once, which bounds how long a stop request can go unnoticed
+    wait_slice = 0.5
+
+    def __init__(
+        self, min_interval=0.5, max_interval=30.0, backoff=2.0, listen=False, max_runs=None, time_budget=None,
+        shard=None
+    ):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.listen = listen
+        self.max_runs = max_runs
+        self.time_budget = time_budget
+        self.shard = shard
+        self.interval = min_interval
+        self.num_runs = 0
+        self.stopping = False
+        self.connection = None
+        self.email_medium = None
+        self.listen_connection = None
+
+    def stop(self, *args):
+        """
+        Request a graceful stop. Usable directly as a signal handler.
+        """
+        self.stopping = True
+
+    def install_signal_handlers(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+    def run(self):
+        """
+        Run until stopped or until ``max_runs`` runs have completed.
+        """
+        self.setup()
+        try:
+            while not self.stopping:
+                try:
+                    summary = self.run_once()
+                    timeout = 0 if summary['remaining_due'] else self.next_interval(summary['processed'])
+                except Exception:
+                    logger.exception('Sending scheduled emails failed')
+                    close_old_connections()
+                    timeout = self.back_off()
+                if self.max_runs is not None and self.num_runs >= self.max_runs:
+                    break
+                if timeout:
+                    self.wait(timeout)
+        finally:
+            self.teardown()
+
+    def setup(self):
+        connection = mail.get_connection()
+        if has_keepalive(connection):
+            self.connection = connection
+            self.connection.open()
+        self.email_medium = get_medium()
+        if self.listen:
+            self.listen_connection = self.start_listening()
+
+    def teardown(self):
+        if self.connection is not None:
+            self.connection.close()
+        if self.listen_connection is not None:
+            self.listen_connection.close()
+
+    def run_once(self):
+        """
+        Send the emails that are currently due within the time budget and return the summary of the run
+        """
+        close_old_connections()
+        try:
+            return EntityEmailerInterface.send_unsent_scheduled_emails(
+                connection=self.connection,
+                email_medium=self.email_medium,
+                time_budget=self.time_budget,
+                shard=self.shard,
+            )
+        finally:
+            self.num_runs += 1
+
+    def next_interval(self, num_processed):
+        """
+        Poll quickly while there is work and back off exponentially while idle. The wait is shortened so that
+        the daemon wakes up right when the next future email is due.
+        """
+        if num_processed:
+            self.interval = self.min_interval
+        else:
+            self.back_off()
+
+        # Emails that are already due but failed are retried on the regular interval, so only future emails are
+        # looked at
+        now = datetime.utcnow()
+        next_due = EntityEmailerInterface.next_due(after=now)
+        seconds_until_due = (next_due - now).total_seconds() if next_due else None
+        if seconds_until_due is not None and seconds_until_due < self.interval:
+            return seconds_until_due
+        return self.interval
+
+    def back_off(self):
+        """
+        Grow the wait between runs by the backoff factor up to the max interval and return it
+        """
+        self.interval = min(self.interval * self.backoff, self.max_interval)
+        return self.interval
+
+    def start_listening(self):
+        """
+        Open a dedicated database connection that listens on the notify channel. Returns None when notifications
+        are not available, in which case the daemon only polls.
+        """
+        channel = get_notify_channel()
+        listen_connection = connections.create_connection(DEFAULT_DB_ALIAS)
+        if not channel or listen_connection.vendor != 'postgresql':
+            return None
+
+        listen_connection.ensure_connection()
+        if not hasattr(listen_connection.connection, 'poll'):
+            # Waiting on notifications is only supported with the psycopg2 driver
+            listen_connection.close()
+            return None
+
+        with listen_connection.cursor() as cursor:
+            cursor.execute('LISTEN {0}'.format(listen_connection.ops.quote_name(channel)))
+        return listen_connection
+
+    def wait(self, timeout):
+        """
+        Sleep for up to ``timeout`` seconds, returning early when stopped or when a notification arrives
+        """
+        deadline = time.monotonic() + timeout
+        remaining = timeout
+        while not self.stopping and remaining > 0:
+            if self.wait_for_notification(min(remaining, self.wait_slice)):
+                return
+            self.keepalive()
+            remaining = deadline - time.monotonic()
+
+    def keepalive(self):
+        """
+        Keep the connection alive while idle when the backend supports it, such as the entity emailer smtp backend
+        """
+        keepalive = getattr(self.connection, 'keepalive', None)
+        if keepalive is not None:
+            try:
+                keepalive()
+            except Exception:
+                # The connection is checked again before it is used to send
+                pass
+
+    def wait_for_notification(self, timeout):
+        """
+        Block for up to ``timeout`` seconds and return True if a notification was received
+        """
+        if self.listen_connection is None:
+            time.sleep(timeout)
+            return False
+
+        raw_connection = self.listen_connection.connection
+        if select.select([raw_connection], [], [], timeout) == ([], [], []):
+            return False
+
+        raw_connection.poll()
+        received = bool(raw_connection.notifies)
+        del raw_connection.notifies[:]
+        return received
@@ -1,18 +1,31 @@
-from datetime import datetime
+from collections import Counter
+from datetime import datetime, timedelta
 import json
 import sys
+import time
 import traceback
+import uuid
 
 from ambition_utils.transaction import durable
 from django.conf import settings
 from django.core import mail
 from django.db import transaction
+from django.db.models import Count, F, Q, Sum, prefetch_related_objects
+from django.db.models.functions import Mod, TruncHour
 from entity_event import context_loader
-
-from entity_emailer.models import Email
-from entity_emailer.signals import pre_send, email_exception
+from entity_event.models import Event
+
+from entity_emailer.backends.base import get_persistent_connection, send_messages_with_results
+from entity_emailer.batching import get_batch_sizer
+from entity_emailer.cache import get_address_cache
+from entity_emailer.mime import SharedBodyMessageMixin, SharedBodyMIMEBuilder
+from entity_emailer.models import DeliveryStats, Email, ExceptionFingerprint, PendingEvent, RenderedBody
+from entity_emailer.signals import pre_send, pre_send_batch, email_exception, batch_sent
 from entity_emailer.utils import get_medium, get_from_email_address, get_subscribed_email_addresses, \
-    create_email_message, extract_email_subject_from_html_content
+    create_email_message, extract_email_subject_from_html_content, count_rows, get_approximate_count_threshold, \
+    get_attempt_checker, get_claim_timeout, get_deduplicate_exceptions, get_max_recipients_per_message, \
+    get_prerender, get_read_database, get_recipient_mode, get_record_delivery_stats, get_resolve_addresses_on_retry, \
+    get_results_chunk_size, get_stale_attempt_policy, get_stop_time, split_email_message
 
 
 class EntityEmailerInterface(object):
@@ -22,41 +35,297 @@ class EntityEmailerInterface(object):
 
     @classmethod
     @durable
-    def send_unsent_scheduled_emails(cls):
+    def send_unsent_scheduled_emails(
+        cls, connection=None, email_medium=None, time_budget=None, deadline=None, shard=None
+    ):
         """
         Send out any scheduled emails that are unsent
-        """
 
-        # Get the emails that we need to send
+        :param connection: An optional open email backend connection. When given, it is used for sending and left
+            open so that long running callers can keep it warm between runs. Otherwise a new connection is opened
+            for the run, unless ENTITY_EMAILER_PERSISTENT_CONNECTION is set, in which case the connection of the
+            previous run in this process is reused
+        :param email_medium: An optional email medium to avoid looking it up on every run
+        :param time_budget: An optional number of seconds after which the run stops picking up new emails
+        :param deadline: An optional utc datetime after which the run stops picking up new emails
+        :param shard: An optional ``(index, count)`` pair. When given, only the emails whose id modulo ``count`` is
+            ``index`` are sent, so that ``count`` senders can each send a disjoint share of the due emails
+        :return: A summary dict of the run with the number of emails ``processed``, the number of those that were
+            ``sent`` and that ``failed``, and the number of due emails that were left for a later run
+            (``remaining_due``) because the time budget or deadline was reached
+        """
         current_time = datetime.utcnow()
-        email_medium = get_medium()
-        to_send = Email.objects.filter(
+        email_medium = email_medium or get_medium()
+        stop_at = get_stop_time(current_time, time_budget, deadline)
+
+        # Reuse the connection of earlier runs in this process when persistent connections are turned on
+        if connection is None and getattr(settings, 'ENTITY_EMAILER_PERSISTENT_CONNECTION', False):
+            connection = get_persistent_connection()
+
+        if connection is None:
+            with mail.get_connection() as connection:
+                return cls.send_batches(connection, email_medium, current_time, stop_at, shard)
+        return cls.send_batches(connection, email_medium, current_time, stop_at, shard)
+
+    @classmethod
+    def send_batches(cls, connection, email_medium, current_time, stop_at=None, shard=None):
+        """
+        Send the emails that are due in batches sized by the batch sizer and return a summary of the run.
+        Batches are read in the order the emails are due, and every batch continues after the last email of the
+        previous batch so that emails that failed are not read again.
+
+        Once the ``time.monotonic`` time ``stop_at`` has passed, no new batch is read and no more emails of the
+        current batch are rendered. The emails that were already rendered are still sent.
+
+        When a ``shard`` is given, only the due emails of that shard are read.
+
+        Emails that were rendered ahead of sending are sent with their stored body, so the contexts of their events
+        are only loaded when there are receivers of the pre send signals.
+
+        When ENTITY_EMAILER_CLAIM_TIMEOUT is set, every batch is claimed before it is sent and released once the
+        results of sending it are saved, so that concurrent senders never send the same email. Emails left behind
+        by senders that stopped while sending them are reconciled first.
+        """
+        batch_sizer = get_batch_sizer()
+        claim_timeout = get_claim_timeout()
+        if claim_timeout is not None:
+            cls.reconcile_attempts(claim_timeout)
+        summary = {
+            'processed': 0,
+            'sent': 0,
+            'failed': 0,
+            'remaining_due': 0,
+        }
+        last_email = None
+        while True:
+            batch_size = batch_sizer.batch_size
+            if stop_at is not None and time.monotonic() >= stop_at:
+                summary['remaining_due'] = cls.get_due_emails(current_time, after=last_email, shard=shard).count()
+                break
+
+            # Get the emails that we need to send along with the contexts of their events
+            start = time.monotonic()
+            to_send = cls.get_batch(current_time, last_email, batch_size, claim_timeout, shard)
+            if not to_send:
+                break
+            context_loader.load_contexts_and_renderers(cls.get_events_to_load(to_send), [email_medium])
+            cls.prefetch_recipients(to_send)
+            query_time = time.monotonic()
+
+            emails_to_send, num_rendered = cls.render_emails(to_send, email_medium, current_time, stop_at)
+            render_time = time.monotonic()
+
+            # Fire the batch pre send signal for every email that was generated properly and send them
+            emails_to_send = cls.fire_pre_send_batch(emails_to_send)
+            cls.send_emails(
+                connection, emails_to_send, current_time, claimed_emails=to_send if claim_timeout is not None else None
+            )
+            send_time = time.monotonic()
+
+            # Emails that were not rendered before the time ran out are left for a later run
+            if num_rendered < len(to_send):
+                to_send = to_send[:num_rendered]
+                summary['remaining_due'] = cls.get_due_emails(current_time, after=to_send[-1], shard=shard).count()
+
+            num_sent = sum(1 for email in to_send if email.sent is not None)
+            summary['processed'] += len(to_send)
+            summary['sent'] += num_sent
+            summary['failed'] += len(to_send) - num_sent
+            cls.record_delivery_stats(to_send, current_time)
+
+            next_batch_size = batch_sizer.observe(
+                len(to_send), query_time - start, render_time - query_time, send_time - render_time
+            )
+            batch_sent.send(
+                sender=Email,
+                batch_size=batch_size,
+                num_emails=len(to_send),
+                query_seconds=query_time - start,
+                render_seconds=render_time - query_time,
+                send_seconds=send_time - render_time,
+                next_batch_size=next_batch_size,
+            )
+
+            if summary['remaining_due'] or batch_size is None or len(to_send) < batch_size:
+                break
+            last_email = to_send[-1]
+
+        return summary
+
+    @staticmethod
+    def get_due_emails(current_time, after=None, shard=None):
+        """
+        Returns the unsent emails that are due in the order they are due, optionally only those after the given
+        email in that order and only those in the given ``(index, count)`` shard
+        """
+        due_emails = Email.objects.filter(
             scheduled__lte=current_time,
             sent__isnull=True,
             num_tries__lt=settings.ENTITY_EMAILER_MAX_SEND_MESSAGE_TRIES
         ).select_related(
-            'event__source'
-        ).prefetch_related(
-            'recipients'
+            'event__source',
+            'rendered_body'
         ).order_by(
             'scheduled',
             'id'
         )
+        if after is not None:
+            due_emails = due_emails.filter(
+                Q(scheduled__gt=after.scheduled) | Q(scheduled=after.scheduled, id__gt=after.id)
+            )
+        if shard is not None:
+            index, count = shard
+            due_emails = due_emails.alias(shard=Mod('id', count)).filter(shard=index)
+        return due_emails
+
+    @classmethod
+    def get_batch(cls, current_time, after, batch_size, claim_timeout=None, shard=None):
+        """
+        Returns the next batch of due emails after the given email, optionally only from the given shard. When a
+        claim timeout is given, only the emails that no other sender is sending are returned and they are claimed
+        first.
+        """
+        due_emails = cls.get_due_emails(current_time, after=after, shard=shard)
+        if claim_timeout is not None:
+            return list(due_emails.filter(id__in=cls.claim_emails(due_emails, batch_size, claim_timeout)))
+        if batch_size is not None:
+            due_emails = due_emails[:batch_size]
+        return list(due_emails)
+
+    @staticmethod
+    def claim_emails(due_emails, batch_size, claim_timeout):
+        """
+        Claim up to ``batch_size`` of the due emails that are not claimed by another sender, or whose claim is
+        older than ``claim_timeout`` seconds, and return their ids. The claim is committed in its own short
+        transaction, and rows locked by a sender that is claiming at the same time are skipped rather than waited
+        for.
+        """
+        claimed = datetime.utcnow()
+        with transaction.atomic():
+            # Emails with an expired claim and an attempt may have been delivered, so they are left to reconciliation
+            email_ids = due_emails.filter(
+                Q(claimed__isnull=True) |
+                Q(claimed__lt=claimed - timedelta(seconds=claim_timeout), attempt__isnull=True)
+            ).select_related(
+                None
+            ).select_for_update(
+                skip_locked=True,
+                of=('self',)
+            ).values_list(
+                'id',
+                flat=True
+            )
+            if batch_size is not None:
+                email_ids = email_ids[:batch_size]
+            email_ids = list(email_ids)
+            Email.objects.filter(id__in=email_ids).update(claimed=claimed)
+        return email_ids
+
+    @staticmethod
+    def start_attempt(emails):
+        """
+        Save a new attempt token on the emails right before they are handed to the backend, so that a sender that
+        stops before their results are saved leaves a record that they may have been delivered
+        """
+        attempt = uuid.uuid4()
+        Email.objects.filter(id__in=[email.id for email in emails]).update(attempt=attempt)
+        for email in emails:
+            email.attempt = attempt
+
+    @staticmethod
+    def release_emails(emails):
+        """
+        Release the claim on the emails once the results of sending them are saved
+        """
+        Email.objects.filter(id__in=[email.id for email in emails]).update(claimed=None, attempt=None)
+
+    @staticmethod
+    def reconcile_attempts(claim_timeout, policy=None):
+        """
+        Handle the emails whose sender stopped after handing them to the backend but before saving the result,
+        which are the emails that still have an attempt once their claim expired. Depending on the policy, which
+        defaults to ENTITY_EMAILER_STALE_ATTEMPT_POLICY, they are either released to be sent again ('resend'),
+        given up on with an exception saying that their delivery is uncertain ('uncertain'), or marked as sent
+        when the ENTITY_EMAILER_ATTEMPT_CHECKER function reports them as delivered and sent again otherwise
+        ('check').
+
+        Returns the number of emails that were reconciled.
+        """
+        policy = policy or get_stale_attempt_policy()
+        current_time = datetime.utcnow()
+
+        # Claim the stale emails so that no other sender reconciles them at the same time
+        with transaction.atomic():
+            stale_ids = list(Email.objects.filter(
+                sent__isnull=True,
+                attempt__isnull=False,
+                claimed__lt=current_time - timedelta(seconds=claim_timeout),
+            ).select_for_update(
+                skip_locked=True
+            ).values_list(
+                'id',
+                flat=True
+            ))
+            Email.objects.filter(id__in=stale_ids).update(claimed=current_time)
+
+        if not stale_ids:
+            return 0
 
-        # Fetch the contexts of every event so that they may be rendered
-        context_loader.load_contexts_and_renderers([e.event for e in to_send], [email_medium])
+        stale_emails = Email.objects.filter(id__in=stale_ids)
+        if policy == 'uncertain':
+            # The attempt is kept as a record of which attempt the email was last handed to the backend in
+            stale_emails.update(
+                claimed=None,
+                exception='The sender stopped before the result of sending the email was saved',
+                num_tries=settings.ENTITY_EMAILER_MAX_SEND_MESSAGE_TRIES,
+            )
+            return len(stale_ids)
 
+        if policy == 'check':
+            delivered_ids = get_attempt_checker()(list(stale_emails.select_related('event__source')))
+            stale_emails.filter(id__in=delivered_ids).update(sent=current_time, claimed=None, attempt=None)
+
+        stale_emails.filter(sent__isnull=True).update(claimed=None, attempt=None)
+        return len(stale_ids)
+
+    @classmethod
+    def get_events_to_load(cls, to_send):
+        """
+        Returns the events of the emails whose contexts have to be loaded before the emails are sent. The contexts
+        of emails that were rendered ahead of sending are only needed by the receivers of the pre send signals.
+        """
+        fire_pre_send = getattr(settings, 'ENTITY_EMAILER_FIRE_PRE_SEND', True)
+        if pre_send_batch.receivers or (fire_pre_send and pre_send.receivers):
+            return [email.event for email in to_send]
+        return [email.event for email in to_send if email.rendered_body_id is None]
+
+    @classmethod
+    def render_emails(cls, to_send, email_medium, current_time, stop_at=None):
+        """
+        Render the message of every email and return the list of emails that can be sent along with the number of
+        emails that were rendered. Emails without any recipients are marked as sent and emails that fail to render
+        have their exception saved.
+
+        Rendering stops once the ``time.monotonic`` time ``stop_at`` has passed, although the first email is always
+        rendered so that every batch makes progress.
+        """
         # Keep track of what emails we will be sending
         emails_to_send = []
 
+        # The per email pre send signal can be turned off when only the batch signal is listened to
+        fire_pre_send = getattr(settings, 'ENTITY_EMAILER_FIRE_PRE_SEND', True)
+
         # Loop over each email and generate the recipients, and message
         # and handle any exceptions that may occur
-        for email in to_send:
+        for i, email in enumerate(to_send):
+            if i and stop_at is not None and time.monotonic() >= stop_at:
+                return emails_to_send, i
+
             # Compute what email addresses we actually want to send this email to
-            to_email_addresses = get_subscribed_email_addresses(email)
+            to_email_addresses = cls.get_undelivered_email_addresses(email)
 
-            # If there are no recipients we can just skip rendering
-            # and mark the email as sent
+            # If there are no recipients, or every recipient already received the email on an earlier try,
+            # we can just skip rendering and mark the email as sent
             if not to_email_addresses:
                 email.sent = current_time
                 email.save(update_fields=['sent'])
@@ -77,14 +346,15 @@ class EntityEmailerInterface(object):
                     html=html_message,
                 )
 
-                # Fire the pre send signal
-                pre_send.send(
-                    sender=sys.intern(email.event.source.name),
-                    email=email,
-                    event=email.event,
-                    context=email.event.context,
-                    message=message,
-                )
+                # Fire the pre send signal unless it has been turned off
+                if fire_pre_send:
+                    pre_send.send(
+                        sender=sys.intern(email.event.source.name),
+                        email=email,
+                        event=email.event,
+                        context=email.event.context,
+                        message=message,
+                    )
 
                 # Add the email to the list of emails that need to be sent
                 emails_to_send.append({
@@ -95,18 +365,350 @@ class EntityEmailerInterface(object):
                 # Save the exception on the model
                 cls.save_email_exception(email, traceback.format_exc())
 
-        # Send all the emails that were generated properly
-        with mail.get_connection() as connection:
-            for email in emails_to_send:
-                try:
-                    # Send mail
-                    connection.send_messages([email.get('message')])
-                    # Update the email model sent value
-                    email_model = email.get('model')
-                    email_model.sent = current_time
-                    email_model.save(update_fields=['sent'])
-                except Exception as e:
-                    cls.save_email_exception(email.get('model'), e)
+        return emails_to_send, len(to_send)
+
+    @classmethod
+    def fire_pre_send_batch(cls, emails_to_send):
+        """
+        Fire the pre send batch signal with every email that is about to be sent. If a receiver raises an
+        exception, it is saved on every email in the batch and none of them are sent.
+        """
+        if not emails_to_send:
+            return emails_to_send
+
+        batch = []
+        for email in emails_to_send:
+            email_model = email.get('model')
+            batch.append((email_model, email_model.event, email_model.event.context, email.get('message')))
+
+        try:
+            pre_send_batch.send(sender=Email, emails=batch)
+        except Exception:
+            exception_message = traceback.format_exc()
+            cls.save_email_exceptions([(email.get('model'), exception_message) for email in emails_to_send])
+            return []
+
+        return emails_to_send
+
+    @staticmethod
+    def resolves_addresses(email):
+        """
+        Returns True if the email addresses of the email are resolved from its recipients when it is sent, which is
+        the case unless they were saved when the email was created. Saved addresses are resolved again when the
+        email is retried if ENTITY_EMAILER_RESOLVE_ADDRESSES_ON_RETRY is set.
+        """
+        return email.to_addresses is None or bool(email.num_tries and get_resolve_addresses_on_retry())
+
+    @classmethod
+    def prefetch_recipients(cls, emails):
+        """
+        Prefetch the recipients of the emails whose addresses are resolved when they are sent. With the entity
+        address cache, only the recipient ids are read and their addresses are resolved through the cache for the
+        whole batch at once.
+        """
+        emails = [email for email in emails if cls.resolves_addresses(email)]
+        address_cache = get_address_cache()
+        if address_cache is None:
+            prefetch_related_objects(emails, 'recipients')
+            return
+
+        recipient_ids = {}
+        for email_id, entity_id in Email.recipients.through.objects.filter(
+            email_id__in=[email.id for email in emails]
+        ).values_list(
+            'email_id',
+            'entity_id'
+        ):
+            recipient_ids.setdefault(email_id, []).append(entity_id)
+
+        addresses = address_cache.resolve(set(entity_id for ids in recipient_ids.values() for entity_id in ids))
+        for email in emails:
+            email.recipient_addresses = {
+                entity_id: addresses[entity_id]
+                for entity_id in recipient_ids.get(email.id, [])
+                if entity_id in addresses
+            }
+
+    @classmethod
+    def get_undelivered_email_addresses(cls, email):
+        """
+        Returns the subscribed email addresses of the email that it has not already been delivered to
+        """
+        if cls.resolves_addresses(email):
+            email_addresses = get_subscribed_email_addresses(email)
+        else:
+            email_addresses = email.to_addresses
+        if email.delivered_addresses:
+            delivered_addresses = set(email.delivered_addresses)
+            email_addresses = [
+                email_address
+                for email_address in email_addresses
+                if email_address not in delivered_addresses
+            ]
+        return email_addresses
+
+    @staticmethod
+    def split_emails(emails_to_send):
+        """
+        Split every email into the messages that are actually sent. Returns the list of messages along with a list
+        of (email model, list of addresses of each of its messages) tuples in the same order.
+        """
+        max_recipients = get_max_recipients_per_message()
+        recipient_mode = get_recipient_mode()
+
+        # Every distinct body is encoded once for the whole batch instead of once per message
+        mime_builder = SharedBodyMIMEBuilder()
+
+        messages = []
+        split_emails = []
+        for email in emails_to_send:
+            email_messages = split_email_message(email.get('message'), max_recipients, recipient_mode)
+            split_emails.append((email.get('model'), [addresses for message, addresses in email_messages]))
+            for message, addresses in email_messages:
+                # Keep a reference to the email so that backends can make decisions based on it, such as routing
+                message.email_model = email.get('model')
+                if isinstance(message, SharedBodyMessageMixin):
+                    message.mime_builder = mime_builder
+                messages.append(message)
+
+        return messages, split_emails
+
+    @classmethod
+    def send_emails(cls, connection, emails_to_send, current_time, claimed_emails=None):
+        """
+        Send the rendered emails over the connection and record the result on each email model. The emails are
+        handed to the backend in chunks of ENTITY_EMAILER_RESULTS_CHUNK_SIZE emails, and the results of every chunk
+        are saved before the next chunk is sent, so that a sender that stops in the middle of a batch only leaves
+        one chunk of delivered emails that are not marked as sent.
+
+        When the ``claimed_emails`` of the batch are given, an attempt is saved on the emails of every chunk before
+        they are sent, and the results of the chunk are saved in one transaction that also releases its emails.
+        The claimed emails that were not sent, such as those that failed to render, are released at the end.
+
+        Emails with more recipients than ENTITY_EMAILER_MAX_RECIPIENTS_PER_MESSAGE, or with a recipient mode of
+        individual or bcc, are split into several messages. An email is only marked as sent once all of its
+        messages were sent. When only some of them were sent, their addresses are saved so that the retry skips them.
+        """
+        messages, split_emails = cls.split_emails(emails_to_send)
+        chunk_size = get_results_chunk_size(connection)
+
+        position = 0
+        for start in range(0, len(split_emails), chunk_size):
+            chunk = split_emails[start:start + chunk_size]
+            num_messages = sum(len(addresses) for email_model, addresses in chunk)
+            cls.send_chunk(
+                connection, chunk, messages[position:position + num_messages], current_time, claimed_emails is not None
+            )
+            position += num_messages
+
+        if claimed_emails is not None:
+            sent_ids = set(email_model.id for email_model, addresses in split_emails)
+            cls.release_emails([email for email in claimed_emails if email.id not in sent_ids])
+
+    @classmethod
+    def send_chunk(cls, connection, split_emails, messages, current_time, claimed=False):
+        """
+        Send the messages of a chunk of split emails and save their results. Claimed emails get an attempt before
+        they are sent and are released along with saving their results.
+        """
+        email_models = [email_model for email_model, addresses in split_emails]
+        if claimed:
+            cls.start_attempt(email_models)
+
+        results = iter(send_messages_with_results(connection, messages))
+
+        if not claimed:
+            cls.save_results(split_emails, results, current_time)
+            return
+
+        with transaction.atomic():
+            cls.save_results(split_emails, results, current_time)
+            cls.release_emails(email_models)
+
+    @classmethod
+    def save_results(cls, split_emails, results, current_time):
+        """
+        Mark the emails whose messages were all sent as sent and save the exception on the others
+        """
+        sent_email_ids = []
+        failures = []
+        for email_model, chunks in split_emails:
+            delivered_addresses = []
+            exceptions = []
+            for addresses, exception in zip(chunks, results):
+                if exception is None:
+                    delivered_addresses.extend(addresses)
+                else:
+                    exceptions.append(exception)
+
+            if not exceptions:
+                email_model.sent = current_time
+                sent_email_ids.append(email_model.id)
+                continue
+
+            # Remember who already received the email so that they do not receive it twice when it is retried
+            if delivered_addresses:
+                email_model.delivered_addresses = email_model.delivered_addresses + delivered_addresses
+                email_model.save(update_fields=['delivered_addresses'])
+            failures.append((email_model, exceptions[0]))
+
+        cls.save_email_exceptions(failures)
+
+        # Mark all of the successfully sent emails as sent at once
+        if sent_email_ids:
+            Email.objects.filter(id__in=sent_email_ids).update(sent=current_time)
+
+    @staticmethod
+    def record_delivery_stats(emails, current_time):
+        """
+        Count the emails of a batch that was sent at ``current_time`` in the delivery stats of its hour when
+        ENTITY_EMAILER_DELIVERY_STATS is set. Emails that were marked as sent count as sent and the others as failed.
+        """
+        if not get_record_delivery_stats() or not emails:
+            return
+
+        DeliveryStats.objects.increment(DeliveryStats.get_hour(current_time), Counter(
+            (email.event.source_id, DeliveryStats.SENT if email.sent is not None else DeliveryStats.FAILED)
+            for email in emails
+        ))
+
+    @staticmethod
+    def get_delivery_stats(start_time=None, end_time=None, source_names=None, outcome=None):
+        """
+        Returns the delivery stats of the hours from the hour of ``start_time`` up to ``end_time``, optionally only
+        those of the sources with the given names or of one outcome, as a list of dicts with the ``hour``, the
+        ``source`` name, the ``outcome`` and the ``count``, in the order of the hours. The stats are read from the
+        ENTITY_EMAILER_READ_DATABASE.
+        """
+        delivery_stats = DeliveryStats.objects.using(get_read_database())
+        if start_time is not None:
+            delivery_stats = delivery_stats.filter(hour__gte=DeliveryStats.get_hour(start_time))
+        if end_time is not None:
+            delivery_stats = delivery_stats.filter(hour__lt=end_time)
+        if source_names is not None:
+            delivery_stats = delivery_stats.filter(source__name__in=source_names)
+        if outcome is not None:
+            delivery_stats = delivery_stats.filter(outcome=outcome)
+
+        return [
+            dict(hour=hour, source=source, outcome=outcome, count=count)
+            for hour, source, outcome, count in delivery_stats.order_by(
+                'hour',
+                'source__name',
+                'outcome'
+            ).values_list(
+                'hour',
+                'source__name',
+                'outcome',
+                'count'
+            )
+        ]
+
+    @staticmethod
+    @transaction.atomic
+    def backfill_delivery_stats(end_time=None):
+        """
+        Replace the delivery stats of the hours before the hour of ``end_time``, which defaults to now, with counts
+        computed from the saved emails. Sent emails are counted in the hour they were sent. Since only the number of
+        tries of an email is saved, failures are counted in the hour the email was scheduled. Returns the number of
+        stats that were saved.
+        """
+        end_hour = DeliveryStats.get_hour(end_time or datetime.utcnow())
+
+        sent = Email.objects.filter(
+            sent__lt=end_hour
+        ).annotate(
+            hour=TruncHour('sent')
+        ).values_list(
+            'hour',
+            'event__source_id'
+        ).annotate(
+            count=Count('id')
+        ).order_by()
+        failed = Email.objects.filter(
+            num_tries__gt=0,
+            scheduled__lt=end_hour
+        ).annotate(
+            hour=TruncHour('scheduled')
+        ).values_list(
+            'hour',
+            'event__source_id'
+        ).annotate(
+            count=Sum('num_tries')
+        ).order_by()
+
+        DeliveryStats.objects.filter(hour__lt=end_hour).delete()
+        return len(DeliveryStats.objects.bulk_create(
+            [
+                DeliveryStats(hour=hour, source_id=source_id, outcome=DeliveryStats.SENT, count=count)
+                for hour, source_id, count in sent
+            ] + [
+                DeliveryStats(hour=hour, source_id=source_id, outcome=DeliveryStats.FAILED, count=count)
+                for hour, source_id, count in failed
+            ]
+        ))
+
+    @staticmethod
+    def next_due(after=None):
+        """
+        Returns the scheduled time of the next unsent email that can still be sent, or None if there are none.
+        This lets callers sleep until the next email is due instead of polling.
+
+        :param after: An optional utc datetime. When given, only emails scheduled after it are looked at, so that
+            emails that are already due, such as failed emails waiting to be retried, don't hide the next future
+            email
+        """
+        emails = Email.objects.filter(
+            sent__isnull=True,
+            scheduled__isnull=False,
+            num_tries__lt=settings.ENTITY_EMAILER_MAX_SEND_MESSAGE_TRIES
+        )
+        if after is not None:
+            emails = emails.filter(scheduled__gt=after)
+        return emails.order_by(
+            'scheduled'
+        ).values_list(
+            'scheduled',
+            flat=True
+        ).first()
+
+    @staticmethod
+    def queue_health(current_time=None):
+        """
+        Returns a snapshot of the health of the email queue that is cheap enough to take every few seconds. Every
+        query only reads the indexes over unsent emails. The dict has:
+
+        - ``pending``: the number of due emails that can still be sent
+        - ``oldest_due_seconds``: how many seconds the oldest of those has been due for, or None if there are none
+        - ``retrying``: the number of unsent emails that failed but will be tried again
+        - ``failed``: the number of unsent emails that failed ENTITY_EMAILER_MAX_SEND_MESSAGE_TRIES times
+        - ``approximate``: the names of the counts that are estimates because they are at least
+          ENTITY_EMAILER_APPROXIMATE_COUNT_THRESHOLD, which on postgres are taken from the table statistics
+
+        The queue is read from the ENTITY_EMAILER_READ_DATABASE.
+        """
+        current_time = current_time or datetime.utcnow()
+        max_tries = settings.ENTITY_EMAILER_MAX_SEND_MESSAGE_TRIES
+        threshold = get_approximate_count_threshold()
+
+        unsent_emails = Email.objects.using(get_read_database()).filter(sent__isnull=True)
+        due_emails = unsent_emails.filter(scheduled__lte=current_time, num_tries__lt=max_tries)
+        oldest_due = due_emails.order_by('scheduled').values_list('scheduled', flat=True).first()
+
+        health = {
+            'oldest_due_seconds': (current_time - oldest_due).total_seconds() if oldest_due is not None else None,
+            'approximate': [],
+        }
+        for name, queryset in (
+            ('pending', due_emails),
+            ('retrying', unsent_emails.filter(num_tries__gt=0, num_tries__lt=max_tries)),
+            ('failed', unsent_emails.filter(num_tries__gte=max_tries)),
+        ):
+            health[name], approximate = count_rows(queryset, threshold)
+            if approximate:
+                health['approximate'].append(name)
+
+        return health
 
     @staticmethod
     def convert_events_to_emails():
@@ -120,6 +722,8 @@ class EntityEmailerInterface(object):
         # Get the default from email
         default_from_email = get_from_email_address()
 
+        emails = []
+
         # Find any unseen events and create unsent email objects
         for event, targets in email_medium.events_targets(seen=False, mark_seen=True):
 
@@ -127,7 +731,10 @@ class EntityEmailerInterface(object):
             from_address = event.context.get('from_address') or default_from_email
 
             # Create the emails
-            Email.objects.create_email(event=event, from_address=from_address, recipients=targets)
+            emails.append(Email.objects.create_email(event=event, from_address=from_address, recipients=targets))
+
+        if get_prerender():
+            EntityEmailerInterface.prerender_emails(emails, email_medium)
 
     @staticmethod
     @transaction.atomic
@@ -158,11 +765,148 @@ class EntityEmailerInterface(object):
             ))
 
         # Bulk create the emails
-        Email.objects.create_emails(email_params_list)
+        emails = Email.objects.create_emails(email_params_list)
+
+        if get_prerender():
+            EntityEmailerInterface.prerender_emails(emails, email_medium)
+
+    @staticmethod
+    def convert_pending_events(batch_size=1000):
+        """
+        Converts the events queued in PendingEvent to emails in batches and removes them from the queue. Instead of
+        scanning every event for unseen ones, each batch only looks at the unseen events within the time window of
+        its queued events, and only converts and marks as seen the queued events themselves. Other events in the
+        window may be queued in a batch of another converter. Returns the number of queued events that were
+        processed.
+        """
+        email_medium = get_medium()
+        default_from_email = get_from_email_address()
+
+        num_processed = 0
+        while True:
+            with transaction.atomic():
+                # Skip events that another converter is processing
+                pending = list(PendingEvent.objects.select_for_update(
+                    skip_locked=True,
+                    of=('self',)
+                ).order_by(
+                    'id'
+                ).values_list(
+                    'id',
+                    'event_id',
+                    'event__time',
+                )[:batch_size])
+                if not pending:
+                    break
+
+                pending_ids, queued_event_ids, event_times = zip(*pending)
+
+                # The queued events that the email medium has not seen yet
+                event_ids = set(
+                    email_medium.get_filtered_events_queryset(
+                        start_time=None,
+                        end_time=None,
+                        seen=False,
+                        include_expired=False,
+                        actor=None,
+                        queryset=Event.objects.filter(id__in=queued_event_ids),
+                    ).values_list(
+                        'id',
+                        flat=True
+                    )
+                )
+                email_params_list = [
+                    dict(
+                        event=event,
+                        from_address=event.context.get('from_address') or default_from_email,
+                        recipients=targets,
+                    )
+                    for event, targets in email_medium.events_targets(
+                        start_time=min(event_times),
+                        end_time=max(event_times),
+                        seen=False,
+                    )
+                    if event.id in event_ids
+                ]
+                Event.objects.filter(id__in=event_ids).mark_seen(email_medium)
+                emails = Email.objects.create_emails(email_params_list)
+                if get_prerender():
+                    EntityEmailerInterface.prerender_emails(emails, email_medium)
+                PendingEvent.objects.filter(id__in=pending_ids).delete()
+
+            num_processed += len(pending)
+            if len(pending) < batch_size:
+                break
+
+        return num_processed
+
+    @staticmethod
+    def prerender_emails(emails, email_medium=None):
+        """
+        Render the bodies of the emails and store them so that they are not rendered again when the emails are sent
+        or retried. Every distinct body is stored once. Emails that fail to render are left to be rendered when
+        they are sent, which is when their exception is saved. Returns the number of emails that were rendered.
+        """
+        email_medium = email_medium or get_medium()
+        emails = [email for email in emails if email.rendered_body_id is None and email.sent is None]
+        context_loader.load_contexts_and_renderers([email.event for email in emails], [email_medium])
+
+        rendered_emails = []
+        bodies = []
+        for email in emails:
+            try:
+                bodies.append(email.render(email_medium))
+            except Exception:
+                continue
+            rendered_emails.append(email)
+
+        # Point the emails at their stored body with one update for each distinct body
+        email_ids_by_body = {}
+        for email, body_id in zip(rendered_emails, RenderedBody.objects.store_bodies(bodies)):
+            email.rendered_body_id = body_id
+            email_ids_by_body.setdefault(body_id, []).append(email.id)
+        for body_id, email_ids in email_ids_by_body.items():
+            Email.objects.filter(id__in=email_ids).update(rendered_body_id=body_id)
+
+        return len(rendered_emails)
 
     @classmethod
-    def save_email_exception(cls, email, e):
-        # Save the error to the email model
+    def prerender_unsent_emails(cls, batch_size=1000):
+        """
+        Render and store the bodies of the unsent emails that were not rendered yet, in batches of ``batch_size``.
+        This is meant to be run as a background pass so that emails created before ENTITY_EMAILER_PRERENDER was set,
+        or created without the convert methods, are not rendered by the sender. Returns the number of emails that
+        were rendered.
+        """
+        email_medium = get_medium()
+        num_rendered = 0
+        last_id = 0
+        while True:
+            emails = list(Email.objects.filter(
+                id__gt=last_id,
+                sent__isnull=True,
+                rendered_body__isnull=True,
+                num_tries__lt=settings.ENTITY_EMAILER_MAX_SEND_MESSAGE_TRIES
+            ).select_related(
+                'event__source'
+            ).order_by(
+                'id'
+            )[:batch_size])
+            if not emails:
+                break
+
+            num_rendered += cls.prerender_emails(emails, email_medium)
+            if len(emails) < batch_size:
+                break
+            last_id = emails[-1].id
+
+        return num_rendered
+
+    @staticmethod
+    def get_exception_message(e):
+        """
+        Returns the message that is saved for an exception, or for the formatted traceback of one
+        """
         exception_message = str(e)
 
         # Duck typing exception for sendgrid api backend rather than place hard dependency
@@ -176,13 +920,61 @@ class EntityEmailerInterface(object):
             # Set the exception message to the exception's serialized dump
             exception_message += ': {}'.format(json.dumps(exception_dict))
 
-        email.exception = exception_message
-        email.num_tries += 1
-        email.save(update_fields=['exception', 'num_tries'])
+        return exception_message
+
+    @classmethod
+    def save_email_exception(cls, email, e):
+        cls.save_email_exceptions([(email, e)])
+
+    @classmethod
+    def save_email_exceptions(cls, failures):
+        """
+        Save the exception of every (email, exception) failure and count it as a try of the email.
+
+        When ENTITY_EMAILER_DEDUPLICATE_EXCEPTIONS is set, each distinct exception is saved once as an
+        ExceptionFingerprint and the emails only reference it, which takes one update for every distinct
+        exception instead of one for every email.
+        """
+        if not failures:
+            return
+
+        if get_deduplicate_exceptions():
+            cls.save_exception_fingerprints(failures)
+        else:
+            for email, e in failures:
+                # Save the error to the email model
+                email.exception = cls.get_exception_message(e)
+                email.num_tries += 1
+                email.save(update_fields=['exception', 'num_tries'])
 
         # Fire the email exception event
-        email_exception.send(
-            sender=Email,
-            email=email,
-            exception=e
-        )
+        for email, e in failures:
+            email_exception.send(
+                sender=Email,
+                email=email,
+                exception=e
+            )
+
+    @classmethod
+    def save_exception_fingerprints(cls, failures):
+        """
+        Record the fingerprint of every exception and point each email at its fingerprint
+        """
+        fingerprint_ids = ExceptionFingerprint.objects.record([
+            (type(e).__name__ if isinstance(e, BaseException) else '', cls.get_exception_message(e))
+            for email, e in failures
+        ])
+
+        email_ids_by_fingerprint = {}
+        for (email, e), fingerprint_id in zip(failures, fingerprint_ids):
+            email.exception = None
+            email.exception_fingerprint_id = fingerprint_id
+            email.num_tries += 1
+            email_ids_by_fingerprint.setdefault(fingerprint_id, []).append(email.id)
+
+        for fingerprint_id, email_ids in email_ids_by_fingerprint.items():
+            Email.objects.filter(id__in=email_ids).update(
+                exception=None,
+                exception_fingerprint_id=fingerprint_id,
+                num_tries=F('num_tries') + 1,
+            )
@@ -0,0 +1,19 @@
+from datetime import datetime
+
+from django.core.management import BaseCommand
+
+from entity_emailer.interface import EntityEmailerInterface
+
+
+class Command(BaseCommand):
+    help = 'Compute the hourly delivery stats of existing emails.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--end', type=datetime.fromisoformat, default=None,
+            help='Utc time before whose hour the stats are replaced. Defaults to now.',
+        )
+
+    def handle(self, *args, **options):
+        num_stats = EntityEmailerInterface.backfill_delivery_stats(end_time=options['end'])
+        self.stdout.write('Saved {0} delivery stats'.format(num_stats))
@@ -0,0 +1,11 @@
+from django.core.management import BaseCommand
+
+from entity_emailer.models import RenderedBody
+
+
+class Command(BaseCommand):
+    help = 'Delete the pre-rendered email bodies that no email uses anymore and print how many were deleted.'
+
+    def handle(self, *args, **options):
+        num_deleted, deleted = RenderedBody.objects.delete_unused()
+        self.stdout.write(str(num_deleted))
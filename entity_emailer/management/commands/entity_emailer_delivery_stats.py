@@ -0,0 +1,40 @@
+from datetime import datetime
+
+from django.core.management import BaseCommand
+
+from entity_emailer.interface import EntityEmailerInterface
+from entity_emailer.models import DeliveryStats
+
+
+class Command(BaseCommand):
+    help = 'Print the number of emails sent and failed per hour and source.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--start', type=datetime.fromisoformat, default=None,
+            help='Utc time of the first hour to print, such as 2014-01-05T10:00.',
+        )
+        parser.add_argument(
+            '--end', type=datetime.fromisoformat, default=None,
+            help='Utc time before which hours are printed.',
+        )
+        parser.add_argument(
+            '--source', action='append', dest='sources', default=None,
+            help='Name of a source to print. Can be given several times.',
+        )
+        parser.add_argument(
+            '--outcome', choices=DeliveryStats.OUTCOMES, default=None,
+            help='Only print the counts of this outcome.',
+        )
+
+    def handle(self, *args, **options):
+        delivery_stats = EntityEmailerInterface.get_delivery_stats(
+            start_time=options['start'],
+            end_time=options['end'],
+            source_names=options['sources'],
+            outcome=options['outcome'],
+        )
+        for stats in delivery_stats:
+            self.stdout.write('{0}\t{1}\t{2}\t{3}'.format(
+                stats['hour'].isoformat(), stats['source'], stats['outcome'], stats['count']
+            ))
@@ -0,0 +1,12 @@
+import json
+
+from django.core.management import BaseCommand
+
+from entity_emailer.interface import EntityEmailerInterface
+
+
+class Command(BaseCommand):
+    help = 'Print the health of the email queue as json.'
+
+    def handle(self, *args, **options):
+        self.stdout.write(json.dumps(EntityEmailerInterface.queue_health(), sort_keys=True))
@@ -0,0 +1,48 @@
+from django.core.management import BaseCommand
+
+from entity_emailer.daemon import EmailerDaemon
+
+
+class Command(BaseCommand):
+    help = 'Continuously send scheduled emails from a single long running process.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--min-interval', type=float, default=0.5,
+            help='Seconds to wait between runs while emails are being sent.',
+        )
+        parser.add_argument(
+            '--max-interval', type=float, default=30.0,
+            help='Longest number of seconds to wait between runs while idle.',
+        )
+        parser.add_argument(
+            '--backoff', type=float, default=2.0,
+            help='Factor the wait between runs grows by after each idle run.',
+        )
+        parser.add_argument(
+            '--listen', action='store_true', default=False,
+            help='Wake up on postgres notifications sent on ENTITY_EMAILER_NOTIFY_CHANNEL.',
+        )
+        parser.add_argument(
+            '--max-runs', type=int, default=None,
+            help='Exit after this many runs instead of running until stopped.',
+        )
+        parser.add_argument(
+            '--time-budget', type=float, default=None,
+            help='Seconds after which a run stops picking up new emails.',
+        )
+
+    def get_daemon_options(self, options):
+        return {
+            'min_interval': options['min_interval'],
+            'max_interval': options['max_interval'],
+            'backoff': options['backoff'],
+            'listen': options['listen'],
+            'max_runs': options['max_runs'],
+            'time_budget': options['time_budget'],
+        }
+
+    def handle(self, *args, **options):
+        daemon = EmailerDaemon(**self.get_daemon_options(options))
+        daemon.install_signal_handlers()
+        daemon.run()
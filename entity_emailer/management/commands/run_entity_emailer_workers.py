@@ -0,0 +1,30 @@
+import json
+import os
+
+from entity_emailer.management.commands import run_entity_emailer
+from entity_emailer.supervisor import EmailerSupervisor
+
+
+class Command(run_entity_emailer.Command):
+    help = 'Continuously send scheduled emails from several worker processes that each send a share of the emails.'
+
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
+        parser.add_argument(
+            '--workers', type=int, default=os.cpu_count() or 1,
+            help='Number of worker processes. Defaults to the number of cpus.',
+        )
+        parser.add_argument(
+            '--restart-delay', type=float, default=1.0,
+            help='Seconds to wait before restarting a worker that crashed.',
+        )
+
+    def handle(self, *args, **options):
+        supervisor = EmailerSupervisor(
+            num_workers=options['workers'],
+            daemon_options=self.get_daemon_options(options),
+            restart_delay=options['restart_delay'],
+        )
+        supervisor.install_signal_handlers()
+        stats = supervisor.run()
+        self.stdout.write(json.dumps(stats, sort_keys=True))
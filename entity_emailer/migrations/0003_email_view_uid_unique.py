@@ -0,0 +1,79 @@
+from django.db import migrations, models
+import uuid
+
+
+INDEX_NAME = 'entity_emailer_email_view_uid_uniq'
+
+
+def get_view_uid_fields(apps):
+    """
+    Returns the email model along with its view_uid field before and after being made unique
+    """
+    email_model = apps.get_model('entity_emailer', 'Email')
+    old_field = email_model._meta.get_field('view_uid')
+    new_field = models.UUIDField(default=uuid.uuid4, editable=False, unique=True)
+    new_field.set_attributes_from_name('view_uid')
+    new_field.model = email_model
+    return email_model, old_field, new_field
+
+
+def add_view_uid_unique(apps, schema_editor):
+    """
+    On postgres the unique index is built concurrently so that the email table is not locked while it is built,
+    and is then attached as the unique constraint. A build that failed or was interrupted leaves an invalid index
+    behind, which can't be attached, so it is dropped and built again. Other databases use a regular unique
+    constraint.
+    """
+    email_model, old_field, new_field = get_view_uid_fields(apps)
+    if schema_editor.connection.vendor == 'postgresql':
+        table = schema_editor.quote_name(email_model._meta.db_table)
+        with schema_editor.connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT 1 FROM pg_index JOIN pg_class ON pg_class.oid = pg_index.indexrelid '
+                'WHERE pg_class.relname = %s AND NOT pg_index.indisvalid',
+                [INDEX_NAME]
+            )
+            if cursor.fetchone():
+                schema_editor.execute('DROP INDEX CONCURRENTLY IF EXISTS {0}'.format(INDEX_NAME))
+        schema_editor.execute('CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS {0} ON {1} (view_uid)'.format(
+            INDEX_NAME, table
+        ))
+        schema_editor.execute('ALTER TABLE {0} ADD CONSTRAINT {1} UNIQUE USING INDEX {1}'.format(
+            table, INDEX_NAME
+        ))
+    else:
+        schema_editor.alter_field(email_model, old_field, new_field)
+
+
+def remove_view_uid_unique(apps, schema_editor):
+    email_model, old_field, new_field = get_view_uid_fields(apps)
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute('ALTER TABLE {0} DROP CONSTRAINT IF EXISTS {1}'.format(
+            schema_editor.quote_name(email_model._meta.db_table), INDEX_NAME
+        ))
+    else:
+        schema_editor.alter_field(email_model, new_field, old_field)
+
+
+class Migration(migrations.Migration):
+    # Building an index concurrently can not happen inside of a transaction
+    atomic = False
+
+    dependencies = [
+        ('entity_emailer', '0002_email_unsent_index'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunPython(add_view_uid_unique, remove_view_uid_unique),
+            ],
+            state_operations=[
+                migrations.AlterField(
+                    model_name='email',
+                    name='view_uid',
+                    field=models.UUIDField(default=uuid.uuid4, editable=False, unique=True),
+                ),
+            ],
+        ),
+    ]
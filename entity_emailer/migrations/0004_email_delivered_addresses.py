@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-19 03:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('entity_emailer', '0003_email_view_uid_unique'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='email',
+            name='delivered_addresses',
+            field=models.JSONField(default=list),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-19 02:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('entity_emailer', '0004_email_delivered_addresses'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='email',
+            name='claimed',
+            field=models.DateTimeField(default=None, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-19 03:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('entity_emailer', '0005_email_claimed'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='email',
+            name='attempt',
+            field=models.UUIDField(default=None, null=True),
+        ),
+    ]
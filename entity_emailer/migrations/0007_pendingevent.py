@@ -0,0 +1,22 @@
+# Generated by Django 4.2.30 on 2026-10-19 03:02
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('entity_event', '0001_0005_squashed'),
+        ('entity_emailer', '0006_email_attempt'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingEvent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('event', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to='entity_event.event')),
+            ],
+        ),
+    ]
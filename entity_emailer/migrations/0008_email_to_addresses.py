@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-19 03:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('entity_emailer', '0007_pendingevent'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='email',
+            name='to_addresses',
+            field=models.JSONField(default=None, null=True),
+        ),
+    ]
@@ -0,0 +1,115 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+INDEX = models.Index(fields=['rendered_body'], name='entity_emailer_body_idx')
+CONSTRAINT_NAME = 'entity_emailer_body_fk'
+
+
+def get_rendered_body_field(apps, email_model):
+    """
+    Returns the rendered body field of the email model along with its index and foreign key constraint
+    """
+    field = models.ForeignKey(
+        apps.get_model('entity_emailer', 'RenderedBody'), default=None, null=True, on_delete=models.SET_NULL
+    )
+    field.set_attributes_from_name('rendered_body')
+    field.model = email_model
+    return field
+
+
+def add_rendered_body_index(apps, schema_editor):
+    """
+    The column is added without its index and foreign key constraint. On postgres the index is then built
+    concurrently and the constraint is validated after it is added, so that writes to the email table are not
+    blocked while either scans the table. An invalid index left behind by an earlier build that failed is dropped
+    first. Other databases alter the column to add both.
+    """
+    email_model = apps.get_model('entity_emailer', 'Email')
+    if schema_editor.connection.vendor != 'postgresql':
+        schema_editor.alter_field(
+            email_model, email_model._meta.get_field('rendered_body'), get_rendered_body_field(apps, email_model)
+        )
+        return
+
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT 1 FROM pg_index JOIN pg_class ON pg_class.oid = pg_index.indexrelid '
+            'WHERE pg_class.relname = %s AND NOT pg_index.indisvalid',
+            [INDEX.name]
+        )
+        if cursor.fetchone():
+            schema_editor.execute(INDEX.remove_sql(email_model, schema_editor, concurrently=True))
+    schema_editor.execute(INDEX.create_sql(email_model, schema_editor, concurrently=True))
+
+    rendered_body_model = apps.get_model('entity_emailer', 'RenderedBody')
+    table = schema_editor.quote_name(email_model._meta.db_table)
+    schema_editor.execute(
+        'ALTER TABLE {0} ADD CONSTRAINT {1} FOREIGN KEY ({2}) REFERENCES {3} ({4}) '
+        'DEFERRABLE INITIALLY DEFERRED NOT VALID'.format(
+            table,
+            schema_editor.quote_name(CONSTRAINT_NAME),
+            schema_editor.quote_name('rendered_body_id'),
+            schema_editor.quote_name(rendered_body_model._meta.db_table),
+            schema_editor.quote_name(rendered_body_model._meta.pk.column),
+        )
+    )
+    schema_editor.execute(
+        'ALTER TABLE {0} VALIDATE CONSTRAINT {1}'.format(table, schema_editor.quote_name(CONSTRAINT_NAME))
+    )
+
+
+def remove_rendered_body_index(apps, schema_editor):
+    """
+    Removing the column on postgres also removes its index and constraint. Other databases alter the column back
+    first, since some can not drop a constraint on its own.
+    """
+    email_model = apps.get_model('entity_emailer', 'Email')
+    if schema_editor.connection.vendor != 'postgresql':
+        schema_editor.alter_field(
+            email_model, get_rendered_body_field(apps, email_model), email_model._meta.get_field('rendered_body')
+        )
+
+
+class Migration(migrations.Migration):
+    # Building an index concurrently can not happen inside of a transaction
+    atomic = False
+
+    dependencies = [
+        ('entity_emailer', '0008_email_to_addresses'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RenderedBody',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hash', models.CharField(max_length=64, unique=True)),
+                ('text', models.TextField()),
+                ('html', models.TextField()),
+            ],
+        ),
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.AddField(
+                    model_name='email',
+                    name='rendered_body',
+                    field=models.ForeignKey(
+                        db_constraint=False, db_index=False, default=None, null=True,
+                        on_delete=django.db.models.deletion.SET_NULL, to='entity_emailer.renderedbody'
+                    ),
+                ),
+                migrations.RunPython(add_rendered_body_index, remove_rendered_body_index),
+            ],
+            state_operations=[
+                migrations.AddField(
+                    model_name='email',
+                    name='rendered_body',
+                    field=models.ForeignKey(
+                        default=None, null=True, on_delete=django.db.models.deletion.SET_NULL,
+                        to='entity_emailer.renderedbody'
+                    ),
+                ),
+            ],
+        ),
+    ]
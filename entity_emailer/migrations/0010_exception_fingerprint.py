@@ -0,0 +1,124 @@
+import datetime
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+INDEX = models.Index(fields=['exception_fingerprint'], name='entity_emailer_fprint_idx')
+CONSTRAINT_NAME = 'entity_emailer_fprint_fk'
+
+
+def get_exception_fingerprint_field(apps, email_model):
+    """
+    Returns the exception fingerprint field of the email model along with its index and foreign key constraint
+    """
+    field = models.ForeignKey(
+        apps.get_model('entity_emailer', 'ExceptionFingerprint'), default=None, null=True, on_delete=models.SET_NULL
+    )
+    field.set_attributes_from_name('exception_fingerprint')
+    field.model = email_model
+    return field
+
+
+def add_exception_fingerprint_index(apps, schema_editor):
+    """
+    The column is added without its index and foreign key constraint. On postgres the index is then built
+    concurrently and the constraint is validated after it is added, so that writes to the email table are not
+    blocked while either scans the table. An invalid index left behind by an earlier build that failed is dropped
+    first. Other databases alter the column to add both.
+    """
+    email_model = apps.get_model('entity_emailer', 'Email')
+    if schema_editor.connection.vendor != 'postgresql':
+        schema_editor.alter_field(
+            email_model,
+            email_model._meta.get_field('exception_fingerprint'),
+            get_exception_fingerprint_field(apps, email_model),
+        )
+        return
+
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT 1 FROM pg_index JOIN pg_class ON pg_class.oid = pg_index.indexrelid '
+            'WHERE pg_class.relname = %s AND NOT pg_index.indisvalid',
+            [INDEX.name]
+        )
+        if cursor.fetchone():
+            schema_editor.execute(INDEX.remove_sql(email_model, schema_editor, concurrently=True))
+    schema_editor.execute(INDEX.create_sql(email_model, schema_editor, concurrently=True))
+
+    fingerprint_model = apps.get_model('entity_emailer', 'ExceptionFingerprint')
+    table = schema_editor.quote_name(email_model._meta.db_table)
+    schema_editor.execute(
+        'ALTER TABLE {0} ADD CONSTRAINT {1} FOREIGN KEY ({2}) REFERENCES {3} ({4}) '
+        'DEFERRABLE INITIALLY DEFERRED NOT VALID'.format(
+            table,
+            schema_editor.quote_name(CONSTRAINT_NAME),
+            schema_editor.quote_name('exception_fingerprint_id'),
+            schema_editor.quote_name(fingerprint_model._meta.db_table),
+            schema_editor.quote_name(fingerprint_model._meta.pk.column),
+        )
+    )
+    schema_editor.execute(
+        'ALTER TABLE {0} VALIDATE CONSTRAINT {1}'.format(table, schema_editor.quote_name(CONSTRAINT_NAME))
+    )
+
+
+def remove_exception_fingerprint_index(apps, schema_editor):
+    """
+    Removing the column on postgres also removes its index and constraint. Other databases alter the column back
+    first, since some can not drop a constraint on its own.
+    """
+    email_model = apps.get_model('entity_emailer', 'Email')
+    if schema_editor.connection.vendor != 'postgresql':
+        schema_editor.alter_field(
+            email_model,
+            get_exception_fingerprint_field(apps, email_model),
+            email_model._meta.get_field('exception_fingerprint'),
+        )
+
+
+class Migration(migrations.Migration):
+    # Building an index concurrently can not happen inside of a transaction
+    atomic = False
+
+    dependencies = [
+        ('entity_emailer', '0009_rendered_body'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExceptionFingerprint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('fingerprint', models.CharField(max_length=64, unique=True)),
+                ('exception_type', models.CharField(max_length=256)),
+                ('message', models.TextField()),
+                ('count', models.IntegerField(default=0)),
+                ('first_seen', models.DateTimeField(default=datetime.datetime.utcnow)),
+                ('last_seen', models.DateTimeField(default=datetime.datetime.utcnow)),
+            ],
+        ),
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.AddField(
+                    model_name='email',
+                    name='exception_fingerprint',
+                    field=models.ForeignKey(
+                        db_constraint=False, db_index=False, default=None, null=True,
+                        on_delete=django.db.models.deletion.SET_NULL, to='entity_emailer.exceptionfingerprint'
+                    ),
+                ),
+                migrations.RunPython(add_exception_fingerprint_index, remove_exception_fingerprint_index),
+            ],
+            state_operations=[
+                migrations.AddField(
+                    model_name='email',
+                    name='exception_fingerprint',
+                    field=models.ForeignKey(
+                        default=None, null=True, on_delete=django.db.models.deletion.SET_NULL,
+                        to='entity_emailer.exceptionfingerprint'
+                    ),
+                ),
+            ],
+        ),
+    ]
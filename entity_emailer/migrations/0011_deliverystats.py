@@ -0,0 +1,29 @@
+# Generated by Django 4.2.30 on 2026-10-19 03:17
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('entity_event', '0001_0005_squashed'),
+        ('entity_emailer', '0010_exception_fingerprint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeliveryStats',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hour', models.DateTimeField()),
+                ('outcome', models.CharField(choices=[('sent', 'sent'), ('failed', 'failed')], max_length=16)),
+                ('count', models.IntegerField(default=0)),
+                ('source', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='entity_event.source')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='deliverystats',
+            constraint=models.UniqueConstraint(fields=('hour', 'source', 'outcome'), name='entity_emailer_delivery_stats_unique'),
+        ),
+    ]
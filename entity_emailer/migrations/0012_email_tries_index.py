@@ -0,0 +1,57 @@
+from django.db import migrations, models
+
+
+INDEX = models.Index(
+    condition=models.Q(('sent__isnull', True)),
+    fields=['num_tries', 'scheduled'],
+    name='entity_emailer_tries_idx',
+)
+
+
+def add_tries_index(apps, schema_editor):
+    """
+    On postgres the index is built concurrently so that writes to the email table are not blocked while it is
+    built. An invalid index left behind by an earlier build that failed is dropped first. Other databases use a
+    regular index.
+    """
+    email_model = apps.get_model('entity_emailer', 'Email')
+    if schema_editor.connection.vendor == 'postgresql':
+        with schema_editor.connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT 1 FROM pg_index JOIN pg_class ON pg_class.oid = pg_index.indexrelid '
+                'WHERE pg_class.relname = %s AND NOT pg_index.indisvalid',
+                [INDEX.name]
+            )
+            if cursor.fetchone():
+                schema_editor.execute(INDEX.remove_sql(email_model, schema_editor, concurrently=True))
+        schema_editor.execute(INDEX.create_sql(email_model, schema_editor, concurrently=True))
+    else:
+        schema_editor.add_index(email_model, INDEX)
+
+
+def remove_tries_index(apps, schema_editor):
+    email_model = apps.get_model('entity_emailer', 'Email')
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(INDEX.remove_sql(email_model, schema_editor, concurrently=True))
+    else:
+        schema_editor.remove_index(email_model, INDEX)
+
+
+class Migration(migrations.Migration):
+    # Building an index concurrently can not happen inside of a transaction
+    atomic = False
+
+    dependencies = [
+        ('entity_emailer', '0011_deliverystats'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunPython(add_tries_index, remove_tries_index),
+            ],
+            state_operations=[
+                migrations.AddIndex(model_name='email', index=INDEX),
+            ],
+        ),
+    ]
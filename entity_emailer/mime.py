@@ -0,0 +1,141 @@
+from email import generator
+from email.message import Message
+from email.utils import formatdate, make_msgid
+from io import BytesIO, StringIO
+
+from django.conf import settings
+from django.core import mail
+from django.core.mail.message import DNS_NAME, MIMEMixin, SafeMIMEMultipart, SafeMIMEText, \
+    forbid_multi_line_headers
+
+
+class SharedMIMEBody(object):
+    """
+    The MIME body of a message, encoded once and serialized at most once per output type and line separator so
+    that it can be reused by every message that has the same content.
+    """
+    def __init__(self, part):
+        self.part = part
+        self.serialized = {}
+        if part.is_multipart():
+            # The boundary is picked when the part is first serialized and it must be known before any message
+            # copies the headers of the part
+            self.as_bytes('\n')
+
+    def serialize(self, generator_class, buffer_class, linesep):
+        key = (generator_class, linesep)
+        if key not in self.serialized:
+            fp = buffer_class()
+            generator_class(fp, mangle_from_=False).flatten(self.part, linesep=linesep)
+            # Only keep what follows the headers of the part, since the headers are written by each message
+            separator = linesep * 2 if buffer_class is StringIO else (linesep * 2).encode('ascii')
+            self.serialized[key] = fp.getvalue().split(separator, 1)[1]
+        return self.serialized[key]
+
+    def as_string(self, linesep):
+        return self.serialize(generator.Generator, StringIO, linesep)
+
+    def as_bytes(self, linesep):
+        return self.serialize(generator.BytesGenerator, BytesIO, linesep)
+
+
+class SharedBodyMIMEMessage(MIMEMixin, Message):
+    """
+    A MIME message with its own headers and a body that is shared with other messages. Its payload is that of
+    the shared body.
+    """
+    def __init__(self, body, encoding):
+        Message.__init__(self)
+        self.body = body
+        self.encoding = encoding
+        for name, value in body.part.raw_items():
+            Message.__setitem__(self, name, value)
+
+    def __setitem__(self, name, val):
+        name, val = forbid_multi_line_headers(name, val, self.encoding)
+        Message.__setitem__(self, name, val)
+
+    def get_payload(self, *args, **kwargs):
+        return self.body.part.get_payload(*args, **kwargs)
+
+    def is_multipart(self):
+        return self.body.part.is_multipart()
+
+    def as_string(self, unixfrom=False, linesep='\n'):
+        policy = self.policy.clone(linesep=linesep)
+        headers = ''.join(policy.fold(name, value) for name, value in self.raw_items())
+        return headers + linesep + self.body.as_string(linesep)
+
+    def as_bytes(self, unixfrom=False, linesep='\n'):
+        policy = self.policy.clone(linesep=linesep)
+        headers = b''.join(policy.fold_binary(name, value) for name, value in self.raw_items())
+        return headers + linesep.encode('ascii') + self.body.as_bytes(linesep)
+
+
+class SharedBodyMIMEBuilder(object):
+    """
+    Builds the MIME bodies of a batch of messages. Each distinct body is encoded and serialized only once, and
+    every message with the same content reuses it, so that only the headers are built for each copy.
+    """
+    def __init__(self):
+        self.bodies = {}
+
+    def get_body(self, email_message, encoding):
+        alternatives = tuple(getattr(email_message, 'alternatives', ()))
+        key = (email_message.body, email_message.content_subtype, encoding, alternatives)
+        if key not in self.bodies:
+            self.bodies[key] = SharedMIMEBody(self.create_part(email_message, encoding, alternatives))
+        return self.bodies[key]
+
+    def create_part(self, email_message, encoding, alternatives):
+        """
+        Create the body part in the same way that django does for a message without attachments
+        """
+        part = SafeMIMEText(email_message.body, email_message.content_subtype, encoding)
+        if alternatives:
+            body_part = part
+            part = SafeMIMEMultipart(_subtype=email_message.alternative_subtype, encoding=encoding)
+            if email_message.body:
+                part.attach(body_part)
+            for content, mimetype in alternatives:
+                part.attach(email_message._create_mime_attachment(content, mimetype))
+        return part
+
+
+class SharedBodyMessageMixin(object):
+    """
+    Mixin for email messages that build their MIME message with a SharedBodyMIMEBuilder when one is set as
+    ``mime_builder``. Messages with attachments are always built by django.
+    """
+    mime_builder = None
+
+    def message(self):
+        if self.mime_builder is None or self.attachments:
+            return super(SharedBodyMessageMixin, self).message()
+
+        encoding = self.encoding or settings.DEFAULT_CHARSET
+        msg = SharedBodyMIMEMessage(self.mime_builder.get_body(self, encoding), encoding)
+        msg['Subject'] = self.subject
+        msg['From'] = self.extra_headers.get('From', self.from_email)
+        self._set_list_header_if_not_empty(msg, 'To', self.to)
+        self._set_list_header_if_not_empty(msg, 'Cc', self.cc)
+        self._set_list_header_if_not_empty(msg, 'Reply-To', self.reply_to)
+
+        # Email header names are case-insensitive
+        header_names = [key.lower() for key in self.extra_headers]
+        if 'date' not in header_names:
+            msg['Date'] = formatdate(localtime=settings.EMAIL_USE_LOCALTIME)
+        if 'message-id' not in header_names:
+            msg['Message-ID'] = make_msgid(domain=DNS_NAME)
+        for name, value in self.extra_headers.items():
+            if name.lower() != 'from':
+                msg[name] = value
+        return msg
+
+
+class EmailMessage(SharedBodyMessageMixin, mail.EmailMessage):
+    pass
+
+
+class EmailMultiAlternatives(SharedBodyMessageMixin, mail.EmailMultiAlternatives):
+    pass
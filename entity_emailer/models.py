@@ -1,10 +1,17 @@
+from collections import Counter
 from datetime import datetime
+import hashlib
+import re
 
 from django.db import models, transaction
+from django.db.models import F
 from entity.models import Entity
-from entity_event.models import Event
+from entity_event.models import Event, Source
 import uuid
 
+from entity_emailer.utils import get_email_addresses, get_queue_events, get_snapshot_addresses, \
+    notify_emails_created
+
 
 class EmailManager(models.Manager):
     """
@@ -18,12 +25,13 @@ class EmailManager(models.Manager):
         picked up by a task that sends it.
         """
         scheduled = kwargs.pop('scheduled', datetime.utcnow())
-        email = Email.objects.create(scheduled=None, **kwargs)
+        email = Email.objects.create(scheduled=None, **self.snapshot_addresses(recipients or [], kwargs))
         if recipients:
             email.recipients.add(*recipients)
 
         email.scheduled = scheduled
         email.save()
+        notify_emails_created(using=self.db)
         return email
 
     @transaction.atomic
@@ -39,7 +47,7 @@ class EmailManager(models.Manager):
         for kwargs in email_params_list:
             scheduled = kwargs.pop('scheduled', datetime.utcnow())
             recipients = kwargs.pop('recipients', [])
-            emails_to_create.append(Email(scheduled=scheduled, **kwargs))
+            emails_to_create.append(Email(scheduled=scheduled, **self.snapshot_addresses(recipients, kwargs)))
             recipient_entities_per_email.append(recipients)
 
         # Bulk create the emails
@@ -65,8 +73,125 @@ class EmailManager(models.Manager):
         # Bulk create the recipient relationships
         Email.recipients.through.objects.bulk_create(recipients_to_create)
 
+        if emails:
+            notify_emails_created(using=self.db)
+
         return emails
 
+    def snapshot_addresses(self, recipients, kwargs):
+        """
+        When ENTITY_EMAILER_SNAPSHOT_ADDRESSES is set, add the email addresses of the recipients to the kwargs of
+        an email so that they do not have to be resolved when it is sent. An email without any addresses is
+        marked as sent right away.
+        """
+        if get_snapshot_addresses() and 'to_addresses' not in kwargs:
+            kwargs['to_addresses'] = get_email_addresses(recipients)
+            if not kwargs['to_addresses']:
+                kwargs.setdefault('sent', datetime.utcnow())
+        return kwargs
+
+
+class RenderedBodyManager(models.Manager):
+    """
+    Stores rendered bodies by the hash of their content.
+    """
+    def store_bodies(self, bodies):
+        """
+        Store every (text, html) body that is not stored yet and return the id of the stored copy of each body in
+        the same order. Bodies that are identical are only stored once.
+        """
+        hashes = [RenderedBody.get_hash(text, html) for text, html in bodies]
+        self.bulk_create(
+            [RenderedBody(hash=body_hash, text=text, html=html) for body_hash, (text, html) in zip(hashes, bodies)],
+            ignore_conflicts=True,
+        )
+        ids = dict(self.filter(hash__in=set(hashes)).values_list('hash', 'id'))
+        return [ids[body_hash] for body_hash in hashes]
+
+    def delete_unused(self):
+        """
+        Delete the bodies that no email uses anymore
+        """
+        return self.filter(email__isnull=True).delete()
+
+
+class RenderedBody(models.Model):
+    """
+    The rendered text and html of an email, stored once for every distinct body and keyed by the sha256 hash of
+    its content. Only used when ENTITY_EMAILER_PRERENDER is set.
+    """
+    hash = models.CharField(max_length=64, unique=True)
+    text = models.TextField()
+    html = models.TextField()
+
+    objects = RenderedBodyManager()
+
+    @staticmethod
+    def get_hash(text, html):
+        # The text and html are separated by a character that can not be part of either
+        return hashlib.sha256('{0}\0{1}'.format(text, html).encode('utf-8')).hexdigest()
+
+
+class ExceptionFingerprintManager(models.Manager):
+    """
+    Records exceptions by their fingerprint.
+    """
+    def record(self, exceptions):
+        """
+        Record every (exception type, message) occurrence and return the id of the fingerprint of each one in the
+        same order. The first message seen for a fingerprint is the one that is stored, and the count and last
+        seen time of each fingerprint are updated.
+        """
+        current_time = datetime.utcnow()
+        fingerprints = [ExceptionFingerprint.get_fingerprint(*exception) for exception in exceptions]
+
+        new_fingerprints = {}
+        for fingerprint, (exception_type, message) in zip(fingerprints, exceptions):
+            new_fingerprints.setdefault(fingerprint, ExceptionFingerprint(
+                fingerprint=fingerprint,
+                exception_type=exception_type,
+                message=message,
+                count=0,
+                first_seen=current_time,
+                last_seen=current_time,
+            ))
+        self.bulk_create(list(new_fingerprints.values()), ignore_conflicts=True)
+
+        for fingerprint, count in Counter(fingerprints).items():
+            self.filter(fingerprint=fingerprint).update(count=F('count') + count, last_seen=current_time)
+
+        ids = dict(self.filter(fingerprint__in=new_fingerprints).values_list('fingerprint', 'id'))
+        return [ids[fingerprint] for fingerprint in fingerprints]
+
+
+class ExceptionFingerprint(models.Model):
+    """
+    An exception that emails failed with, stored once for all of the emails that failed the same way. The
+    fingerprint is the sha256 hash of the exception type and its message with the parts that differ between
+    occurrences, such as numbers and email addresses, masked. Only used when ENTITY_EMAILER_DEDUPLICATE_EXCEPTIONS
+    is set.
+    """
+    fingerprint = models.CharField(max_length=64, unique=True)
+    exception_type = models.CharField(max_length=256)
+
+    # The message of the first occurrence of the exception
+    message = models.TextField()
+
+    # The number of times that emails failed with the exception and when they first and last did
+    count = models.IntegerField(default=0)
+    first_seen = models.DateTimeField(default=datetime.utcnow)
+    last_seen = models.DateTimeField(default=datetime.utcnow)
+
+    objects = ExceptionFingerprintManager()
+
+    # The parts of messages that differ between occurrences of the same exception
+    variable_pattern = re.compile(r'\S+@\S+|0x[0-9a-fA-F]+|[0-9a-fA-F]{8}-[0-9a-fA-F-]{27}|\d+')
+
+    @classmethod
+    def get_fingerprint(cls, exception_type, message):
+        normalized_message = cls.variable_pattern.sub('#', message)
+        return hashlib.sha256('{0}\0{1}'.format(exception_type, normalized_message).encode('utf-8')).hexdigest()
+
 
 class Email(models.Model):
     """Save an Email object and it is sent automagically!
@@ -90,7 +215,7 @@ class Email(models.Model):
 
     Emails are viewable online and identified with their view_uid UUID
     """
-    view_uid = models.UUIDField(default=uuid.uuid4, editable=False)
+    view_uid = models.UUIDField(default=uuid.uuid4, editable=False, unique=True)
     event = models.ForeignKey(Event, on_delete=models.CASCADE)
     recipients = models.ManyToManyField(Entity)
     subject = models.CharField(max_length=256)
@@ -111,11 +236,148 @@ class Email(models.Model):
     # Any exception that occurred when attempting to send the email last
     exception = models.TextField(default=None, null=True)
 
+    # The fingerprint of the exception that occurred when attempting to send the email last, which is saved instead
+    # of the exception itself when ENTITY_EMAILER_DEDUPLICATE_EXCEPTIONS is set
+    exception_fingerprint = models.ForeignKey(
+        ExceptionFingerprint, null=True, default=None, on_delete=models.SET_NULL
+    )
+
+    # The addresses that the email was already delivered to when only some of its messages could be sent.
+    # These are skipped when the email is retried.
+    delivered_addresses = models.JSONField(default=list)
+
+    # The time that a sender claimed the email to send it, or None if no sender is sending it. Only used when
+    # ENTITY_EMAILER_CLAIM_TIMEOUT is set. A claim that is older than the timeout belongs to a sender that crashed.
+    claimed = models.DateTimeField(null=True, default=None)
+
+    # The token of the attempt to send the email, written by a sender that claimed the email right before the email
+    # is handed to the backend and cleared once the result is saved. A claimed email whose claim expired while it
+    # still has an attempt may have been delivered and is reconciled before it is sent again.
+    attempt = models.UUIDField(null=True, default=None)
+
+    # The email addresses of the recipients as they were resolved when the email was created, or None if they are
+    # resolved when the email is sent. Only saved when ENTITY_EMAILER_SNAPSHOT_ADDRESSES is set.
+    to_addresses = models.JSONField(null=True, default=None)
+
+    # The body of the email when it was rendered ahead of sending, or None if it is rendered when it is sent. Only
+    # saved when ENTITY_EMAILER_PRERENDER is set.
+    rendered_body = models.ForeignKey(RenderedBody, null=True, default=None, on_delete=models.SET_NULL)
+
     objects = EmailManager()
 
+    class Meta:
+        indexes = [
+            # Finds unsent emails in the order they are due without scanning sent history
+            models.Index(
+                fields=['scheduled', 'id'],
+                name='entity_emailer_unsent_idx',
+                condition=models.Q(sent__isnull=True),
+            ),
+            # Counts unsent emails by their number of tries for queue health checks
+            models.Index(
+                fields=['num_tries', 'scheduled'],
+                name='entity_emailer_tries_idx',
+                condition=models.Q(sent__isnull=True),
+            ),
+        ]
+
+    def get_exception(self):
+        """
+        Returns the exception that occurred when attempting to send the email last. When only its fingerprint was
+        saved, this is the message of the first occurrence of the fingerprint.
+        """
+        if self.exception is None and self.exception_fingerprint_id is not None:
+            return self.exception_fingerprint.message
+        return self.exception
+
     def render(self, medium):
         """
-        Renders the event, assuming it has already had its context and renderers prefetched.
+        Renders the event, assuming it has already had its context and renderers prefetched. An email that was
+        rendered ahead of sending returns its stored body instead.
         """
         self.event.context['entity_emailer_id'] = str(self.view_uid)
+        if self.rendered_body_id is not None:
+            return self.rendered_body.text, self.rendered_body.html
         return self.event.render(medium)
+
+
+class DeliveryStatsManager(models.Manager):
+    """
+    Maintains the rollup of delivery counts.
+    """
+    def increment(self, hour, counts):
+        """
+        Add counts, a dict of counts keyed by (source id, outcome), to the stats of the hour
+        """
+        self.bulk_create(
+            [
+                DeliveryStats(hour=hour, source_id=source_id, outcome=outcome, count=0)
+                for source_id, outcome in counts
+            ],
+            ignore_conflicts=True,
+        )
+        for (source_id, outcome), count in counts.items():
+            self.filter(hour=hour, source_id=source_id, outcome=outcome).update(count=F('count') + count)
+
+
+class DeliveryStats(models.Model):
+    """
+    The number of emails of a source that were sent, or that failed to send, within an hour. When
+    ENTITY_EMAILER_DELIVERY_STATS is set, the counts are incremented as batches are sent, so that delivery
+    statistics can be read without counting emails.
+    """
+    SENT = 'sent'
+    FAILED = 'failed'
+    OUTCOMES = (SENT, FAILED)
+
+    # The utc start of the hour
+    hour = models.DateTimeField()
+    source = models.ForeignKey(Source, on_delete=models.CASCADE)
+    outcome = models.CharField(max_length=16, choices=[(outcome, outcome) for outcome in OUTCOMES])
+    count = models.IntegerField(default=0)
+
+    objects = DeliveryStatsManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['hour', 'source', 'outcome'], name='entity_emailer_delivery_stats_unique'),
+        ]
+
+    @staticmethod
+    def get_hour(time):
+        return time.replace(minute=0, second=0, microsecond=0)
+
+
+class PendingEventManager(models.Manager):
+    """
+    Queues events to be converted to emails.
+    """
+    def queue_events(self, events):
+        """
+        Queue the events, or event ids, so that EntityEmailerInterface.convert_pending_events converts them.
+        Events that are already queued are skipped.
+        """
+        self.bulk_create(
+            [PendingEvent(event_id=getattr(event, 'id', event)) for event in events],
+            ignore_conflicts=True,
+        )
+
+
+class PendingEvent(models.Model):
+    """
+    An event that was created but not yet converted to emails. When ENTITY_EMAILER_QUEUE_EVENTS is set, every
+    saved event is queued here so that the converter only has to look at new events instead of scanning for
+    unseen ones.
+    """
+    event = models.OneToOneField(Event, on_delete=models.CASCADE)
+
+    objects = PendingEventManager()
+
+
+def queue_created_event(sender, instance, created, **kwargs):
+    """
+    Queue events as they are created when ENTITY_EMAILER_QUEUE_EVENTS is set. The queued event is written in the
+    same transaction as the event so that it can not be lost.
+    """
+    if created and get_queue_events():
+        PendingEvent.objects.queue_events([instance])
@@ -0,0 +1,28 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+
+# The database that reads are routed to by ReadDatabaseRouter, or None to leave reads to the other routers
+read_database = ContextVar('entity_emailer_read_database', default=None)
+
+
+@contextmanager
+def read_from(database):
+    """
+    Route the reads made within the block to the database when ReadDatabaseRouter is installed
+    """
+    token = read_database.set(database)
+    try:
+        yield
+    finally:
+        read_database.reset(token)
+
+
+class ReadDatabaseRouter(object):
+    """
+    A database router that sends reads made within ``read_from`` to its database. Add it to ``DATABASE_ROUTERS``
+    so that queries which entity emailer does not make itself, such as the context loading of the email view, read
+    from the same database as the email. Every other query is left to the other routers.
+    """
+    def db_for_read(self, model, **hints):
+        return read_database.get()
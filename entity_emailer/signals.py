@@ -5,6 +5,20 @@ from django.dispatch import Signal
 pre_send = Signal()
 """providing_args=['email', 'event', 'context', 'message']"""
 
+# An event that will be fired once per batch prior to its emails being sent. The emails argument is a list
+# of (email, event, context, message) tuples so that receivers can do their work with bulk queries
+pre_send_batch = Signal()
+"""providing_args=['emails']"""
+
+# An event that will be fired after every batch of emails is sent, with the size the batch was read with, the
+# number of emails it had, the seconds spent querying, rendering and sending it and the size of the next batch
+batch_sent = Signal()
+"""providing_args=['batch_size', 'num_emails', 'query_seconds', 'render_seconds', 'send_seconds', 'next_batch_size']"""
+
 # An event that will be fired if an exception occurs when trying to send an email
 email_exception = Signal()
 """providing_args=['email', 'exception']"""
+
+# An event that will be fired by the routing email backend after each batch of messages sent through a route
+route_batch_sent = Signal()
+"""providing_args=['route', 'num_sent', 'num_failed', 'seconds']"""
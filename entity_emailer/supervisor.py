@@ -0,0 +1,204 @@
+import multiprocessing
+import queue
+import signal
+import time
+
+import django
+from django.apps import apps
+from django.db import connections
+
+from entity_emailer.daemon import EmailerDaemon
+
+
+class WorkerStats(object):
+    """
+    Counts the runs of a worker and the emails they processed
+    """
+    def __init__(self):
+        self.runs = 0
+        self.processed = 0
+        self.sent = 0
+        self.failed = 0
+        self.crashes = 0
+
+    def add(self, summary):
+        self.runs += 1
+        self.processed += summary['processed']
+        self.sent += summary['sent']
+        self.failed += summary['failed']
+
+    def combine(self, stats):
+        self.runs += stats.runs
+        self.processed += stats.processed
+        self.sent += stats.sent
+        self.failed += stats.failed
+        self.crashes += stats.crashes
+
+    def as_dict(self):
+        return {
+            'runs': self.runs,
+            'processed': self.processed,
+            'sent': self.sent,
+            'failed': self.failed,
+            'crashes': self.crashes,
+        }
+
+
+class WorkerDaemon(EmailerDaemon):
+    """
+    An emailer daemon that sends one shard of the due emails and reports the summary of every run to its supervisor
+    """
+    def __init__(self, index, num_workers, stats_queue, **kwargs):
+        super(WorkerDaemon, self).__init__(shard=(index, num_workers), **kwargs)
+        self.index = index
+        self.stats_queue = stats_queue
+
+    def run_once(self):
+        summary = super(WorkerDaemon, self).run_once()
+        self.stats_queue.put((self.index, summary))
+        return summary
+
+
+def run_worker(index, num_workers, daemon_options, stats_queue):
+    """
+    The entry point of a worker process
+    """
+    # Processes that are spawned rather than forked start without django being set up
+    if not apps.ready:
+        django.setup()
+
+    daemon = WorkerDaemon(index, num_workers, stats_queue, **daemon_options)
+    daemon.install_signal_handlers()
+    daemon.run()
+
+
+class EmailerSupervisor(object):
+    """
+    Sends scheduled emails from ``num_workers`` worker processes, so that rendering, which is cpu bound, is spread
+    over several cores.
+
+    Every worker runs an emailer daemon with the ``daemon_options`` that only sends the emails whose id modulo
+    ``num_workers`` is its index, so no two workers read the same emails. A worker that crashes is started again
+    after ``restart_delay`` seconds, and a worker that exits on its own, such as after ``max_runs`` runs, is not.
+    The supervisor returns once every worker has exited on its own or once it is stopped.
+
+    The summary of every run of a worker is sent to the supervisor, which combines them in ``get_stats``.
+
+    Stopping the supervisor (for example with SIGTERM) stops every worker gracefully and waits for their current
+    runs to finish.
+    """
+    # The longest time that is waited for stats at once, which bounds how long a crash or a stop goes unnoticed
+    poll_interval = 0.5
+
+    def __init__(self, num_workers, daemon_options=None, restart_delay=1.0, context=None):
+        self.num_workers = num_workers
+        self.daemon_options = daemon_options or {}
+        self.restart_delay = restart_delay
+        self.context = context or multiprocessing.get_context()
+        self.stats_queue = self.context.Queue()
+        self.workers = [None] * num_workers
+        self.restart_at = [0.0] * num_workers
+        self.finished = set()
+        self.stats = [WorkerStats() for i in range(num_workers)]
+        self.started = None
+        self.stopping = False
+
+    def stop(self, *args):
+        """
+        Request a graceful stop. Usable directly as a signal handler.
+        """
+        self.stopping = True
+
+    def install_signal_handlers(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+    def run(self):
+        """
+        Run the workers until stopped or until every worker has exited on its own and return the combined stats
+        """
+        self.started = time.monotonic()
+        try:
+            while not self.stopping and len(self.finished) < self.num_workers:
+                self.check_workers()
+                self.collect_stats(self.poll_interval)
+        finally:
+            self.stop_workers()
+        return self.get_stats()
+
+    def start_worker(self, index):
+        # Forked workers must not share the database connections of the supervisor
+        connections.close_all()
+        process = self.context.Process(
+            target=run_worker,
+            args=(index, self.num_workers, self.daemon_options, self.stats_queue),
+            name='entity_emailer_worker_{0}'.format(index),
+            daemon=True,
+        )
+        process.start()
+        return process
+
+    def check_workers(self):
+        """
+        Start the workers that are not running yet and the crashed workers that are due to be restarted
+        """
+        now = time.monotonic()
+        for index, process in enumerate(self.workers):
+            if index in self.finished:
+                continue
+
+            if process is None:
+                if now >= self.restart_at[index]:
+                    self.workers[index] = self.start_worker(index)
+            elif not process.is_alive():
+                process.join()
+                if process.exitcode == 0:
+                    self.finished.add(index)
+                else:
+                    self.stats[index].crashes += 1
+                    self.workers[index] = None
+                    self.restart_at[index] = now + self.restart_delay
+
+    def collect_stats(self, timeout):
+        """
+        Add the summaries that the workers send within ``timeout`` seconds to their stats
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                index, summary = self.stats_queue.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                return
+            self.stats[index].add(summary)
+
+    def stop_workers(self):
+        """
+        Stop the running workers gracefully and collect their last summaries while waiting for them to exit
+        """
+        running = [process for process in self.workers if process is not None and process.is_alive()]
+        for process in running:
+            process.terminate()
+        while any(process.is_alive() for process in running):
+            self.collect_stats(self.poll_interval)
+        for process in running:
+            process.join()
+        self.collect_stats(0)
+
+    def get_stats(self):
+        """
+        Returns the stats of each worker along with their total and the number of emails processed per second
+        since the supervisor started
+        """
+        total = WorkerStats()
+        for stats in self.stats:
+            total.combine(stats)
+        seconds = time.monotonic() - self.started if self.started is not None else 0.0
+
+        return {
+            'workers': [stats.as_dict() for stats in self.stats],
+            'total': dict(
+                total.as_dict(),
+                seconds=seconds,
+                emails_per_second=total.processed / seconds if seconds else 0.0,
+            ),
+        }
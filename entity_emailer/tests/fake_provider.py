@@ -0,0 +1,110 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+import time
+
+
+class FakeProviderHandler(BaseHTTPRequestHandler):
+    # Keep connections alive between requests like a real provider api
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, so avoid waiting on delayed acks between them
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super(FakeProviderHandler, self).setup()
+        self.server.provider.connection_opened()
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        status, response = self.server.provider.handle(self.headers, json.loads(body.decode('utf-8')))
+        data = json.dumps(response).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeProviderServer(object):
+    """
+    A local stand in for a provider bulk email api that speaks the protocol of the http email backend. It
+    records every request it receives, rejects any message addressed to one of ``rejected_recipients`` with a
+    per recipient error and waits ``latency`` seconds before answering to simulate a remote api.
+
+    Usable as a context manager that starts and stops the server.
+    """
+    def __init__(self, api_key='test-api-key', rejected_recipients=(), latency=0, status=200):
+        self.api_key = api_key
+        self.rejected_recipients = set(rejected_recipients)
+        self.latency = latency
+        self.status = status
+        self.requests = []
+        self.num_connections = 0
+        self.lock = threading.Lock()
+        self.server = None
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://{0}:{1}/v1/send'.format(*self.server.server_address)
+
+    @property
+    def num_messages(self):
+        return sum(len(request['messages']) for request in self.requests)
+
+    def start(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), FakeProviderHandler)
+        self.server.daemon_threads = True
+        self.server.provider = self
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def connection_opened(self):
+        with self.lock:
+            self.num_connections += 1
+
+    def handle(self, headers, payload):
+        """
+        Returns the status and response for a bulk send request
+        """
+        if self.latency:
+            time.sleep(self.latency)
+
+        if headers.get('Authorization') != 'Bearer {0}'.format(self.api_key):
+            return 401, {'error': 'Invalid api key'}
+
+        with self.lock:
+            self.requests.append(payload)
+
+        if self.status != 200:
+            return self.status, {'error': 'Provider unavailable'}
+
+        return 200, {'results': [self.get_result(message) for message in payload['messages']]}
+
+    def get_result(self, message):
+        rejected = [
+            recipient
+            for recipient in message['to'] + message['cc'] + message['bcc']
+            if recipient in self.rejected_recipients
+        ]
+        if rejected:
+            return {
+                'status': 'failed',
+                'errors': [{'recipient': recipient, 'reason': 'Mailbox unavailable'} for recipient in rejected],
+            }
+        return {'status': 'sent'}
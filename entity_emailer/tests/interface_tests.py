@@ -1,9 +1,11 @@
 from datetime import datetime
 import json
+import uuid
 
 from django.conf import settings
 from django.core import mail
 from django.core.mail import EmailMultiAlternatives
+from django.core.exceptions import ImproperlyConfigured
 from django.core.management import call_command
 from django.db import utils
 from django.test import TestCase, SimpleTestCase
@@ -14,13 +16,17 @@ from entity_event.models import (
     Medium, Source, Subscription, Unsubscription, Event, EventActor
 )
 from freezegun import freeze_time
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
 
+from entity_emailer.batching import batch_sizers
 from entity_emailer.interface import EntityEmailerInterface
-from entity_emailer.models import Email
+from entity_emailer.models import DeliveryStats, Email, ExceptionFingerprint, PendingEvent, RenderedBody
+from entity_emailer.signals import pre_send, pre_send_batch
+from entity_emailer.tests.fake_provider import FakeProviderServer
 from entity_emailer.tests.utils import g_email
 from entity_emailer.utils import extract_email_subject_from_html_content, create_email_message, \
-    get_subscribed_email_addresses, get_from_email_address
+    get_subscribed_email_addresses, get_from_email_address, get_recipient_mode, split_email_message, \
+    get_attempt_checker, get_medium, get_stale_attempt_policy
 
 
 class ExtractEmailSubjectFromHtmlContentTest(SimpleTestCase):
@@ -380,6 +386,261 @@ class ConvertEventsToEmailsTest(TestCase):
         self.assertEqual(email.scheduled, datetime(2013, 1, 2))
 
 
+@override_settings(ENTITY_EMAILER_QUEUE_EVENTS=True)
+class ConvertPendingEventsTest(TestCase):
+    def setUp(self):
+        call_command('add_email_medium')
+        self.email_medium = Medium.objects.get(name='email')
+        self.source = G(Source)
+        self.entity = G(Entity)
+        G(
+            Subscription, entity=self.entity, source=self.source, medium=self.email_medium, only_following=False,
+            sub_entity_kind=None
+        )
+        self.email_context = {
+            'entity_emailer_template': 'template',
+            'entity_emailer_subject': 'hi',
+        }
+
+    def test_queues_created_events(self):
+        event = G(Event, source=self.source, context=self.email_context)
+        event.save()
+
+        self.assertEqual(PendingEvent.objects.get().event, event)
+
+    @override_settings(ENTITY_EMAILER_QUEUE_EVENTS=False)
+    def test_queueing_off(self):
+        G(Event, source=self.source, context=self.email_context)
+
+        self.assertFalse(PendingEvent.objects.exists())
+
+    def test_queue_events(self):
+        event = G(Event, source=self.source, context=self.email_context)
+        other_event = G(Event, source=self.source, context=self.email_context)
+        PendingEvent.objects.all().delete()
+
+        PendingEvent.objects.queue_events([event, other_event.id, event])
+
+        self.assertEqual(set(PendingEvent.objects.values_list('event_id', flat=True)), {event.id, other_event.id})
+
+    def test_no_pending_events(self):
+        self.assertEqual(EntityEmailerInterface.convert_pending_events(), 0)
+
+    def test_converts_pending_events(self):
+        with freeze_time('2013-1-1'):
+            unqueued_event = G(Event, source=self.source, context=self.email_context)
+        PendingEvent.objects.all().delete()
+        with freeze_time('2013-1-2'):
+            event = G(Event, source=self.source, context=self.email_context)
+
+        self.assertEqual(EntityEmailerInterface.convert_pending_events(), 1)
+
+        # Only the queued event is converted and it is removed from the queue
+        email = Email.objects.get()
+        self.assertEqual(email.event, event)
+        self.assertEqual(list(email.recipients.all()), [self.entity])
+        self.assertFalse(PendingEvent.objects.exists())
+        self.assertEqual(Event.objects.filter(eventseen__medium=self.email_medium).get(), event)
+
+        # The scan still converts events that were not queued
+        EntityEmailerInterface.bulk_convert_events_to_emails()
+        self.assertEqual(Email.objects.get(event=unqueued_event).from_address, 'test@example.com')
+
+    def test_converts_only_queued_events_in_window(self):
+        with freeze_time('2013-1-1'):
+            first_event = G(Event, source=self.source, context=self.email_context)
+        with freeze_time('2013-1-2'):
+            other_event = G(Event, source=self.source, context=self.email_context)
+        with freeze_time('2013-1-3'):
+            last_event = G(Event, source=self.source, context=self.email_context)
+        # The event in the middle of the window is queued for another converter
+        PendingEvent.objects.filter(event=other_event).delete()
+
+        self.assertEqual(EntityEmailerInterface.convert_pending_events(), 2)
+
+        self.assertEqual(set(Email.objects.values_list('event_id', flat=True)), {first_event.id, last_event.id})
+        self.assertEqual(
+            set(Event.objects.filter(eventseen__medium=self.email_medium).values_list('id', flat=True)),
+            {first_event.id, last_event.id}
+        )
+
+    def test_seen_queued_events_not_converted_again(self):
+        event = G(Event, source=self.source, context=self.email_context)
+        Event.objects.filter(id=event.id).mark_seen(self.email_medium)
+
+        self.assertEqual(EntityEmailerInterface.convert_pending_events(), 1)
+
+        self.assertFalse(Email.objects.exists())
+        self.assertFalse(PendingEvent.objects.exists())
+
+    def test_batches(self):
+        for day in range(1, 4):
+            with freeze_time(datetime(2013, 1, day)):
+                G(Event, source=self.source, context=self.email_context)
+
+        with patch.object(Medium, 'events_targets', autospec=True, side_effect=Medium.events_targets) as targets_mock:
+            self.assertEqual(EntityEmailerInterface.convert_pending_events(batch_size=2), 3)
+
+        # Each batch only looks at the window of its own events
+        self.assertEqual(
+            [(call[1]['start_time'], call[1]['end_time']) for call in targets_mock.call_args_list],
+            [(datetime(2013, 1, 1), datetime(2013, 1, 2)), (datetime(2013, 1, 3), datetime(2013, 1, 3))],
+        )
+        self.assertEqual(Email.objects.count(), 3)
+        self.assertFalse(PendingEvent.objects.exists())
+
+
+@override_settings(ENTITY_EMAILER_PRERENDER=True)
+@patch.object(Event, 'render', spec_set=True, return_value=('text', '<p>html</p>'))
+class PrerenderEmailsTest(TestCase):
+    def setUp(self):
+        call_command('add_email_medium')
+        self.email_medium = Medium.objects.get(name='email')
+        self.source = G(Source)
+        G(
+            Subscription, entity=G(Entity), source=self.source, medium=self.email_medium, only_following=False,
+            sub_entity_kind=None
+        )
+
+    def test_identical_bodies_stored_once(self, render_mock):
+        emails = [g_email(context={}), g_email(context={})]
+
+        self.assertEqual(EntityEmailerInterface.prerender_emails(emails), 2)
+
+        body = RenderedBody.objects.get()
+        self.assertEqual((body.text, body.html), ('text', '<p>html</p>'))
+        self.assertEqual(body.hash, RenderedBody.get_hash('text', '<p>html</p>'))
+        self.assertEqual([email.rendered_body_id for email in Email.objects.order_by('id')], [body.id, body.id])
+
+    def test_failed_render_left_for_sending(self, render_mock):
+        render_mock.side_effect = [Exception('error'), ('text', '<p>html</p>')]
+        failed_email = g_email(context={})
+        email = g_email(context={})
+
+        self.assertEqual(EntityEmailerInterface.prerender_emails([failed_email, email], self.email_medium), 1)
+
+        failed_email.refresh_from_db()
+        self.assertIsNone(failed_email.rendered_body)
+        self.assertIsNone(failed_email.exception)
+        email.refresh_from_db()
+        self.assertIsNotNone(email.rendered_body)
+
+    def test_skips_sent_and_rendered_emails(self, render_mock):
+        rendered_email = g_email(context={})
+        EntityEmailerInterface.prerender_emails([rendered_email])
+
+        self.assertEqual(
+            EntityEmailerInterface.prerender_emails([rendered_email, g_email(context={}, sent=datetime(2014, 1, 5))]),
+            0,
+        )
+        self.assertEqual(render_mock.call_count, 1)
+
+    def test_prerender_unsent_emails(self, render_mock):
+        emails = [g_email(context={}), g_email(context={}), g_email(context={}, num_tries=3)]
+
+        self.assertEqual(EntityEmailerInterface.prerender_unsent_emails(batch_size=1), 2)
+
+        self.assertEqual(
+            [email.rendered_body_id is not None for email in Email.objects.filter(id__in=[e.id for e in emails])],
+            [True, True, False],
+        )
+        g_email(context={})
+        self.assertEqual(EntityEmailerInterface.prerender_unsent_emails(), 1)
+
+    def test_convert_events_to_emails(self, render_mock):
+        G(Event, source=self.source, context={})
+
+        EntityEmailerInterface.convert_events_to_emails()
+
+        self.assertEqual(Email.objects.get().rendered_body, RenderedBody.objects.get())
+
+    def test_bulk_convert_events_to_emails(self, render_mock):
+        G(Event, source=self.source, context={})
+        G(Event, source=self.source, context={})
+
+        EntityEmailerInterface.bulk_convert_events_to_emails()
+
+        self.assertEqual(Email.objects.filter(rendered_body=RenderedBody.objects.get()).count(), 2)
+
+    @override_settings(ENTITY_EMAILER_QUEUE_EVENTS=True)
+    def test_convert_pending_events(self, render_mock):
+        G(Event, source=self.source, context={})
+
+        EntityEmailerInterface.convert_pending_events()
+
+        self.assertEqual(Email.objects.get().rendered_body, RenderedBody.objects.get())
+
+    @override_settings(ENTITY_EMAILER_PRERENDER=False)
+    def test_prerender_off(self, render_mock):
+        G(Event, source=self.source, context={})
+
+        EntityEmailerInterface.bulk_convert_events_to_emails()
+
+        self.assertIsNone(Email.objects.get().rendered_body)
+        render_mock.assert_not_called()
+
+    @freeze_time('2014-01-05')
+    @override_settings(DISABLE_DURABILITY_CHECKING=True)
+    def test_sends_stored_body(self, render_mock):
+        email = g_email(context={}, scheduled=datetime.min)
+        email.recipients.add(G(Entity, entity_meta={'email': 'test@example.com'}))
+        EntityEmailerInterface.prerender_emails([email])
+        render_mock.reset_mock()
+
+        with patch('entity_emailer.interface.context_loader.load_contexts_and_renderers') as load_mock:
+            EntityEmailerInterface.send_unsent_scheduled_emails()
+
+        render_mock.assert_not_called()
+        self.assertEqual(load_mock.call_args[0][0], [])
+        self.assertEqual(mail.outbox[0].body, 'text')
+        self.assertEqual(mail.outbox[0].alternatives, [('<p>html</p>', 'text/html')])
+        email.refresh_from_db()
+        self.assertEqual(email.sent, datetime(2014, 1, 5))
+
+    @freeze_time('2014-01-05')
+    @override_settings(DISABLE_DURABILITY_CHECKING=True)
+    def test_pre_send_receivers_get_loaded_context(self, render_mock):
+        event = G(Event, source=self.source, context={'name': 'Swansonbot'})
+        email = g_email(event=event, scheduled=datetime.min)
+        email.recipients.add(G(Entity, entity_meta={'email': 'test@example.com'}))
+        EntityEmailerInterface.prerender_emails([email])
+        render_mock.reset_mock()
+        contexts = []
+
+        def receiver(sender, emails, **kwargs):
+            contexts.extend(context.get('name') for email, event, context, message in emails)
+
+        pre_send_batch.connect(receiver)
+        self.addCleanup(pre_send_batch.disconnect, receiver)
+
+        EntityEmailerInterface.send_unsent_scheduled_emails()
+
+        render_mock.assert_not_called()
+        self.assertEqual(contexts, ['Swansonbot'])
+
+    @override_settings(ENTITY_EMAILER_FIRE_PRE_SEND=False)
+    def test_get_events_to_load(self, render_mock):
+        rendered_email = g_email(context={})
+        EntityEmailerInterface.prerender_emails([rendered_email])
+        email = g_email(context={})
+
+        def receiver(sender, **kwargs):
+            """
+            Never called, since no email is sent
+            """
+
+        pre_send.connect(receiver)
+        self.addCleanup(pre_send.disconnect, receiver)
+
+        # The per email signal is turned off, so nothing needs the context of the rendered email
+        self.assertEqual(EntityEmailerInterface.get_events_to_load([rendered_email, email]), [email.event])
+        with override_settings(ENTITY_EMAILER_FIRE_PRE_SEND=True):
+            self.assertEqual(
+                EntityEmailerInterface.get_events_to_load([rendered_email, email]),
+                [rendered_email.event, email.event],
+            )
+
+
 @freeze_time('2014-01-05')
 class SendUnsentScheduledEmailsTest(TestCase):
     def setUp(self):
@@ -422,6 +683,21 @@ class SendUnsentScheduledEmailsTest(TestCase):
 
             self.assertEqual(2, mock_connection.return_value.__enter__.return_value.send_messages.call_count)
 
+    @override_settings(DISABLE_DURABILITY_CHECKING=True, ENTITY_EMAILER_RESULTS_CHUNK_SIZE=2)
+    @patch('entity_emailer.interface.send_messages_with_results')
+    @patch('entity_emailer.interface.get_subscribed_email_addresses', return_value=['test1@example.com'])
+    @patch.object(Event, 'render', spec_set=True, return_value=('text', '<p>html</p>'))
+    def test_saves_results_of_every_chunk(self, render_mock, address_mock, send_mock):
+        emails = [g_email(context={}, scheduled=datetime.min) for i in range(3)]
+        send_mock.side_effect = [[None, None], Exception('sender stopped')]
+
+        with self.assertRaises(Exception):
+            EntityEmailerInterface.send_unsent_scheduled_emails()
+
+        # The emails of the chunk that was sent before the sender stopped are already marked as sent
+        self.assertEqual([len(call[0][1]) for call in send_mock.call_args_list], [2, 1])
+        self.assertEqual(list(Email.objects.filter(sent__isnull=False).order_by('id')), emails[:2])
+
     @override_settings(DISABLE_DURABILITY_CHECKING=True)
     @patch('entity_emailer.interface.pre_send')
     @patch('entity_emailer.interface.get_subscribed_email_addresses')
@@ -455,6 +731,70 @@ class SendUnsentScheduledEmailsTest(TestCase):
             })
             self.assertIsInstance(kwargs['message'], EmailMultiAlternatives)
 
+    @override_settings(DISABLE_DURABILITY_CHECKING=True, ENTITY_EMAILER_FIRE_PRE_SEND=False)
+    @patch('entity_emailer.interface.pre_send')
+    @patch('entity_emailer.interface.get_subscribed_email_addresses')
+    @patch.object(Event, 'render', spec_set=True)
+    def test_pre_send_signal_disabled(self, render_mock, address_mock, mock_pre_send):
+        render_mock.return_value = ['<p>This is a test html email.</p>', 'This is a test text email.']
+        address_mock.return_value = ['test1@example.com']
+        g_email(context={}, scheduled=datetime.min)
+
+        with patch(settings.EMAIL_BACKEND) as mock_connection:
+            EntityEmailerInterface.send_unsent_scheduled_emails()
+
+            self.assertEqual(1, mock_connection.return_value.__enter__.return_value.send_messages.call_count)
+
+        mock_pre_send.send.assert_not_called()
+
+    @override_settings(DISABLE_DURABILITY_CHECKING=True)
+    @patch('entity_emailer.interface.get_subscribed_email_addresses')
+    @patch.object(Event, 'render', spec_set=True)
+    def test_pre_send_batch_signal(self, render_mock, address_mock):
+        """
+        Test that the batch pre send signal fires once with every email that is about to be sent
+        """
+        render_mock.return_value = ['<p>This is a test html email.</p>', 'This is a test text email.']
+        address_mock.return_value = ['test1@example.com']
+        email_1 = g_email(context={'test': 1}, scheduled=datetime.min)
+        email_2 = g_email(context={'test': 2}, scheduled=datetime.min)
+        receiver = MagicMock()
+        pre_send_batch.connect(receiver)
+        self.addCleanup(pre_send_batch.disconnect, receiver)
+
+        EntityEmailerInterface.send_unsent_scheduled_emails()
+
+        self.assertEqual(receiver.call_count, 1)
+        emails = receiver.call_args[1]['emails']
+        self.assertEqual(receiver.call_args[1]['sender'], Email)
+        self.assertEqual([(email, event, context) for email, event, context, message in emails], [
+            (email_1, email_1.event, {'test': 1, 'entity_emailer_id': str(email_1.view_uid)}),
+            (email_2, email_2.event, {'test': 2, 'entity_emailer_id': str(email_2.view_uid)}),
+        ])
+        self.assertEqual([message for email, event, context, message in emails], mail.outbox)
+
+    @override_settings(DISABLE_DURABILITY_CHECKING=True)
+    @patch('entity_emailer.interface.get_subscribed_email_addresses')
+    @patch.object(Event, 'render', spec_set=True)
+    def test_pre_send_batch_signal_exception(self, render_mock, address_mock):
+        """
+        Test that an exception in a batch pre send receiver is saved on every email in the batch
+        """
+        render_mock.return_value = ['<p>This is a test html email.</p>', 'This is a test text email.']
+        address_mock.return_value = ['test1@example.com']
+        g_email(context={}, scheduled=datetime.min)
+        g_email(context={}, scheduled=datetime.min)
+        receiver = MagicMock(side_effect=Exception('batch failure'))
+        pre_send_batch.connect(receiver)
+        self.addCleanup(pre_send_batch.disconnect, receiver)
+
+        EntityEmailerInterface.send_unsent_scheduled_emails()
+
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(Email.objects.filter(sent__isnull=True, num_tries=1).count(), 2)
+        for email in Email.objects.all():
+            self.assertIn('Exception: batch failure', email.exception)
+
     @override_settings(DISABLE_DURABILITY_CHECKING=True)
     @patch('entity_emailer.interface.get_subscribed_email_addresses')
     @patch.object(Event, 'render', spec_set=True)
@@ -653,6 +993,671 @@ class SendUnsentScheduledEmailsTest(TestCase):
         )
 
 
+@freeze_time('2014-01-05')
+@override_settings(DISABLE_DURABILITY_CHECKING=True)
+@patch.object(Event, 'render', spec_set=True, return_value=('text', '<p>html</p>'))
+@patch('entity_emailer.interface.get_subscribed_email_addresses')
+class SendUnsentScheduledEmailsRecipientsTest(TestCase):
+    addresses = ['test1@example.com', 'test2@example.com', 'test3@example.com']
+
+    def setUp(self):
+        G(Medium, name='email')
+
+    def test_default_single_message(self, address_mock, render_mock):
+        address_mock.return_value = self.addresses
+        g_email(context={}, scheduled=datetime.min)
+
+        EntityEmailerInterface.send_unsent_scheduled_emails()
+
+        self.assertEqual([message.to for message in mail.outbox], [self.addresses])
+
+    @override_settings(ENTITY_EMAILER_MAX_RECIPIENTS_PER_MESSAGE=2)
+    def test_max_recipients_per_message(self, address_mock, render_mock):
+        address_mock.return_value = self.addresses
+        email = g_email(context={}, scheduled=datetime.min)
+
+        EntityEmailerInterface.send_unsent_scheduled_emails()
+
+        self.assertEqual([message.to for message in mail.outbox], [self.addresses[:2], self.addresses[2:]])
+        email.refresh_from_db()
+        self.assertEqual(email.sent, datetime(2014, 1, 5))
+
+    @override_settings(ENTITY_EMAILER_RECIPIENT_MODE='individual')
+    def test_individual_recipient_mode(self, address_mock, render_mock):
+        address_mock.return_value = self.addresses
+
+        g_email(context={}, scheduled=datetime.min)
+        EntityEmailerInterface.send_unsent_scheduled_emails()
+
+        self.assertEqual([message.to for message in mail.outbox], [[address] for address in self.addresses])
+
+    @override_settings(ENTITY_EMAILER_RECIPIENT_MODE='bcc', ENTITY_EMAILER_MAX_RECIPIENTS_PER_MESSAGE=2)
+    def test_bcc_recipient_mode(self, address_mock, render_mock):
+        address_mock.return_value = self.addresses
+
+        g_email(context={}, scheduled=datetime.min)
+        EntityEmailerInterface.send_unsent_scheduled_emails()
+
+        self.assertEqual([message.to for message in mail.outbox], [[], []])
+        self.assertEqual([message.bcc for message in mail.outbox], [self.addresses[:2], self.addresses[2:]])
+
+    @override_settings(ENTITY_EMAILER_RECIPIENT_MODE='individual')
+    def test_partial_success_and_retry(self, address_mock, render_mock):
+        address_mock.return_value = ['test1@example.com', 'fail@example.com']
+        email = g_email(context={}, scheduled=datetime.min)
+
+        with FakeProviderServer(rejected_recipients=['fail@example.com']) as provider:
+            with self.settings(
+                EMAIL_BACKEND='entity_emailer.backends.http.EmailBackend',
+                ENTITY_EMAILER_HTTP_BACKEND={'URL': provider.url, 'API_KEY': 'test-api-key'},
+            ):
+                EntityEmailerInterface.send_unsent_scheduled_emails()
+
+                # Only the failed address is retried
+                email.refresh_from_db()
+                self.assertIsNone(email.sent)
+                self.assertEqual(email.num_tries, 1)
+                self.assertEqual(email.delivered_addresses, ['test1@example.com'])
+
+                provider.rejected_recipients.clear()
+                EntityEmailerInterface.send_unsent_scheduled_emails()
+
+        self.assertEqual(
+            [[message['to'] for message in request['messages']] for request in provider.requests],
+            [[['test1@example.com'], ['fail@example.com']], [['fail@example.com']]],
+        )
+        email.refresh_from_db()
+        self.assertEqual(email.sent, datetime(2014, 1, 5))
+
+    def test_shared_body(self, address_mock, render_mock):
+        address_mock.return_value = self.addresses
+        g_email(context={}, scheduled=datetime.min)
+        g_email(context={}, scheduled=datetime.min)
+
+        with override_settings(ENTITY_EMAILER_RECIPIENT_MODE='individual'):
+            EntityEmailerInterface.send_unsent_scheduled_emails()
+
+        self.assertEqual(len(mail.outbox), 6)
+        mime_messages = [message.message() for message in mail.outbox]
+        self.assertEqual([mime_message['To'] for mime_message in mime_messages], self.addresses * 2)
+        self.assertEqual(len(set(mime_message.body for mime_message in mime_messages)), 1)
+
+    @patch('entity_emailer.interface.create_email_message')
+    def test_django_message(self, create_email_message_mock, address_mock, render_mock):
+        address_mock.return_value = self.addresses
+        create_email_message_mock.return_value = mail.EmailMessage(to=self.addresses)
+        g_email(context={}, scheduled=datetime.min)
+
+        EntityEmailerInterface.send_unsent_scheduled_emails()
+
+        self.assertEqual(mail.outbox, [create_email_message_mock.return_value])
+        self.assertFalse(hasattr(mail.outbox[0], 'mime_builder'))
+
+    def test_all_addresses_delivered(self, address_mock, render_mock):
+        address_mock.return_value = self.addresses
+        email = g_email(context={}, scheduled=datetime.min, delivered_addresses=self.addresses)
+
+        EntityEmailerInterface.send_unsent_scheduled_emails()
+
+        self.assertEqual(len(mail.outbox), 0)
+        email.refresh_from_db()
+        self.assertEqual(email.sent, datetime(2014, 1, 5))
+
+
+@freeze_time('2014-01-05')
+@override_settings(DISABLE_DURABILITY_CHECKING=True, ENTITY_EMAILER_CLAIM_TIMEOUT=600)
+@patch.object(Event, 'render', spec_set=True, return_value=('text', '<p>html</p>'))
+@patch('entity_emailer.interface.get_subscribed_email_addresses', return_value=['test1@example.com'])
+class SendUnsentScheduledEmailsClaimTest(TestCase):
+    def setUp(self):
+        G(Medium, name='email')
+        batch_sizers.clear()
+
+    def test_claimed_while_sending(self, address_mock, render_mock):
+        email = g_email(context={}, scheduled=datetime.min)
+
+        def assert_claimed(sender, emails, **kwargs):
+            self.assertEqual(Email.objects.get(id=email.id).claimed, datetime(2014, 1, 5))
+
+        receiver = MagicMock(side_effect=assert_claimed)
+        pre_send_batch.connect(receiver)
+        try:
+            EntityEmailerInterface.send_unsent_scheduled_emails()
+        finally:
+            pre_send_batch.disconnect(receiver)
+
+        receiver.assert_called_once()
+        email.refresh_from_db()
+        self.assertEqual(email.sent, datetime(2014, 1, 5))
+        self.assertIsNone(email.claimed)
+
+    @override_settings(ENTITY_EMAILER_RESULTS_CHUNK_SIZE=1)
+    def test_releases_every_chunk(self, address_mock, render_mock):
+        first = g_email(context={}, scheduled=datetime.min)
+        g_email(context={}, scheduled=datetime.min)
+        states = []
+
+        def send_messages(connection, messages):
+            states.append(list(Email.objects.order_by('id').values_list('sent', 'claimed')))
+            return [None] * len(messages)
+
+        with patch('entity_emailer.interface.send_messages_with_results', side_effect=send_messages):
+            EntityEmailerInterface.send_unsent_scheduled_emails()
+
+        # The first email is sent and released before the second one is handed to the backend
+        claimed = datetime(2014, 1, 5)
+        self.assertEqual(states, [
+            [(None, claimed), (None, claimed)],
+            [(datetime(2014, 1, 5), None), (None, claimed)],
+        ])
+        self.assertEqual(Email.objects.get(id=first.id).attempt, None)
+
+    def test_skips_emails_claimed_by_another_sender(self, address_mock, render_mock):
+        g_email(context={}, scheduled=datetime.min, claimed=datetime(2014, 1, 4, 23, 55))
+        expired = g_email(context={}, scheduled=datetime.min, claimed=datetime(2014, 1, 4, 23, 45))
+
+        summary = EntityEmailerInterface.send_unsent_scheduled_emails()
+
+        # Only the email whose claim expired is sent
+        self.assertEqual(summary['sent'], 1)
+        self.assertEqual(list(Email.objects.filter(sent__isnull=False)), [expired])
+
+    def test_releases_failed_emails(self, address_mock, render_mock):
+        render_mock.side_effect = Exception('render failed')
+        email = g_email(context={}, scheduled=datetime.min)
+
+        EntityEmailerInterface.send_unsent_scheduled_emails()
+
+        email.refresh_from_db()
+        self.assertEqual(email.num_tries, 1)
+        self.assertIsNone(email.claimed)
+        self.assertIsNone(email.sent)
+
+    @override_settings(ENTITY_EMAILER_SEND_BATCH_SIZE=2)
+    def test_claims_each_batch(self, address_mock, render_mock):
+        for i in range(3):
+            g_email(context={}, scheduled=datetime.min)
+
+        summary = EntityEmailerInterface.send_unsent_scheduled_emails()
+
+        self.assertEqual(summary['sent'], 3)
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertFalse(Email.objects.filter(claimed__isnull=False).exists())
+
+    @patch('entity_emailer.interface.time.monotonic')
+    def test_releases_emails_left_for_later(self, monotonic_mock, address_mock, render_mock):
+        # The budget runs out after the first email is rendered
+        monotonic_mock.side_effect = [0, 0, 0, 1, 5, 5, 5]
+        emails = [g_email(context={}, scheduled=datetime.min) for i in range(2)]
+
+        summary = EntityEmailerInterface.send_unsent_scheduled_emails(time_budget=3)
+
+        self.assertEqual(summary['remaining_due'], 1)
+        emails[1].refresh_from_db()
+        self.assertIsNone(emails[1].claimed)
+        self.assertIsNone(emails[1].sent)
+
+    @patch('entity_emailer.interface.send_messages_with_results')
+    def test_attempt_saved_before_sending(self, send_mock, address_mock, render_mock):
+        email = g_email(context={}, scheduled=datetime.min)
+
+        def assert_attempt(connection, messages):
+            self.assertIsNotNone(Email.objects.get(id=email.id).attempt)
+            return [None] * len(messages)
+
+        send_mock.side_effect = assert_attempt
+        EntityEmailerInterface.send_unsent_scheduled_emails()
+
+        send_mock.assert_called_once()
+        email.refresh_from_db()
+        self.assertIsNone(email.attempt)
+
+    def test_stale_attempt_not_claimed(self, address_mock, render_mock):
+        g_email(context={}, scheduled=datetime.min, claimed=datetime(2014, 1, 4), attempt=uuid.uuid4())
+
+        with patch.object(EntityEmailerInterface, 'reconcile_attempts') as reconcile_mock:
+            summary = EntityEmailerInterface.send_unsent_scheduled_emails()
+
+        reconcile_mock.assert_called_once_with(600)
+        self.assertEqual(summary['processed'], 0)
+
+    def test_stale_attempt_resent(self, address_mock, render_mock):
+        email = g_email(context={}, scheduled=datetime.min, claimed=datetime(2014, 1, 4), attempt=uuid.uuid4())
+
+        EntityEmailerInterface.send_unsent_scheduled_emails()
+
+        email.refresh_from_db()
+        self.assertEqual(email.sent, datetime(2014, 1, 5))
+        self.assertEqual(len(mail.outbox), 1)
+
+
+@freeze_time('2014-01-05')
+@override_settings(DISABLE_DURABILITY_CHECKING=True, ENTITY_EMAILER_SEND_BATCH_SIZE=1)
+@patch.object(Event, 'render', spec_set=True, return_value=('text', '<p>html</p>'))
+@patch('entity_emailer.interface.get_subscribed_email_addresses', return_value=['test1@example.com'])
+class SendUnsentScheduledEmailsShardTest(TestCase):
+    def setUp(self):
+        G(Medium, name='email')
+        batch_sizers.clear()
+        self.emails = [g_email(context={}, scheduled=datetime.min) for i in range(4)]
+
+    def test_sends_only_the_shard(self, address_mock, render_mock):
+        shard_ids = [email.id for email in self.emails if email.id % 2 == 1]
+
+        summary = EntityEmailerInterface.send_unsent_scheduled_emails(shard=(1, 2))
+
+        self.assertEqual(summary['sent'], 2)
+        self.assertEqual(sorted(Email.objects.filter(sent__isnull=False).values_list('id', flat=True)), shard_ids)
+
+    def test_shards_are_disjoint(self, address_mock, render_mock):
+        for index in range(3):
+            EntityEmailerInterface.send_unsent_scheduled_emails(shard=(index, 3))
+
+        self.assertEqual(len(mail.outbox), 4)
+        self.assertFalse(Email.objects.filter(sent__isnull=True).exists())
+
+    def test_remaining_due_counts_the_shard(self, address_mock, render_mock):
+        summary = EntityEmailerInterface.send_unsent_scheduled_emails(time_budget=0, shard=(0, 2))
+
+        self.assertEqual(summary['remaining_due'], 2)
+
+
+@freeze_time('2014-01-05')
+@override_settings(DISABLE_DURABILITY_CHECKING=True)
+@patch.object(Event, 'render', spec_set=True, return_value=('text', '<p>html</p>'))
+class SendUnsentScheduledEmailsSnapshotAddressesTest(TestCase):
+    def setUp(self):
+        G(Medium, name='email')
+        self.entity = G(Entity, entity_meta={'email': 'resolved@example.com'})
+
+    def test_uses_saved_addresses(self, render_mock):
+        email = g_email(context={}, scheduled=datetime.min, to_addresses=['saved@example.com'])
+        email.recipients.add(self.entity)
+
+        with patch('entity_emailer.interface.get_subscribed_email_addresses') as address_mock:
+            EntityEmailerInterface.send_unsent_scheduled_emails()
+
+        address_mock.assert_not_called()
+        self.assertEqual(mail.outbox[0].to, ['saved@example.com'])
+
+    def test_resolves_without_saved_addresses(self, render_mock):
+        email = g_email(context={}, scheduled=datetime.min)
+        email.recipients.add(self.entity)
+
+        EntityEmailerInterface.send_unsent_scheduled_emails()
+
+        self.assertEqual(mail.outbox[0].to, ['resolved@example.com'])
+
+    def test_saved_addresses_on_retry(self, render_mock):
+        email = g_email(context={}, scheduled=datetime.min, to_addresses=['saved@example.com'], num_tries=1)
+        email.recipients.add(self.entity)
+
+        EntityEmailerInterface.send_unsent_scheduled_emails()
+
+        self.assertEqual(mail.outbox[0].to, ['saved@example.com'])
+
+    @override_settings(ENTITY_EMAILER_RESOLVE_ADDRESSES_ON_RETRY=True)
+    def test_resolves_on_retry(self, render_mock):
+        email = g_email(context={}, scheduled=datetime.min, to_addresses=['saved@example.com'], num_tries=1)
+        email.recipients.add(self.entity)
+        g_email(context={}, scheduled=datetime.min, to_addresses=['first@example.com'])
+
+        EntityEmailerInterface.send_unsent_scheduled_emails()
+
+        self.assertEqual(
+            sorted(message.to for message in mail.outbox),
+            [['first@example.com'], ['resolved@example.com']],
+        )
+
+
+@freeze_time('2014-01-05')
+@override_settings(DISABLE_DURABILITY_CHECKING=True, ENTITY_EMAILER_DEDUPLICATE_EXCEPTIONS=True)
+@patch.object(Event, 'render', spec_set=True, return_value=('text', '<p>html</p>'))
+@patch('entity_emailer.interface.get_subscribed_email_addresses', return_value=['test1@example.com'])
+class SendUnsentScheduledEmailsDeduplicateExceptionsTest(TestCase):
+    def setUp(self):
+        G(Medium, name='email')
+        self.emails = [g_email(context={}, scheduled=datetime.min, exception='old') for i in range(3)]
+
+    @patch('entity_emailer.interface.email_exception')
+    @patch('entity_emailer.interface.send_messages_with_results')
+    def test_send_failures(self, send_mock, exception_signal_mock, address_mock, render_mock):
+        errors = [
+            Exception('Rejected user1@example.com (code 550)'),
+            Exception('Rejected user2@example.com (code 551)'),
+        ]
+        send_mock.return_value = errors + [None]
+
+        EntityEmailerInterface.send_unsent_scheduled_emails()
+
+        fingerprint = ExceptionFingerprint.objects.get()
+        self.assertEqual(fingerprint.exception_type, 'Exception')
+        self.assertEqual(fingerprint.message, 'Rejected user1@example.com (code 550)')
+        self.assertEqual(fingerprint.count, 2)
+        self.assertEqual(fingerprint.last_seen, datetime(2014, 1, 5))
+
+        failed_emails = list(Email.objects.filter(sent__isnull=True).order_by('id'))
+        self.assertEqual(failed_emails, self.emails[:2])
+        for email in failed_emails:
+            self.assertIsNone(email.exception)
+            self.assertEqual(email.exception_fingerprint, fingerprint)
+            self.assertEqual(email.num_tries, 1)
+            self.assertEqual(email.get_exception(), 'Rejected user1@example.com (code 550)')
+        self.assertEqual(
+            [call[1]['exception'] for call in exception_signal_mock.send.call_args_list],
+            errors,
+        )
+
+    def test_render_failures(self, address_mock, render_mock):
+        def render(medium):
+            raise Exception('test')
+        render_mock.side_effect = render
+
+        EntityEmailerInterface.send_unsent_scheduled_emails()
+
+        fingerprint = ExceptionFingerprint.objects.get()
+        self.assertEqual(fingerprint.exception_type, '')
+        self.assertIn('Exception: test', fingerprint.message)
+        self.assertEqual(fingerprint.count, 3)
+        self.assertEqual(Email.objects.filter(exception_fingerprint=fingerprint, num_tries=1).count(), 3)
+
+    def test_pre_send_batch_failure(self, address_mock, render_mock):
+        def fail(**kwargs):
+            raise Exception('batch failure')
+        pre_send_batch.connect(fail, dispatch_uid='test_dedupe_batch_failure')
+        self.addCleanup(pre_send_batch.disconnect, dispatch_uid='test_dedupe_batch_failure')
+
+        EntityEmailerInterface.send_unsent_scheduled_emails()
+        EntityEmailerInterface.send_unsent_scheduled_emails()
+
+        fingerprint = ExceptionFingerprint.objects.get()
+        self.assertEqual(fingerprint.count, 6)
+        self.assertEqual(Email.objects.filter(exception_fingerprint=fingerprint, num_tries=2).count(), 3)
+
+
+@freeze_time('2014-01-05 10:30')
+@override_settings(DISABLE_DURABILITY_CHECKING=True, ENTITY_EMAILER_DELIVERY_STATS=True)
+@patch.object(Event, 'render', spec_set=True, return_value=('text', '<p>html</p>'))
+@patch('entity_emailer.interface.get_subscribed_email_addresses', return_value=['test1@example.com'])
+class DeliveryStatsTest(TestCase):
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        G(Medium, name='email')
+        self.source = G(Source, name='source')
+        self.other_source = G(Source, name='other_source')
+
+    @patch('entity_emailer.interface.send_messages_with_results', return_value=[None, Exception('error'), None])
+    def test_recorded_when_sent(self, send_mock, address_mock, render_mock):
+        g_email(event=G(Event, source=self.source, context={}), scheduled=datetime.min)
+        g_email(event=G(Event, source=self.source, context={}), scheduled=datetime.min)
+        g_email(event=G(Event, source=self.other_source, context={}), scheduled=datetime.min)
+
+        EntityEmailerInterface.send_unsent_scheduled_emails()
+
+        self.assertEqual(EntityEmailerInterface.get_delivery_stats(), [
+            dict(hour=datetime(2014, 1, 5, 10), source='other_source', outcome='sent', count=1),
+            dict(hour=datetime(2014, 1, 5, 10), source='source', outcome='failed', count=1),
+            dict(hour=datetime(2014, 1, 5, 10), source='source', outcome='sent', count=1),
+        ])
+
+    @override_settings(ENTITY_EMAILER_DELIVERY_STATS=False)
+    def test_off(self, address_mock, render_mock):
+        g_email(context={}, scheduled=datetime.min)
+
+        EntityEmailerInterface.send_unsent_scheduled_emails()
+
+        self.assertFalse(DeliveryStats.objects.exists())
+
+    def test_get_delivery_stats_filters(self, address_mock, render_mock):
+        for hour in (9, 10, 11):
+            DeliveryStats.objects.increment(datetime(2014, 1, 5, hour), {
+                (self.source.id, 'sent'): hour,
+                (self.source.id, 'failed'): 1,
+                (self.other_source.id, 'sent'): 1,
+            })
+
+        self.assertEqual(
+            EntityEmailerInterface.get_delivery_stats(
+                start_time=datetime(2014, 1, 5, 10, 30),
+                end_time=datetime(2014, 1, 5, 11),
+                source_names=['source'],
+                outcome='sent',
+            ),
+            [dict(hour=datetime(2014, 1, 5, 10), source='source', outcome='sent', count=10)],
+        )
+
+    @override_settings(ENTITY_EMAILER_READ_DATABASE='replica')
+    def test_get_delivery_stats_read_database(self, address_mock, render_mock):
+        DeliveryStats.objects.increment(datetime(2014, 1, 5, 9), {(self.source.id, 'sent'): 1})
+
+        with self.assertNumQueries(1, using='replica'):
+            self.assertEqual(EntityEmailerInterface.get_delivery_stats(), [])
+
+    def test_backfill(self, address_mock, render_mock):
+        event = G(Event, source=self.source, context={})
+        g_email(event=event, sent=datetime(2014, 1, 4, 8, 10), num_tries=1, scheduled=datetime(2014, 1, 4, 7, 59))
+        g_email(event=event, sent=datetime(2014, 1, 4, 8, 50))
+        g_email(event=event, num_tries=2, scheduled=datetime(2014, 1, 4, 9))
+        g_email(event=event, sent=datetime(2014, 1, 5, 10, 10))
+        DeliveryStats.objects.increment(datetime(2014, 1, 4, 8), {(self.source.id, 'sent'): 100})
+        DeliveryStats.objects.increment(datetime(2014, 1, 5, 10), {(self.source.id, 'sent'): 100})
+
+        self.assertEqual(EntityEmailerInterface.backfill_delivery_stats(), 3)
+
+        # The stats of the current hour are left to the senders
+        self.assertEqual(EntityEmailerInterface.get_delivery_stats(), [
+            dict(hour=datetime(2014, 1, 4, 7), source='source', outcome='failed', count=1),
+            dict(hour=datetime(2014, 1, 4, 8), source='source', outcome='sent', count=2),
+            dict(hour=datetime(2014, 1, 4, 9), source='source', outcome='failed', count=2),
+            dict(hour=datetime(2014, 1, 5, 10), source='source', outcome='sent', count=100),
+        ])
+
+
+@freeze_time('2014-01-05')
+@override_settings(DISABLE_DURABILITY_CHECKING=True)
+class ReconcileAttemptsTest(TestCase):
+    def setUp(self):
+        self.attempt = uuid.uuid4()
+        self.stale = g_email(context={}, scheduled=datetime.min, claimed=datetime(2014, 1, 4), attempt=self.attempt)
+        self.claimed = g_email(context={}, scheduled=datetime.min, claimed=datetime(2014, 1, 5), attempt=self.attempt)
+        self.expired = g_email(context={}, scheduled=datetime.min, claimed=datetime(2014, 1, 4))
+
+    def assert_untouched(self):
+        self.claimed.refresh_from_db()
+        self.assertEqual(self.claimed.claimed, datetime(2014, 1, 5))
+        self.assertEqual(self.claimed.attempt, self.attempt)
+        self.expired.refresh_from_db()
+        self.assertEqual(self.expired.claimed, datetime(2014, 1, 4))
+
+    def test_none_stale(self):
+        Email.objects.filter(id=self.stale.id).delete()
+
+        self.assertEqual(EntityEmailerInterface.reconcile_attempts(600), 0)
+        self.assert_untouched()
+
+    def test_resend(self):
+        self.assertEqual(EntityEmailerInterface.reconcile_attempts(600), 1)
+
+        self.stale.refresh_from_db()
+        self.assertIsNone(self.stale.claimed)
+        self.assertIsNone(self.stale.attempt)
+        self.assertIsNone(self.stale.sent)
+        self.assert_untouched()
+
+    @override_settings(ENTITY_EMAILER_STALE_ATTEMPT_POLICY='uncertain')
+    def test_uncertain(self):
+        self.assertEqual(EntityEmailerInterface.reconcile_attempts(600), 1)
+
+        self.stale.refresh_from_db()
+        self.assertIsNone(self.stale.claimed)
+        self.assertEqual(self.stale.attempt, self.attempt)
+        self.assertIsNone(self.stale.sent)
+        self.assertEqual(self.stale.num_tries, settings.ENTITY_EMAILER_MAX_SEND_MESSAGE_TRIES)
+        self.assertIn('sender stopped', self.stale.exception)
+        self.assert_untouched()
+
+    def test_check(self):
+        undelivered = g_email(context={}, scheduled=datetime.min, claimed=datetime(2014, 1, 4), attempt=self.attempt)
+        checker = MagicMock(return_value=[self.stale.id])
+
+        with override_settings(ENTITY_EMAILER_ATTEMPT_CHECKER=checker):
+            num_reconciled = EntityEmailerInterface.reconcile_attempts(600, policy='check')
+
+        self.assertEqual(num_reconciled, 2)
+        self.assertEqual(set(checker.call_args[0][0]), {self.stale, undelivered})
+        self.stale.refresh_from_db()
+        self.assertEqual(self.stale.sent, datetime(2014, 1, 5))
+        self.assertIsNone(self.stale.attempt)
+        undelivered.refresh_from_db()
+        self.assertIsNone(undelivered.sent)
+        self.assertIsNone(undelivered.claimed)
+        self.assertIsNone(undelivered.attempt)
+        self.assert_untouched()
+
+
+class SplitEmailMessageTest(SimpleTestCase):
+    def setUp(self):
+        self.message = create_email_message(
+            ['to1@example.com', 'to2@example.com', 'to3@example.com'], 'from@example.com', 'Subject', 'Text',
+            '<html>A</html>'
+        )
+
+    def test_no_split(self):
+        self.assertEqual(
+            split_email_message(self.message),
+            [(self.message, ['to1@example.com', 'to2@example.com', 'to3@example.com'])]
+        )
+
+    def test_split_shares_body(self):
+        self.message.cc = ['cc@example.com']
+        self.message.extra_headers = {'X-Test': '1'}
+
+        messages = split_email_message(self.message, max_recipients=2)
+
+        self.assertEqual(
+            [addresses for message, addresses in messages],
+            [['to1@example.com', 'to2@example.com'], ['to3@example.com']]
+        )
+        self.assertEqual(
+            [message.to for message, addresses in messages],
+            [['to1@example.com', 'to2@example.com'], ['to3@example.com']]
+        )
+        self.assertEqual([message.cc for message, addresses in messages], [['cc@example.com'], []])
+        for message, addresses in messages:
+            self.assertIs(message.alternatives, self.message.alternatives)
+            self.assertEqual(message.extra_headers, {'X-Test': '1'})
+            self.assertIsNot(message.extra_headers, self.message.extra_headers)
+        # The original message is left untouched
+        self.assertEqual(self.message.to, ['to1@example.com', 'to2@example.com', 'to3@example.com'])
+
+    def test_bcc_without_limit(self):
+        messages = split_email_message(self.message, recipient_mode='bcc')
+
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(messages[0][0].to, [])
+        self.assertEqual(messages[0][0].bcc, ['to1@example.com', 'to2@example.com', 'to3@example.com'])
+
+    def test_no_recipients(self):
+        self.message.to = []
+        self.assertEqual(split_email_message(self.message, recipient_mode='individual'), [(self.message, [])])
+
+
+class GetRecipientModeTest(SimpleTestCase):
+    def test_default(self):
+        self.assertEqual(get_recipient_mode(), 'to')
+
+    @override_settings(ENTITY_EMAILER_RECIPIENT_MODE='cc')
+    def test_invalid(self):
+        with self.assertRaises(ImproperlyConfigured):
+            get_recipient_mode()
+
+
+class GetStaleAttemptPolicyTest(SimpleTestCase):
+    def test_default(self):
+        self.assertEqual(get_stale_attempt_policy(), 'resend')
+
+    @override_settings(ENTITY_EMAILER_STALE_ATTEMPT_POLICY='ignore')
+    def test_invalid(self):
+        with self.assertRaises(ImproperlyConfigured):
+            get_stale_attempt_policy()
+
+
+class GetAttemptCheckerTest(SimpleTestCase):
+    def test_not_set(self):
+        with self.assertRaises(ImproperlyConfigured):
+            get_attempt_checker()
+
+    @override_settings(ENTITY_EMAILER_ATTEMPT_CHECKER='entity_emailer.utils.get_medium')
+    def test_path(self):
+        self.assertEqual(get_attempt_checker(), get_medium)
+
+
+class NextDueTest(TestCase):
+    def test_no_emails(self):
+        self.assertIsNone(EntityEmailerInterface.next_due())
+
+    @override_settings(ENTITY_EMAILER_MAX_SEND_MESSAGE_TRIES=2)
+    def test_next_due(self):
+        g_email(context={}, scheduled=datetime(2014, 1, 1), sent=datetime(2014, 1, 1))
+        g_email(context={}, scheduled=datetime(2014, 1, 2), num_tries=2)
+        g_email(context={}, scheduled=None)
+        g_email(context={}, scheduled=datetime(2014, 1, 4))
+        g_email(context={}, scheduled=datetime(2014, 1, 3), num_tries=1)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(EntityEmailerInterface.next_due(), datetime(2014, 1, 3))
+
+        self.assertEqual(EntityEmailerInterface.next_due(after=datetime(2014, 1, 3)), datetime(2014, 1, 4))
+        self.assertIsNone(EntityEmailerInterface.next_due(after=datetime(2014, 1, 4)))
+
+
+@override_settings(ENTITY_EMAILER_MAX_SEND_MESSAGE_TRIES=2)
+class QueueHealthTest(TestCase):
+    databases = {'default', 'replica'}
+
+    def test_empty(self):
+        self.assertEqual(EntityEmailerInterface.queue_health(), {
+            'pending': 0,
+            'oldest_due_seconds': None,
+            'retrying': 0,
+            'failed': 0,
+            'approximate': [],
+        })
+
+    def test_queue_health(self):
+        g_email(context={}, scheduled=datetime(2014, 1, 1), sent=datetime(2014, 1, 1))
+        g_email(context={}, scheduled=datetime(2014, 1, 2), num_tries=2)
+        g_email(context={}, scheduled=datetime(2014, 1, 3), num_tries=1)
+        g_email(context={}, scheduled=datetime(2014, 1, 4, 12))
+        g_email(context={}, scheduled=datetime(2014, 1, 6))
+
+        with self.assertNumQueries(4):
+            health = EntityEmailerInterface.queue_health(current_time=datetime(2014, 1, 5))
+
+        self.assertEqual(health, {
+            'pending': 2,
+            'oldest_due_seconds': 2 * 24 * 60 * 60,
+            'retrying': 1,
+            'failed': 1,
+            'approximate': [],
+        })
+
+    @override_settings(ENTITY_EMAILER_READ_DATABASE='replica')
+    def test_read_database(self):
+        g_email(context={}, scheduled=datetime(2014, 1, 1))
+
+        with self.assertNumQueries(4, using='replica'):
+            self.assertEqual(EntityEmailerInterface.queue_health()['pending'], 0)
+
+    @patch('entity_emailer.interface.count_rows', return_value=(50000, True))
+    def test_approximate(self, count_mock):
+        health = EntityEmailerInterface.queue_health()
+
+        self.assertEqual(health['approximate'], ['pending', 'retrying', 'failed'])
+        self.assertEqual(count_mock.call_args[0][1], 10000)
+
+
 class CreateEmailObjectTest(TestCase):
     def test_no_html(self):
         email = create_email_message(
@@ -0,0 +1,776 @@
+from datetime import datetime
+import json
+import smtplib
+import socket
+
+from django.core import mail
+from django.core.exceptions import ImproperlyConfigured
+from django.core.mail.backends.base import BaseEmailBackend
+from django.test import TestCase, SimpleTestCase
+from django.test.utils import override_settings
+from django_dynamic_fixture import G
+from entity_event.models import Event, Medium, Source
+from freezegun import freeze_time
+from unittest.mock import MagicMock, patch
+
+from entity_emailer.backends.base import BatchResultsMixin, close_persistent_connection, get_persistent_connection, \
+    send_messages_with_results
+from entity_emailer.backends.http import EmailBackend as HTTPEmailBackend, HTTPProviderError
+from entity_emailer.backends.routing import EmailBackend as RoutingEmailBackend, NoRouteError, is_transport_error
+from entity_emailer.backends.smtp import EmailBackend as SMTPEmailBackend
+from entity_emailer.interface import EntityEmailerInterface
+from entity_emailer.models import Email
+from entity_emailer.signals import route_batch_sent
+from entity_emailer.tests.fake_provider import FakeProviderServer
+from entity_emailer.tests.utils import g_email
+
+
+class BatchBackend(BatchResultsMixin, BaseEmailBackend):
+    """
+    A batch backend that rejects any message sent to fail@example.com and can't hand over any message sent to
+    down@example.com
+    """
+    def __init__(self, *args, **kwargs):
+        super(BatchBackend, self).__init__(*args, **kwargs)
+        self.batches = []
+
+    def get_result(self, message):
+        if 'fail@example.com' in message.to:
+            return Exception('rejected')
+        if 'down@example.com' in message.to:
+            return ConnectionResetError('connection reset')
+        return None
+
+    def keepalive(self):
+        """
+        There is no connection to keep alive
+        """
+
+    def send_messages_with_results(self, email_messages):
+        self.batches.append(email_messages)
+        return [self.get_result(message) for message in email_messages]
+
+
+BATCH_BACKEND = 'entity_emailer.tests.test_backends.BatchBackend'
+UNAVAILABLE_BACKEND = 'entity_emailer.tests.test_backends.UnavailableBackend'
+LOCMEM_BACKEND = 'django.core.mail.backends.locmem.EmailBackend'
+DJANGO_SMTP_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
+ROUTING_BACKEND = 'entity_emailer.backends.routing.EmailBackend'
+
+
+def g_source_email(source_name, **kwargs):
+    """
+    Create an email of an event from the named source
+    """
+    source = Source.objects.filter(name=source_name).first() or G(Source, name=source_name)
+    return g_email(event=G(Event, context=kwargs.pop('context', {}), source=source), **kwargs)
+
+
+class UnavailableBackend(BaseEmailBackend):
+    """
+    A backend whose connection can never be opened
+    """
+    def open(self):
+        raise ConnectionRefusedError('unavailable')
+
+    def keepalive(self):
+        """
+        There is no connection to keep alive
+        """
+
+
+class SendMessagesWithResultsTest(SimpleTestCase):
+    def test_batch_backend(self):
+        connection = BatchBackend()
+        messages = [mail.EmailMessage(to=['ok@example.com']), mail.EmailMessage(to=['fail@example.com'])]
+
+        results = send_messages_with_results(connection, messages)
+
+        self.assertEqual(connection.batches, [messages])
+        self.assertIsNone(results[0])
+        self.assertEqual(str(results[1]), 'rejected')
+
+    def test_plain_backend(self):
+        connection = MagicMock()
+        error = Exception('rejected')
+        connection.send_messages.side_effect = [1, error]
+        messages = [mail.EmailMessage(to=['ok@example.com']), mail.EmailMessage(to=['fail@example.com'])]
+
+        results = send_messages_with_results(connection, messages)
+
+        self.assertEqual(connection.send_messages.call_count, 2)
+        self.assertEqual(results, [None, error])
+
+
+class SMTPEmailBackendTest(SimpleTestCase):
+    def test_reports_each_message(self):
+        backend = SMTPEmailBackend()
+        error = Exception('rejected')
+        messages = [mail.EmailMessage(to=['ok@example.com']), mail.EmailMessage(to=['fail@example.com'])]
+
+        with patch.object(backend, 'open', return_value=True), \
+                patch.object(backend, 'close') as close_mock, \
+                patch.object(backend, '_send', side_effect=[True, error]):
+            results = backend.send_messages_with_results(messages)
+
+        self.assertEqual(results, [None, error])
+        close_mock.assert_called_once_with()
+
+    def test_keeps_open_connection(self):
+        backend = SMTPEmailBackend()
+        messages = [mail.EmailMessage(to=['ok@example.com'])]
+
+        with patch.object(backend, 'open', return_value=False), \
+                patch.object(backend, 'close') as close_mock, \
+                patch.object(backend, '_send', return_value=True):
+            results = backend.send_messages_with_results(messages)
+
+        self.assertEqual(results, [None])
+        close_mock.assert_not_called()
+
+    def test_open_fails(self):
+        backend = SMTPEmailBackend()
+        error = OSError('connection refused')
+        messages = [mail.EmailMessage(to=['a@example.com']), mail.EmailMessage(to=['b@example.com'])]
+
+        with patch.object(backend, 'open', side_effect=error):
+            results = backend.send_messages_with_results(messages)
+
+        self.assertEqual(results, [error, error])
+
+    def test_open_fails_silently(self):
+        backend = SMTPEmailBackend(fail_silently=True)
+        messages = [mail.EmailMessage(to=['a@example.com']), mail.EmailMessage(to=['b@example.com'])]
+
+        with patch.object(SMTPEmailBackend, 'connection_class', side_effect=OSError('connection refused')), \
+                patch.object(backend, '_send') as send_mock:
+            results = backend.send_messages_with_results(messages)
+
+        self.assertEqual([type(result) for result in results], [smtplib.SMTPServerDisconnected] * 2)
+        send_mock.assert_not_called()
+
+
+@patch('entity_emailer.backends.smtp.time.monotonic', return_value=100)
+class SMTPEmailBackendReconnectTest(SimpleTestCase):
+    def get_backend(self, *connections, **kwargs):
+        patcher = patch.object(SMTPEmailBackend, 'connection_class', MagicMock(side_effect=connections))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return SMTPEmailBackend(**kwargs)
+
+    def get_smtp_connection(self, sendmail_side_effect=None, noop=(250, b'OK')):
+        connection = MagicMock()
+        connection.sendmail.side_effect = sendmail_side_effect
+        connection.noop.return_value = noop
+        return connection
+
+    def test_reconnects_and_retries_once(self, monotonic_mock):
+        broken = self.get_smtp_connection(smtplib.SMTPServerDisconnected('disconnected'))
+        working = self.get_smtp_connection()
+        backend = self.get_backend(broken, working)
+        messages = [mail.EmailMessage(to=['a@example.com']), mail.EmailMessage(to=['b@example.com'])]
+
+        self.assertEqual(backend.send_messages_with_results(messages), [None, None])
+
+        self.assertEqual(backend.num_reconnects, 1)
+        self.assertEqual(broken.sendmail.call_count, 1)
+        self.assertEqual(working.sendmail.call_count, 2)
+        working.quit.assert_called_once_with()
+
+    def test_fails_after_retry(self, monotonic_mock):
+        error = ConnectionResetError('reset')
+        backend = self.get_backend(
+            self.get_smtp_connection(error), self.get_smtp_connection([error, None])
+        )
+        messages = [mail.EmailMessage(to=['a@example.com']), mail.EmailMessage(to=['b@example.com'])]
+
+        self.assertEqual(backend.send_messages_with_results(messages), [error, None])
+        self.assertEqual(backend.num_reconnects, 1)
+
+    def test_reconnects_on_421(self, monotonic_mock):
+        backend = self.get_backend(
+            self.get_smtp_connection(smtplib.SMTPSenderRefused(421, b'closing', 'from@example.com')),
+            self.get_smtp_connection(),
+        )
+
+        self.assertEqual(backend.send_messages_with_results([mail.EmailMessage(to=['a@example.com'])]), [None])
+        self.assertEqual(backend.num_reconnects, 1)
+
+    def test_refused_message_not_retried(self, monotonic_mock):
+        error = smtplib.SMTPRecipientsRefused({'a@example.com': (550, b'unknown')})
+        connection = self.get_smtp_connection(error)
+        backend = self.get_backend(connection)
+
+        self.assertEqual(backend.send_messages_with_results([mail.EmailMessage(to=['a@example.com'])]), [error])
+        self.assertEqual(backend.num_reconnects, 0)
+        self.assertEqual(connection.sendmail.call_count, 1)
+
+    def test_reconnect_with_broken_close(self, monotonic_mock):
+        broken = self.get_smtp_connection(smtplib.SMTPServerDisconnected('disconnected'))
+        broken.quit.side_effect = BrokenPipeError('broken')
+        backend = self.get_backend(broken, self.get_smtp_connection())
+
+        self.assertEqual(backend.send_messages_with_results([mail.EmailMessage(to=['a@example.com'])]), [None])
+        self.assertEqual(backend.num_reconnects, 1)
+
+    def test_keepalive_when_idle(self, monotonic_mock):
+        connection = self.get_smtp_connection()
+        backend = self.get_backend(connection, keepalive_interval=10)
+        backend.open()
+
+        # Recently used connections are not checked
+        monotonic_mock.return_value = 105
+        backend.send_messages_with_results([mail.EmailMessage(to=['a@example.com'])])
+        connection.noop.assert_not_called()
+
+        monotonic_mock.return_value = 120
+        backend.send_messages_with_results([mail.EmailMessage(to=['a@example.com'])])
+        connection.noop.assert_called_once_with()
+        self.assertEqual(backend.num_reconnects, 0)
+        self.assertEqual(backend.last_used, 120)
+
+    def test_keepalive_reconnects(self, monotonic_mock):
+        disconnected = self.get_smtp_connection()
+        disconnected.noop.side_effect = smtplib.SMTPServerDisconnected('disconnected')
+        closing = self.get_smtp_connection(noop=(421, b'closing'))
+        working = self.get_smtp_connection()
+        backend = self.get_backend(disconnected, closing, working, keepalive_interval=10)
+        backend.open()
+
+        monotonic_mock.return_value = 120
+        backend.keepalive()
+        self.assertIs(backend.connection, closing)
+
+        monotonic_mock.return_value = 140
+        backend.keepalive()
+        self.assertIs(backend.connection, working)
+        self.assertEqual(backend.num_reconnects, 2)
+
+    def test_keepalive_error(self, monotonic_mock):
+        error = smtplib.SMTPException('error')
+        connection = self.get_smtp_connection()
+        connection.noop.side_effect = error
+        backend = self.get_backend(connection, keepalive_interval=10)
+        backend.open()
+        monotonic_mock.return_value = 120
+
+        self.assertEqual(backend.send_messages_with_results([mail.EmailMessage(to=['a@example.com'])]), [error])
+
+    @override_settings(ENTITY_EMAILER_SMTP_KEEPALIVE_INTERVAL=5)
+    def test_keepalive_interval_setting(self, monotonic_mock):
+        self.assertEqual(SMTPEmailBackend().keepalive_interval, 5)
+        self.assertEqual(SMTPEmailBackend(keepalive_interval=1).keepalive_interval, 1)
+
+
+class PersistentConnectionTest(SimpleTestCase):
+    def setUp(self):
+        self.addCleanup(close_persistent_connection)
+
+    @override_settings(EMAIL_BACKEND=BATCH_BACKEND)
+    def test_reused(self):
+        connection = get_persistent_connection()
+
+        self.assertIsInstance(connection, BatchBackend)
+        self.assertIs(get_persistent_connection(), connection)
+        close_persistent_connection()
+        self.assertIsNot(get_persistent_connection(), connection)
+
+    @override_settings(EMAIL_BACKEND=UNAVAILABLE_BACKEND)
+    def test_open_fails(self):
+        self.assertIsInstance(get_persistent_connection(), UnavailableBackend)
+
+    @override_settings(EMAIL_BACKEND=LOCMEM_BACKEND)
+    def test_backend_without_keepalive(self):
+        self.assertIsNone(get_persistent_connection())
+
+    @override_settings(
+        EMAIL_BACKEND=ROUTING_BACKEND,
+        ENTITY_EMAILER_ROUTES=[
+            {'NAME': 'bulk', 'BACKEND': BATCH_BACKEND},
+            {'NAME': 'default', 'BACKEND': LOCMEM_BACKEND},
+        ],
+    )
+    def test_routing_backend_without_keepalive(self):
+        self.assertIsNone(get_persistent_connection())
+
+        with self.settings(ENTITY_EMAILER_ROUTES=[{'NAME': 'bulk', 'BACKEND': BATCH_BACKEND}]):
+            self.assertIsInstance(get_persistent_connection(), RoutingEmailBackend)
+
+    def test_close_without_connection(self):
+        close_persistent_connection()
+        close_persistent_connection()
+
+
+@freeze_time('2014-01-05')
+@override_settings(DISABLE_DURABILITY_CHECKING=True)
+class SendUnsentScheduledEmailsBatchBackendTest(TestCase):
+    def setUp(self):
+        G(Medium, name='email')
+
+    @override_settings(ENTITY_EMAILER_PERSISTENT_CONNECTION=True, EMAIL_BACKEND=BATCH_BACKEND)
+    @patch('entity_emailer.interface.get_subscribed_email_addresses', return_value=['ok@example.com'])
+    @patch.object(Event, 'render', spec_set=True, return_value=('text', '<p>html</p>'))
+    def test_persistent_connection(self, render_mock, address_mock):
+        self.addCleanup(close_persistent_connection)
+        g_email(context={}, scheduled=datetime.min)
+        EntityEmailerInterface.send_unsent_scheduled_emails()
+        g_email(context={}, scheduled=datetime.min)
+        EntityEmailerInterface.send_unsent_scheduled_emails()
+
+        self.assertEqual([len(batch) for batch in get_persistent_connection().batches], [1, 1])
+
+    @patch('entity_emailer.interface.get_subscribed_email_addresses')
+    @patch.object(Event, 'render', spec_set=True, return_value=('text', '<p>html</p>'))
+    def test_sends_one_batch(self, render_mock, address_mock):
+        address_mock.side_effect = [['ok@example.com'], ['fail@example.com'], ['ok@example.com']]
+        sent_email_1 = g_email(context={}, scheduled=datetime.min)
+        failed_email = g_email(context={}, scheduled=datetime.min)
+        sent_email_2 = g_email(context={}, scheduled=datetime.min)
+        connection = BatchBackend()
+
+        EntityEmailerInterface.send_unsent_scheduled_emails(connection=connection)
+
+        self.assertEqual(len(connection.batches), 1)
+        self.assertEqual(len(connection.batches[0]), 3)
+        self.assertEqual(
+            set(Email.objects.filter(sent=datetime(2014, 1, 5))),
+            {sent_email_1, sent_email_2}
+        )
+        failed_email.refresh_from_db()
+        self.assertIsNone(failed_email.sent)
+        self.assertEqual(failed_email.num_tries, 1)
+        self.assertEqual(failed_email.exception, 'rejected')
+
+
+class HTTPEmailBackendTest(SimpleTestCase):
+    def setUp(self):
+        self.provider = FakeProviderServer(rejected_recipients=['fail@example.com']).start()
+        self.addCleanup(self.provider.stop)
+
+    def get_backend(self, **kwargs):
+        kwargs.setdefault('url', self.provider.url)
+        kwargs.setdefault('api_key', 'test-api-key')
+        return HTTPEmailBackend(**kwargs)
+
+    def get_messages(self, num_messages):
+        return [
+            mail.EmailMessage(subject='Subject {0}'.format(i), body='Body', to=['to{0}@example.com'.format(i)])
+            for i in range(num_messages)
+        ]
+
+    def test_packs_messages_into_bulk_requests(self):
+        results = self.get_backend(batch_size=2, concurrency=1).send_messages_with_results(self.get_messages(5))
+
+        self.assertEqual(results, [None] * 5)
+        self.assertEqual([len(request['messages']) for request in self.provider.requests], [2, 2, 1])
+        # Every request was made over the same kept alive connection
+        self.assertEqual(self.provider.num_connections, 1)
+
+    def test_concurrency(self):
+        results = self.get_backend(batch_size=2, concurrency=3).send_messages_with_results(self.get_messages(12))
+
+        self.assertEqual(results, [None] * 12)
+        self.assertEqual(self.provider.num_messages, 12)
+        self.assertLessEqual(self.provider.num_connections, 3)
+
+    def test_keeps_connections_open(self):
+        backend = self.get_backend(concurrency=1)
+        self.assertTrue(backend.open())
+        self.assertFalse(backend.open())
+
+        backend.send_messages_with_results(self.get_messages(1))
+        backend.send_messages_with_results(self.get_messages(1))
+        backend.close()
+        backend.close()
+
+        self.assertEqual(len(self.provider.requests), 2)
+        self.assertEqual(self.provider.num_connections, 1)
+
+    def test_serializes_message(self):
+        message = mail.EmailMultiAlternatives(
+            subject='Subject', body='Text', from_email='from@example.com', to=['to@example.com'],
+            cc=['cc@example.com'], bcc=['bcc@example.com'], reply_to=['reply@example.com'],
+            headers={'X-Tag': 'tag'},
+        )
+        message.attach_alternative('<p>Html</p>', 'text/html')
+
+        self.get_backend().send_messages_with_results([message])
+
+        self.assertEqual(self.provider.requests[0]['messages'], [{
+            'from': 'from@example.com',
+            'to': ['to@example.com'],
+            'cc': ['cc@example.com'],
+            'bcc': ['bcc@example.com'],
+            'reply_to': ['reply@example.com'],
+            'subject': 'Subject',
+            'text': 'Text',
+            'html': '<p>Html</p>',
+            'headers': {'X-Tag': 'tag'},
+        }])
+
+    def test_rejected_recipient(self):
+        messages = self.get_messages(2)
+        messages[1].to.append('fail@example.com')
+
+        results = self.get_backend().send_messages_with_results(messages)
+
+        self.assertIsNone(results[0])
+        self.assertIsInstance(results[1], HTTPProviderError)
+        self.assertEqual(results[1].to_dict(), {
+            'status': 'failed',
+            'errors': [{'recipient': 'fail@example.com', 'reason': 'Mailbox unavailable'}],
+        })
+
+    def test_request_error(self):
+        results = self.get_backend(api_key='wrong', batch_size=1).send_messages_with_results(self.get_messages(2))
+
+        self.assertEqual(len(results), 2)
+        for result in results:
+            self.assertIsInstance(result, HTTPProviderError)
+            self.assertEqual(str(result), 'Provider api returned status 401')
+            self.assertEqual(result.to_dict(), {'error': 'Invalid api key'})
+
+    def test_provider_unavailable(self):
+        with FakeProviderServer(status=503, latency=0.01) as provider:
+            results = self.get_backend(url=provider.url).send_messages_with_results(self.get_messages(1))
+
+        self.assertEqual(str(results[0]), 'Provider api returned status 503')
+        self.assertEqual(results[0].to_dict(), {'error': 'Provider unavailable'})
+
+    def test_ignores_non_html_alternatives(self):
+        message = mail.EmailMultiAlternatives(body='Text', to=['to@example.com'])
+        message.attach_alternative('# Markdown', 'text/markdown')
+
+        self.get_backend().send_messages_with_results([message])
+
+        self.assertIsNone(self.provider.requests[0]['messages'][0]['html'])
+
+    def test_result_count_mismatch(self):
+        backend = self.get_backend()
+        with patch.object(backend, 'post', return_value={'results': []}):
+            results = backend.send_messages_with_results(self.get_messages(1))
+
+        self.assertEqual(str(results[0]), 'Provider api returned 0 results for 1 messages')
+
+    def test_no_messages(self):
+        self.assertEqual(self.get_backend().send_messages_with_results([]), [])
+
+    def test_send_messages(self):
+        messages = self.get_messages(2)
+        messages[1].to = ['fail@example.com']
+
+        with self.assertRaises(HTTPProviderError):
+            self.get_backend().send_messages(messages)
+        self.assertEqual(self.get_backend(fail_silently=True).send_messages(messages), 1)
+
+    @override_settings(ENTITY_EMAILER_HTTP_BACKEND={
+        'URL': 'https://api.example.com/send', 'API_KEY': 'key', 'BATCH_SIZE': 50, 'CONCURRENCY': 2, 'TIMEOUT': 5,
+    })
+    def test_settings(self):
+        backend = HTTPEmailBackend()
+
+        self.assertEqual(backend.host, 'api.example.com')
+        self.assertEqual(backend.path, '/send')
+        self.assertEqual(backend.api_key, 'key')
+        self.assertEqual((backend.batch_size, backend.concurrency, backend.timeout), (50, 2, 5))
+        self.assertEqual(backend.results_chunk_size, 100)
+        self.assertEqual(backend.connection_class.__name__, 'HTTPSConnection')
+
+
+class HTTPEmailBackendReconnectTest(SimpleTestCase):
+    def get_connection(self, sock, side_effect):
+        connection = MagicMock(sock=sock)
+        connection.request.side_effect = side_effect
+        connection.getresponse.return_value.status = 200
+        connection.getresponse.return_value.read.return_value = json.dumps({'results': [{'status': 'sent'}]}).encode()
+        return connection
+
+    def send_with_connection(self, connection):
+        backend = HTTPEmailBackend(url='http://api.example.com/send', concurrency=1)
+        backend.open()
+        backend.connections.get()
+        backend.connections.put(connection)
+        results = backend.send_messages_with_results([mail.EmailMessage(to=['to@example.com'])])
+        backend.close()
+        return results
+
+    def test_reconnects_closed_keep_alive_connection(self):
+        connection = self.get_connection(sock=object(), side_effect=[ConnectionResetError('reset'), None])
+
+        self.assertEqual(self.send_with_connection(connection), [None])
+        self.assertEqual(connection.request.call_count, 2)
+
+    def test_new_connection_error(self):
+        error = ConnectionRefusedError('refused')
+        connection = self.get_connection(sock=None, side_effect=[error])
+
+        self.assertEqual(self.send_with_connection(connection), [error])
+        self.assertEqual(connection.request.call_count, 1)
+        # The failed connection is reset when it fails and when the backend is closed
+        self.assertEqual(connection.close.call_count, 2)
+
+
+@freeze_time('2014-01-05')
+@override_settings(DISABLE_DURABILITY_CHECKING=True, EMAIL_BACKEND='entity_emailer.backends.http.EmailBackend')
+class SendUnsentScheduledEmailsHTTPBackendTest(TestCase):
+    def setUp(self):
+        G(Medium, name='email')
+        self.provider = FakeProviderServer(rejected_recipients=['fail@example.com']).start()
+        self.addCleanup(self.provider.stop)
+
+    @patch('entity_emailer.interface.get_subscribed_email_addresses')
+    @patch.object(Event, 'render', spec_set=True, return_value=('text', '<p>html</p>'))
+    def test_maps_provider_errors_onto_emails(self, render_mock, address_mock):
+        address_mock.side_effect = [['ok@example.com'], ['ok@example.com', 'fail@example.com']]
+        sent_email = g_email(context={}, scheduled=datetime.min)
+        failed_email = g_email(context={}, scheduled=datetime.min)
+
+        with self.settings(ENTITY_EMAILER_HTTP_BACKEND={'URL': self.provider.url, 'API_KEY': 'test-api-key'}):
+            EntityEmailerInterface.send_unsent_scheduled_emails()
+
+        self.assertEqual(len(self.provider.requests), 1)
+        sent_email.refresh_from_db()
+        self.assertEqual(sent_email.sent, datetime(2014, 1, 5))
+        failed_email.refresh_from_db()
+        self.assertIsNone(failed_email.sent)
+        self.assertEqual(failed_email.exception, 'Provider api rejected message: {0}'.format(json.dumps({
+            'status': 'failed',
+            'errors': [{'recipient': 'fail@example.com', 'reason': 'Mailbox unavailable'}],
+        })))
+
+
+class RoutingEmailBackendTest(TestCase):
+    def get_backend(self, routes):
+        backend = RoutingEmailBackend(routes=routes)
+        self.addCleanup(backend.close)
+        return backend
+
+    def get_message(self, to, source_name=None, priority=None):
+        message = mail.EmailMessage(to=to)
+        if source_name is not None:
+            message.email_model = g_source_email(source_name, context={'priority': priority})
+        return message
+
+    def test_routes_by_source_priority_and_domain(self):
+        backend = self.get_backend([
+            {'NAME': 'urgent', 'BACKEND': BATCH_BACKEND, 'PRIORITIES': ['high']},
+            {'NAME': 'bulk', 'BACKEND': BATCH_BACKEND, 'SOURCES': ['newsletter']},
+            {'NAME': 'partner', 'BACKEND': BATCH_BACKEND, 'DOMAINS': ['Partner.com']},
+            {'NAME': 'default', 'BACKEND': BATCH_BACKEND},
+        ])
+        urgent_message = self.get_message(['a@example.com'], 'newsletter', priority='high')
+        bulk_message = self.get_message(['a@partner.com'], 'newsletter')
+        partner_message = self.get_message(['A <a@PARTNER.com>', 'b@partner.com'], 'alerts')
+        default_messages = [
+            self.get_message(['a@partner.com', 'b@example.com'], 'alerts'),
+            self.get_message(['a@example.com']),
+            self.get_message([]),
+        ]
+
+        results = backend.send_messages_with_results(
+            [urgent_message, bulk_message, partner_message] + default_messages
+        )
+
+        self.assertEqual(results, [None] * 6)
+        routes = backend.routes_by_name
+        self.assertEqual(routes['urgent'].connection.batches, [[urgent_message]])
+        self.assertEqual(routes['bulk'].connection.batches, [[bulk_message]])
+        self.assertEqual(routes['partner'].connection.batches, [[partner_message]])
+        self.assertEqual(routes['default'].connection.batches, [default_messages])
+
+    def test_no_route(self):
+        backend = self.get_backend([
+            {'NAME': 'bulk', 'BACKEND': BATCH_BACKEND, 'SOURCES': ['newsletter']},
+        ])
+
+        results = backend.send_messages_with_results([self.get_message(['a@example.com'])])
+
+        self.assertIsInstance(results[0], NoRouteError)
+        with self.assertRaises(NoRouteError):
+            backend.send_messages([self.get_message(['a@example.com'])])
+        backend.fail_silently = True
+        self.assertEqual(backend.send_messages([self.get_message(['a@example.com'])]), 0)
+
+    def test_keeps_route_connections_open(self):
+        backend = self.get_backend([{'NAME': 'default', 'BACKEND': BATCH_BACKEND}])
+        route = backend.routes_by_name['default']
+
+        self.assertFalse(backend.open())
+        self.assertEqual(backend.send_messages([self.get_message(['a@example.com'])]), 1)
+        connection = route.connection
+        backend.send_messages([self.get_message(['a@example.com'])])
+
+        self.assertIs(route.connection, connection)
+        self.assertEqual(len(connection.batches), 2)
+        backend.close()
+        self.assertIsNone(route.connection)
+
+    def test_fallback(self):
+        backend = self.get_backend([
+            {'NAME': 'primary', 'BACKEND': BATCH_BACKEND, 'FALLBACK': 'secondary'},
+            {
+                'NAME': 'secondary',
+                'BACKEND': LOCMEM_BACKEND,
+                'DOMAINS': [],
+                'FALLBACK': 'primary',
+            },
+        ])
+        messages = [self.get_message(['ok@example.com']), self.get_message(['down@example.com'])]
+
+        self.assertEqual(backend.send_messages_with_results(messages), [None, None])
+        self.assertEqual(mail.outbox, [messages[1]])
+        self.assertEqual(backend.get_stats()['primary']['sent'], 1)
+        self.assertEqual(backend.get_stats()['primary']['failed'], 1)
+        self.assertEqual(backend.get_stats()['primary']['rerouted'], 1)
+        self.assertEqual(backend.get_stats()['secondary']['sent'], 1)
+
+    def test_fallback_cycle(self):
+        backend = self.get_backend([
+            {'NAME': 'primary', 'BACKEND': BATCH_BACKEND, 'FALLBACK': 'secondary'},
+            {
+                'NAME': 'secondary',
+                'BACKEND': BATCH_BACKEND,
+                'FALLBACK': 'primary',
+            },
+        ])
+
+        results = backend.send_messages_with_results([self.get_message(['down@example.com'])])
+
+        self.assertEqual(str(results[0]), 'connection reset')
+        self.assertEqual(
+            {name: stats['failed'] for name, stats in backend.get_stats().items()},
+            {'primary': 1, 'secondary': 1}
+        )
+
+    def test_rejected_messages_not_rerouted(self):
+        backend = self.get_backend([
+            {'NAME': 'primary', 'BACKEND': BATCH_BACKEND, 'FALLBACK': 'secondary'},
+            {'NAME': 'secondary', 'BACKEND': LOCMEM_BACKEND, 'DOMAINS': []},
+        ])
+
+        results = backend.send_messages_with_results([self.get_message(['fail@example.com'])])
+
+        self.assertEqual(str(results[0]), 'rejected')
+        self.assertEqual(mail.outbox, [])
+        self.assertEqual(backend.get_stats()['primary']['rerouted'], 0)
+
+    def test_is_transport_error(self):
+        self.assertTrue(is_transport_error(smtplib.SMTPServerDisconnected('disconnected')))
+        self.assertTrue(is_transport_error(smtplib.SMTPConnectError(554, 'unavailable')))
+        self.assertTrue(is_transport_error(smtplib.SMTPResponseException(421, 'closing')))
+        self.assertTrue(is_transport_error(socket.timeout('timed out')))
+        self.assertTrue(is_transport_error(HTTPProviderError('server error', status=503)))
+        self.assertFalse(is_transport_error(smtplib.SMTPRecipientsRefused({'a@example.com': (550, 'unknown')})))
+        self.assertFalse(is_transport_error(smtplib.SMTPDataError(554, 'rejected')))
+        self.assertFalse(is_transport_error(HTTPProviderError('bad request', status=400)))
+        self.assertFalse(is_transport_error(HTTPProviderError('rejected', {'status': 'failed'})))
+        self.assertFalse(is_transport_error(Exception('rejected')))
+
+    def test_unavailable_route(self):
+        backend = self.get_backend([
+            {'NAME': 'primary', 'BACKEND': UNAVAILABLE_BACKEND, 'FALLBACK': 'secondary'},
+            {'NAME': 'secondary', 'BACKEND': LOCMEM_BACKEND, 'SOURCES': []},
+        ])
+        messages = [self.get_message(['a@example.com']), self.get_message(['b@example.com'])]
+        receiver = MagicMock()
+        route_batch_sent.connect(receiver)
+        self.addCleanup(route_batch_sent.disconnect, receiver)
+
+        self.assertEqual(backend.send_messages_with_results(messages), [None, None])
+
+        self.assertEqual(mail.outbox, messages)
+        self.assertIsNone(backend.routes_by_name['primary'].connection)
+        self.assertEqual(
+            [(call[1]['route'], call[1]['num_sent'], call[1]['num_failed']) for call in receiver.call_args_list],
+            [('primary', 0, 2), ('secondary', 2, 0)]
+        )
+        stats = backend.get_stats()
+        self.assertEqual(stats['primary']['messages_per_second'], 0.0)
+        self.assertGreater(stats['secondary']['messages_per_second'], 0)
+
+    @patch('entity_emailer.backends.smtp.time.monotonic', return_value=100)
+    def test_keepalive_and_reconnects(self, monotonic_mock):
+        backend = self.get_backend([
+            {'NAME': 'smtp', 'BACKEND': 'entity_emailer.backends.smtp.EmailBackend', 'SOURCES': ['alerts']},
+            {'NAME': 'default', 'BACKEND': LOCMEM_BACKEND},
+        ])
+        smtp_connection = MagicMock()
+        smtp_connection.sendmail.side_effect = [smtplib.SMTPServerDisconnected('disconnected'), None]
+        messages = [self.get_message(['a@example.com'], 'alerts'), self.get_message(['b@example.com'])]
+
+        with patch.object(SMTPEmailBackend, 'connection_class', return_value=smtp_connection):
+            self.assertEqual(backend.send_messages_with_results(messages), [None, None])
+
+            monotonic_mock.return_value = 200
+            backend.keepalive()
+
+        smtp_connection.noop.assert_called_once_with()
+        self.assertEqual(backend.get_stats()['smtp']['reconnects'], 1)
+        self.assertEqual(backend.get_stats()['default']['reconnects'], 0)
+
+    def test_reconnects_route_after_transport_error(self):
+        backend = self.get_backend([{'NAME': 'smtp', 'BACKEND': DJANGO_SMTP_BACKEND}])
+        # The server dropped the first connection while it was idle between runs
+        dropped_connection = MagicMock()
+        dropped_connection.sendmail.side_effect = smtplib.SMTPServerDisconnected('please run connect() first')
+        new_connection = MagicMock()
+        new_connection.sendmail.return_value = {}
+
+        with patch('django.core.mail.backends.smtp.smtplib.SMTP', side_effect=[dropped_connection, new_connection]):
+            first_results = backend.send_messages_with_results([self.get_message(['a@example.com'])])
+            second_results = backend.send_messages_with_results([self.get_message(['a@example.com'])])
+
+        self.assertIsInstance(first_results[0], smtplib.SMTPServerDisconnected)
+        self.assertEqual(second_results, [None])
+        new_connection.sendmail.assert_called_once()
+
+    def test_supports_keepalive(self):
+        self.assertTrue(self.get_backend([
+            {'NAME': 'smtp', 'BACKEND': 'entity_emailer.backends.smtp.EmailBackend'},
+            {'NAME': 'default', 'BACKEND': BATCH_BACKEND},
+        ]).supports_keepalive())
+        self.assertFalse(self.get_backend([
+            {'NAME': 'smtp', 'BACKEND': DJANGO_SMTP_BACKEND},
+            {'NAME': 'default', 'BACKEND': BATCH_BACKEND},
+        ]).supports_keepalive())
+        with self.settings(EMAIL_BACKEND=LOCMEM_BACKEND):
+            self.assertFalse(self.get_backend([{'NAME': 'default'}]).supports_keepalive())
+
+    def test_unknown_fallback(self):
+        with self.assertRaises(ImproperlyConfigured):
+            RoutingEmailBackend(routes=[{'NAME': 'primary', 'FALLBACK': 'secondary'}])
+
+    @override_settings(ENTITY_EMAILER_ROUTES=[{'NAME': 'default', 'BACKEND': LOCMEM_BACKEND}])
+    def test_routes_setting(self):
+        backend = RoutingEmailBackend()
+
+        self.assertEqual([route.name for route in backend.routes], ['default'])
+
+
+@freeze_time('2014-01-05')
+@override_settings(
+    DISABLE_DURABILITY_CHECKING=True,
+    EMAIL_BACKEND='entity_emailer.backends.routing.EmailBackend',
+    ENTITY_EMAILER_ROUTES=[
+        {'NAME': 'bulk', 'BACKEND': UNAVAILABLE_BACKEND, 'SOURCES': ['newsletter']},
+        {'NAME': 'default', 'BACKEND': LOCMEM_BACKEND},
+    ],
+)
+class SendUnsentScheduledEmailsRoutingBackendTest(TestCase):
+    def setUp(self):
+        G(Medium, name='email')
+
+    @patch('entity_emailer.interface.get_subscribed_email_addresses', return_value=['to@example.com'])
+    @patch.object(Event, 'render', spec_set=True, return_value=('text', '<p>html</p>'))
+    def test_routes_by_email_source(self, render_mock, address_mock):
+        newsletter_email = g_source_email('newsletter', scheduled=datetime.min)
+        alert_email = g_source_email('alerts', scheduled=datetime.min)
+
+        EntityEmailerInterface.send_unsent_scheduled_emails()
+
+        self.assertEqual([message.email_model for message in mail.outbox], [alert_email])
+        alert_email.refresh_from_db()
+        self.assertEqual(alert_email.sent, datetime(2014, 1, 5))
+        newsletter_email.refresh_from_db()
+        self.assertIsNone(newsletter_email.sent)
+        self.assertEqual(newsletter_email.exception, 'unavailable')
@@ -0,0 +1,236 @@
+from datetime import datetime
+
+from django.test import TestCase, SimpleTestCase
+from django.test.utils import override_settings
+from django_dynamic_fixture import G
+from entity_event.models import Event, Medium
+from freezegun import freeze_time
+from unittest.mock import MagicMock, patch
+
+from entity_emailer.batching import BatchSizer, batch_sizers, get_batch_sizer
+from entity_emailer.interface import EntityEmailerInterface
+from entity_emailer.models import Email
+from entity_emailer.signals import batch_sent
+from entity_emailer.tests.utils import g_email
+
+
+class BatchSizerTest(SimpleTestCase):
+    def test_fixed(self):
+        batch_sizer = BatchSizer(batch_size=100)
+
+        self.assertEqual(batch_sizer.observe(100, 1, 10, 10), 100)
+        self.assertEqual(batch_sizer.batch_size, 100)
+
+    def test_unbatched(self):
+        self.assertIsNone(BatchSizer().batch_size)
+
+    def test_adaptive_starts_within_bounds(self):
+        self.assertEqual(BatchSizer(adaptive=True, min_batch_size=20).batch_size, 20)
+        self.assertEqual(BatchSizer(batch_size=10000, adaptive=True, max_batch_size=1000).batch_size, 1000)
+
+    def test_adaptive_grows_toward_target(self):
+        batch_sizer = BatchSizer(batch_size=100, adaptive=True, target_seconds=5)
+
+        # 100 emails took 1 second, 0.01 seconds each after a 0 second query, so 500 fit in 5 seconds but the size
+        # may only double
+        self.assertEqual(batch_sizer.observe(100, 0, 0.5, 0.5), 200)
+        self.assertEqual(batch_sizer.observe(200, 0, 1, 1), 400)
+        self.assertEqual(batch_sizer.observe(400, 0, 2, 2), 500)
+
+    def test_adaptive_shrinks_toward_target(self):
+        batch_sizer = BatchSizer(batch_size=1000, adaptive=True, target_seconds=5)
+
+        # The query takes 1 second and each email 0.01 seconds, so 400 emails fit in 5 seconds
+        self.assertEqual(batch_sizer.observe(1000, 1, 5, 5), 400)
+        self.assertEqual(batch_sizer.observe(400, 1, 2, 2), 400)
+
+    def test_adaptive_averages_observations(self):
+        batch_sizer = BatchSizer(batch_size=100, adaptive=True, target_seconds=5)
+        batch_sizer.observe(100, 0, 1, 1)
+
+        # One slow batch only moves the estimate halfway
+        self.assertEqual(batch_sizer.observe(100, 0, 3, 3), 125)
+        self.assertAlmostEqual(batch_sizer.seconds_per_email, 0.04)
+
+    def test_adaptive_bounds(self):
+        batch_sizer = BatchSizer(batch_size=100, adaptive=True, min_batch_size=50, max_batch_size=150)
+
+        self.assertEqual(batch_sizer.observe(100, 0, 0, 0), 150)
+        self.assertEqual(batch_sizer.observe(150, 10, 10, 10), 50)
+
+    def test_adaptive_ignores_empty_batches(self):
+        batch_sizer = BatchSizer(batch_size=100, adaptive=True)
+
+        self.assertEqual(batch_sizer.observe(0, 1, 0, 0), 100)
+        self.assertIsNone(batch_sizer.fixed_seconds)
+
+
+class GetBatchSizerTest(SimpleTestCase):
+    def setUp(self):
+        batch_sizers.clear()
+
+    def test_default(self):
+        batch_sizer = get_batch_sizer()
+
+        self.assertIsNone(batch_sizer.batch_size)
+        self.assertFalse(batch_sizer.adaptive)
+        self.assertIs(get_batch_sizer(), batch_sizer)
+
+    @override_settings(
+        ENTITY_EMAILER_SEND_BATCH_SIZE=200,
+        ENTITY_EMAILER_ADAPTIVE_BATCH_SIZE=True,
+        ENTITY_EMAILER_BATCH_TARGET_SECONDS=2.0,
+        ENTITY_EMAILER_MIN_BATCH_SIZE=5,
+        ENTITY_EMAILER_MAX_BATCH_SIZE=500,
+    )
+    def test_settings(self):
+        batch_sizer = get_batch_sizer()
+
+        self.assertEqual(batch_sizer.batch_size, 200)
+        self.assertTrue(batch_sizer.adaptive)
+        self.assertEqual(batch_sizer.target_seconds, 2.0)
+        self.assertEqual(batch_sizer.min_batch_size, 5)
+        self.assertEqual(batch_sizer.max_batch_size, 500)
+
+
+@freeze_time('2014-01-05')
+@override_settings(DISABLE_DURABILITY_CHECKING=True)
+@patch('entity_emailer.interface.get_subscribed_email_addresses', return_value=['to@example.com'])
+@patch.object(Event, 'render', spec_set=True, return_value=('text', '<p>html</p>'))
+class SendUnsentScheduledEmailsBatchesTest(TestCase):
+    def setUp(self):
+        G(Medium, name='email')
+        batch_sizers.clear()
+        self.receiver = MagicMock()
+        batch_sent.connect(self.receiver)
+        self.addCleanup(batch_sent.disconnect, self.receiver)
+
+    def get_batches(self):
+        return [
+            (call[1]['batch_size'], call[1]['num_emails'], call[1]['next_batch_size'])
+            for call in self.receiver.call_args_list
+        ]
+
+    def test_one_batch_by_default(self, render_mock, address_mock):
+        for i in range(3):
+            g_email(context={}, scheduled=datetime.min)
+
+        summary = EntityEmailerInterface.send_unsent_scheduled_emails()
+
+        self.assertEqual(summary, {'processed': 3, 'sent': 3, 'failed': 0, 'remaining_due': 0})
+        self.assertEqual(self.get_batches(), [(None, 3, None)])
+
+    def test_no_emails(self, render_mock, address_mock):
+        summary = EntityEmailerInterface.send_unsent_scheduled_emails()
+
+        self.assertEqual(summary, {'processed': 0, 'sent': 0, 'failed': 0, 'remaining_due': 0})
+
+        self.assertEqual(self.get_batches(), [])
+
+    @override_settings(ENTITY_EMAILER_SEND_BATCH_SIZE=2)
+    def test_fixed_batch_size(self, render_mock, address_mock):
+        emails = [g_email(context={}, scheduled=datetime(2014, 1, 1)) for i in range(3)]
+        emails.insert(0, g_email(context={}, scheduled=datetime(2013, 1, 1)))
+
+        self.assertEqual(EntityEmailerInterface.send_unsent_scheduled_emails()['sent'], 4)
+
+        self.assertEqual(self.get_batches(), [(2, 2, 2), (2, 2, 2)])
+        self.assertEqual(Email.objects.filter(sent=datetime(2014, 1, 5)).count(), 4)
+        call = self.receiver.call_args_list[0][1]
+        self.assertEqual(call['sender'], Email)
+        for key in ['query_seconds', 'render_seconds', 'send_seconds']:
+            self.assertGreaterEqual(call[key], 0)
+
+    @override_settings(ENTITY_EMAILER_SEND_BATCH_SIZE=2)
+    def test_failed_emails_not_read_again(self, render_mock, address_mock):
+        render_mock.side_effect = Exception('render failed')
+        for i in range(5):
+            g_email(context={}, scheduled=datetime.min)
+
+        summary = EntityEmailerInterface.send_unsent_scheduled_emails()
+
+        self.assertEqual(summary, {'processed': 5, 'sent': 0, 'failed': 5, 'remaining_due': 0})
+
+        self.assertEqual(self.get_batches(), [(2, 2, 2), (2, 2, 2), (2, 1, 2)])
+        self.assertEqual(Email.objects.filter(num_tries=1).count(), 5)
+
+    @override_settings(
+        ENTITY_EMAILER_SEND_BATCH_SIZE=2,
+        ENTITY_EMAILER_ADAPTIVE_BATCH_SIZE=True,
+        ENTITY_EMAILER_MIN_BATCH_SIZE=1,
+        ENTITY_EMAILER_BATCH_TARGET_SECONDS=1,
+    )
+    @patch('entity_emailer.interface.time.monotonic')
+    def test_adaptive_batch_size(self, monotonic_mock, render_mock, address_mock):
+        # Every batch takes no time to query and render and a second to send, so one email fits in the target
+        monotonic_mock.side_effect = [0, 0, 0, 2, 2, 2, 2, 3, 3]
+        for i in range(3):
+            g_email(context={}, scheduled=datetime.min)
+
+        self.assertEqual(EntityEmailerInterface.send_unsent_scheduled_emails()['processed'], 3)
+
+        self.assertEqual(self.get_batches(), [(2, 2, 1), (1, 1, 1)])
+
+
+@freeze_time('2014-01-05')
+@override_settings(DISABLE_DURABILITY_CHECKING=True)
+@patch('entity_emailer.interface.get_subscribed_email_addresses', return_value=['to@example.com'])
+@patch.object(Event, 'render', spec_set=True, return_value=('text', '<p>html</p>'))
+class SendUnsentScheduledEmailsTimeBudgetTest(TestCase):
+    def setUp(self):
+        G(Medium, name='email')
+        batch_sizers.clear()
+
+    def test_budget_not_spent(self, render_mock, address_mock):
+        for i in range(3):
+            g_email(context={}, scheduled=datetime.min)
+
+        summary = EntityEmailerInterface.send_unsent_scheduled_emails(time_budget=60)
+
+        self.assertEqual(summary, {'processed': 3, 'sent': 3, 'failed': 0, 'remaining_due': 0})
+
+    def test_budget_spent(self, render_mock, address_mock):
+        g_email(context={}, scheduled=datetime.min)
+
+        summary = EntityEmailerInterface.send_unsent_scheduled_emails(time_budget=0)
+
+        self.assertEqual(summary, {'processed': 0, 'sent': 0, 'failed': 0, 'remaining_due': 1})
+        self.assertFalse(Email.objects.filter(sent__isnull=False).exists())
+
+    def test_deadline_passed(self, render_mock, address_mock):
+        g_email(context={}, scheduled=datetime.min)
+
+        summary = EntityEmailerInterface.send_unsent_scheduled_emails(deadline=datetime(2014, 1, 4))
+
+        self.assertEqual(summary['remaining_due'], 1)
+
+    @patch('entity_emailer.interface.time.monotonic')
+    def test_budget_spent_while_rendering(self, monotonic_mock, render_mock, address_mock):
+        # The budget runs out after the second email is rendered
+        monotonic_mock.side_effect = [0, 0, 0, 1, 2, 5, 5, 5]
+        emails = [g_email(context={}, scheduled=datetime.min) for i in range(4)]
+        render_mock.side_effect = [('text', '<p>html</p>'), Exception('render failed')]
+
+        with patch('entity_emailer.interface.mail.get_connection') as get_connection_mock:
+            summary = EntityEmailerInterface.send_unsent_scheduled_emails(time_budget=3)
+
+        # The emails that were rendered are still sent
+        self.assertEqual(summary, {'processed': 2, 'sent': 1, 'failed': 1, 'remaining_due': 2})
+        send_messages = get_connection_mock.return_value.__enter__.return_value.send_messages
+        self.assertEqual(len(send_messages.call_args[0][0]), 1)
+        self.assertEqual(
+            list(Email.objects.filter(sent__isnull=True, num_tries=0).order_by('id')),
+            emails[2:],
+        )
+
+    @override_settings(ENTITY_EMAILER_SEND_BATCH_SIZE=2)
+    @patch('entity_emailer.interface.time.monotonic')
+    def test_budget_spent_between_batches(self, monotonic_mock, render_mock, address_mock):
+        # The budget runs out after the first batch is sent
+        monotonic_mock.side_effect = [0, 0, 0, 1, 1, 2, 2, 5]
+        for i in range(5):
+            g_email(context={}, scheduled=datetime.min)
+
+        summary = EntityEmailerInterface.send_unsent_scheduled_emails(time_budget=3)
+
+        self.assertEqual(summary, {'processed': 2, 'sent': 2, 'failed': 0, 'remaining_due': 3})
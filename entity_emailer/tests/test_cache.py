@@ -0,0 +1,235 @@
+from datetime import datetime
+
+from django.core import mail
+from django.core.cache import caches
+from django.test import TestCase, SimpleTestCase
+from django.test.utils import override_settings
+from django_dynamic_fixture import G
+from entity.models import Entity
+from entity_event.models import Event, Medium
+from manager_utils import post_bulk_operation
+from unittest.mock import patch
+
+from entity_emailer.cache import EntityAddressCache, address_caches, get_address_cache, get_entity_address
+from entity_emailer.interface import EntityEmailerInterface
+from entity_emailer.tests.utils import g_email
+from entity_emailer.utils import get_subscribed_email_addresses
+
+
+class GetEntityAddressTest(SimpleTestCase):
+    def test_address(self):
+        self.assertEqual(get_entity_address({'email': 'test@example.com'}), ('test@example.com', False))
+
+    def test_no_address(self):
+        self.assertEqual(get_entity_address({'email': ''}), (None, False))
+        self.assertEqual(get_entity_address(None), (None, False))
+
+    @override_settings(ENTITY_EMAILER_EMAIL_KEY='email_address', ENTITY_EMAILER_EXCLUDE_KEY='active')
+    def test_keys(self):
+        self.assertEqual(
+            get_entity_address({'email_address': 'test@example.com', 'active': True}),
+            ('test@example.com', False),
+        )
+        self.assertEqual(get_entity_address({'email_address': 'test@example.com'}), ('test@example.com', True))
+
+
+class EntityAddressCacheTest(TestCase):
+    def setUp(self):
+        caches['default'].clear()
+        self.e1 = G(Entity, entity_meta={'email': 'e1@example.com'})
+        self.e2 = G(Entity, entity_meta={'email': 'e2@example.com'})
+
+    def test_resolve(self):
+        address_cache = EntityAddressCache()
+
+        with self.assertNumQueries(1):
+            self.assertEqual(address_cache.resolve([self.e2.id, self.e1.id, 0]), {
+                self.e2.id: ('e2@example.com', False),
+                self.e1.id: ('e1@example.com', False),
+            })
+        with self.assertNumQueries(0):
+            self.assertEqual(list(address_cache.resolve([self.e1.id, self.e2.id])), [self.e1.id, self.e2.id])
+
+        self.assertEqual(address_cache.get_stats(), {'hits': 2, 'shared_hits': 0, 'misses': 3, 'size': 2})
+
+    def test_inactive_entities(self):
+        Entity.all_objects.filter(id=self.e1.id).update(is_active=False)
+
+        self.assertEqual(list(EntityAddressCache().resolve([self.e1.id, self.e2.id])), [self.e2.id])
+
+    def test_least_recently_used_evicted(self):
+        e3 = G(Entity, entity_meta={'email': 'e3@example.com'})
+        address_cache = EntityAddressCache(max_size=2)
+
+        address_cache.resolve([self.e1.id, self.e2.id])
+        address_cache.resolve([self.e1.id])
+        address_cache.resolve([e3.id])
+
+        self.assertEqual(list(address_cache.entries), [self.e1.id, e3.id])
+
+    @patch('entity_emailer.cache.time.monotonic')
+    def test_expires(self, monotonic_mock):
+        monotonic_mock.return_value = 0
+        address_cache = EntityAddressCache(timeout=10)
+        address_cache.resolve([self.e1.id])
+
+        monotonic_mock.return_value = 10
+        with self.assertNumQueries(1):
+            address_cache.resolve([self.e1.id])
+
+        self.assertEqual(address_cache.misses, 2)
+
+    def test_shared_cache(self):
+        EntityAddressCache(cache_alias='default').resolve([self.e1.id])
+        address_cache = EntityAddressCache(cache_alias='default')
+
+        with self.assertNumQueries(1):
+            self.assertEqual(address_cache.resolve([self.e1.id, self.e2.id]), {
+                self.e1.id: ('e1@example.com', False),
+                self.e2.id: ('e2@example.com', False),
+            })
+
+        self.assertEqual(address_cache.get_stats(), {'hits': 0, 'shared_hits': 1, 'misses': 1, 'size': 2})
+
+    def test_invalidate(self):
+        address_cache = EntityAddressCache(cache_alias='default')
+        address_cache.resolve([self.e1.id, self.e2.id])
+
+        address_cache.invalidate([self.e1.id])
+
+        self.assertEqual(list(address_cache.entries), [self.e2.id])
+        self.assertIsNone(caches['default'].get(address_cache.get_key(self.e1.id, address_cache.generation)))
+
+    def test_clear_starts_new_generation(self):
+        other_address_cache = EntityAddressCache(cache_alias='default')
+        other_address_cache.resolve([self.e1.id])
+        address_cache = EntityAddressCache(cache_alias='default')
+
+        address_cache.clear()
+
+        # The entries of the shared cache and of other processes belong to the old generation
+        with self.assertNumQueries(1):
+            other_address_cache.resolve([self.e1.id])
+        self.assertNotEqual(other_address_cache.generation, address_cache.generation)
+        self.assertEqual(other_address_cache.get_stats(), {'hits': 0, 'shared_hits': 0, 'misses': 2, 'size': 1})
+
+    def test_concurrent_generation(self):
+        address_cache = EntityAddressCache(cache_alias='default')
+
+        # Another process adds its generation between the read and the add
+        with patch.object(caches['default'], 'get', side_effect=[None, 'other']):
+            with patch.object(caches['default'], 'add', return_value=False):
+                self.assertEqual(address_cache.get_generation(), 'other')
+
+
+@override_settings(ENTITY_EMAILER_ADDRESS_CACHE_SIZE=100)
+class GetAddressCacheTest(TestCase):
+    def setUp(self):
+        address_caches.clear()
+
+    @override_settings(ENTITY_EMAILER_ADDRESS_CACHE_SIZE=None)
+    def test_off(self):
+        self.assertIsNone(get_address_cache())
+
+    def test_per_configuration(self):
+        address_cache = get_address_cache()
+
+        self.assertEqual(address_cache.max_size, 100)
+        self.assertIs(get_address_cache(), address_cache)
+        with override_settings(ENTITY_EMAILER_EMAIL_KEY='email_address'):
+            self.assertIsNot(get_address_cache(), address_cache)
+
+    def test_invalidated_on_save(self):
+        entity = G(Entity, entity_meta={'email': 'old@example.com'})
+        address_cache = get_address_cache()
+        address_cache.resolve([entity.id])
+
+        entity.entity_meta = {'email': 'new@example.com'}
+        entity.save()
+
+        self.assertEqual(address_cache.resolve([entity.id]), {entity.id: ('new@example.com', False)})
+
+    def test_invalidated_on_deactivation(self):
+        entity = G(Entity, entity_meta={'email': 'e@example.com'})
+        address_cache = get_address_cache()
+        address_cache.resolve([entity.id])
+
+        Entity.objects.filter(id=entity.id).update(is_active=False)
+
+        self.assertEqual(address_cache.resolve([entity.id]), {})
+
+    def test_cleared_on_bulk_operation(self):
+        entity = G(Entity, entity_meta={'email': 'e@example.com'})
+        address_cache = get_address_cache()
+        address_cache.resolve([entity.id])
+
+        post_bulk_operation.send(sender=Entity, model=Entity)
+
+        self.assertEqual(len(address_cache.entries), 0)
+
+    @override_settings(ENTITY_EMAILER_ADDRESS_CACHE='default')
+    def test_shared_cache_invalidated_without_local_cache(self):
+        caches['default'].clear()
+        entity = G(Entity, entity_meta={'email': 'old@example.com'})
+        # A sending process warms the shared cache while this process has no address cache
+        sender_cache = EntityAddressCache(cache_alias='default')
+        sender_cache.resolve([entity.id])
+
+        entity.entity_meta = {'email': 'new@example.com'}
+        entity.save()
+
+        self.assertEqual(
+            EntityAddressCache(cache_alias='default').resolve([entity.id]),
+            {entity.id: ('new@example.com', False)},
+        )
+
+    @override_settings(ENTITY_EMAILER_ADDRESS_CACHE='default')
+    def test_shared_cache_cleared_on_bulk_operation_without_local_cache(self):
+        caches['default'].clear()
+        entity = G(Entity, entity_meta={'email': 'old@example.com'})
+        sender_cache = EntityAddressCache(cache_alias='default')
+        sender_cache.resolve([entity.id])
+
+        Entity.objects.filter(id=entity.id).update(entity_meta={'email': 'new@example.com'})
+        post_bulk_operation.send(sender=Entity, model=Entity)
+
+        self.assertEqual(sender_cache.resolve([entity.id]), {entity.id: ('new@example.com', False)})
+        self.assertEqual(
+            EntityAddressCache(cache_alias='default').resolve([entity.id]),
+            {entity.id: ('new@example.com', False)},
+        )
+
+
+@override_settings(ENTITY_EMAILER_ADDRESS_CACHE_SIZE=100, ENTITY_EMAILER_EXCLUDE_KEY='active')
+class GetSubscribedEmailAddressesCacheTest(TestCase):
+    def setUp(self):
+        address_caches.clear()
+        self.e1 = G(Entity, entity_meta={'email': 'e1@example.com', 'active': True})
+        self.e2 = G(Entity, entity_meta={'email': 'e2@example.com', 'active': False})
+        self.e3 = G(Entity, entity_meta={'email': '', 'active': True})
+
+    def test_resolves_through_cache(self):
+        email = g_email(recipients=[self.e1, self.e2, self.e3], context={})
+
+        self.assertEqual(get_subscribed_email_addresses(email), ['e1@example.com'])
+        self.assertEqual(get_subscribed_email_addresses(email), ['e1@example.com'])
+
+        self.assertEqual(get_address_cache().get_stats()['hits'], 3)
+
+    @override_settings(DISABLE_DURABILITY_CHECKING=True)
+    @patch.object(Event, 'render', spec_set=True, return_value=('text', '<p>html</p>'))
+    def test_resolves_batch(self, render_mock):
+        G(Medium, name='email')
+        e4 = G(Entity, entity_meta={'email': 'e4@example.com', 'active': True})
+        g_email(recipients=[self.e1, self.e2], context={}, scheduled=datetime.min)
+        g_email(recipients=[self.e1, e4, self.e3], context={}, scheduled=datetime.min)
+        g_email(recipients=[], context={}, scheduled=datetime.min)
+
+        EntityEmailerInterface.send_unsent_scheduled_emails()
+
+        self.assertEqual(
+            sorted(message.to for message in mail.outbox),
+            [['e1@example.com'], ['e1@example.com', 'e4@example.com']],
+        )
+        # Every recipient was read once for the whole batch
+        self.assertEqual(get_address_cache().get_stats(), {'hits': 0, 'shared_hits': 0, 'misses': 4, 'size': 4})
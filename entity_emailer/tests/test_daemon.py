@@ -0,0 +1,308 @@
+from datetime import datetime
+
+from django.core import mail
+from django.core.management import call_command
+from django.db import OperationalError
+from django.test import TestCase, SimpleTestCase
+from django.test.utils import override_settings
+from django_dynamic_fixture import G
+from entity_event.models import Event, Medium
+from freezegun import freeze_time
+from unittest.mock import MagicMock, call, patch
+
+from entity_emailer.daemon import EmailerDaemon
+from entity_emailer.interface import EntityEmailerInterface
+from entity_emailer.models import Email
+from entity_emailer.tests.utils import g_email
+from entity_emailer.utils import notify_emails_created
+
+
+@freeze_time('2014-01-05')
+@override_settings(DISABLE_DURABILITY_CHECKING=True)
+@patch('entity_emailer.interface.get_subscribed_email_addresses', return_value=['test1@example.com'])
+@patch.object(Event, 'render', spec_set=True, return_value=('text', '<p>html</p>'))
+class EmailerDaemonRunTest(TestCase):
+    def setUp(self):
+        G(Medium, name='email')
+
+    def test_run_sends_due_emails(self, render_mock, address_mock):
+        g_email(context={}, scheduled=datetime.min)
+        g_email(context={}, scheduled=datetime.min)
+
+        daemon = EmailerDaemon(max_runs=2)
+        with patch.object(daemon, 'wait') as wait_mock:
+            daemon.run()
+
+        self.assertEqual(daemon.num_runs, 2)
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(Email.objects.filter(sent__isnull=False).count(), 2)
+        # The first run processed the emails so the daemon polls again quickly
+        wait_mock.assert_called_once_with(0.5)
+
+    def test_run_stops_when_requested(self, render_mock, address_mock):
+        daemon = EmailerDaemon()
+        with patch.object(daemon, 'wait', side_effect=daemon.stop):
+            daemon.run()
+
+        self.assertEqual(daemon.num_runs, 1)
+
+    def test_run_continues_with_remaining_due_emails(self, render_mock, address_mock):
+        g_email(context={}, scheduled=datetime.min)
+        g_email(context={}, scheduled=datetime.min)
+
+        daemon = EmailerDaemon(max_runs=2, time_budget=0)
+        with patch.object(daemon, 'wait') as wait_mock:
+            daemon.run()
+
+        # Every run ran out of time before picking up an email, so the daemon never waited between runs
+        self.assertEqual(daemon.num_runs, 2)
+        self.assertEqual(len(mail.outbox), 0)
+        wait_mock.assert_not_called()
+
+    def test_run_reuses_connection(self, render_mock, address_mock):
+        g_email(context={}, scheduled=datetime.min)
+
+        daemon = EmailerDaemon(max_runs=1)
+        with patch('entity_emailer.daemon.mail.get_connection') as get_connection_mock:
+            daemon.run()
+
+        connection = get_connection_mock.return_value
+        connection.open.assert_called_once_with()
+        connection.send_messages.assert_called_once()
+        connection.close.assert_called_once_with()
+
+    def test_run_connects_every_run_without_keepalive(self, render_mock, address_mock):
+        g_email(context={}, scheduled=datetime.min)
+
+        # The locmem backend can't repair a broken connection, so it is not kept open between runs
+        daemon = EmailerDaemon(max_runs=2)
+        with patch('entity_emailer.interface.mail.get_connection', wraps=mail.get_connection) as get_connection_mock:
+            with patch.object(daemon, 'wait'):
+                daemon.run()
+
+        # One connection is created to check the backend and one for each run
+        self.assertIsNone(daemon.connection)
+        self.assertEqual(get_connection_mock.call_count, 3)
+        self.assertEqual(len(mail.outbox), 1)
+
+    @patch('entity_emailer.daemon.logger')
+    @patch('entity_emailer.daemon.close_old_connections')
+    def test_run_continues_after_failed_run(self, close_mock, logger_mock, render_mock, address_mock):
+        summary = {'processed': 0, 'sent': 0, 'failed': 0, 'remaining_due': 0}
+        daemon = EmailerDaemon(max_runs=3)
+        with patch(
+            'entity_emailer.daemon.EntityEmailerInterface.send_unsent_scheduled_emails',
+            side_effect=[OperationalError('connection lost'), summary, summary],
+        ):
+            with patch.object(daemon, 'wait') as wait_mock:
+                daemon.run()
+
+        self.assertEqual(daemon.num_runs, 3)
+        logger_mock.exception.assert_called_once()
+        # The daemon backs off after the failed run and keeps backing off while idle
+        self.assertEqual(wait_mock.call_args_list, [call(1.0), call(2.0)])
+
+
+@freeze_time('2014-01-05')
+class EmailerDaemonIntervalTest(TestCase):
+    def test_backs_off_while_idle(self):
+        daemon = EmailerDaemon(min_interval=1, max_interval=5, backoff=2)
+        self.assertEqual(
+            [daemon.next_interval(0) for i in range(4)],
+            [2, 4, 5, 5]
+        )
+
+    def test_resets_when_working(self):
+        daemon = EmailerDaemon(min_interval=1, max_interval=5, backoff=2)
+        daemon.next_interval(0)
+        daemon.next_interval(0)
+        self.assertEqual(daemon.next_interval(3), 1)
+
+    def test_wakes_up_when_next_email_is_due(self):
+        g_email(context={}, scheduled=datetime(2014, 1, 5, 0, 0, 3))
+        daemon = EmailerDaemon(min_interval=1, max_interval=5, backoff=2)
+        self.assertEqual(daemon.next_interval(0), 2)
+        self.assertEqual(daemon.next_interval(0), 3)
+        self.assertEqual(daemon.interval, 4)
+
+    def test_ignores_due_failed_emails(self):
+        g_email(context={}, scheduled=datetime(2014, 1, 4), num_tries=1)
+        daemon = EmailerDaemon(min_interval=1, max_interval=5, backoff=2)
+        self.assertEqual(daemon.next_interval(0), 2)
+
+    def test_wakes_up_for_future_email_behind_due_failed_emails(self):
+        g_email(context={}, scheduled=datetime(2014, 1, 4), num_tries=1)
+        g_email(context={}, scheduled=datetime(2014, 1, 5, 0, 0, 3))
+        daemon = EmailerDaemon(min_interval=1, max_interval=5, backoff=2)
+        self.assertEqual(daemon.next_interval(0), 2)
+        self.assertEqual(daemon.next_interval(0), 3)
+
+    @patch('entity_emailer.daemon.time.sleep')
+    def test_wait_sleeps_in_slices(self, sleep_mock):
+        daemon = EmailerDaemon()
+        with patch('entity_emailer.daemon.time.monotonic', side_effect=[0, 0.5, 1.0]):
+            daemon.wait(1)
+
+        self.assertEqual(sleep_mock.call_count, 2)
+
+    @patch('entity_emailer.daemon.time.sleep')
+    def test_wait_returns_when_stopped(self, sleep_mock):
+        daemon = EmailerDaemon()
+        sleep_mock.side_effect = daemon.stop
+        daemon.wait(10)
+
+        sleep_mock.assert_called_once_with(0.5)
+
+    @patch('entity_emailer.daemon.time.sleep')
+    def test_wait_keeps_connection_alive(self, sleep_mock):
+        daemon = EmailerDaemon()
+        daemon.connection = MagicMock()
+        daemon.connection.keepalive.side_effect = [None, Exception('broken')]
+        with patch('entity_emailer.daemon.time.monotonic', side_effect=[0, 0.5, 1.0]):
+            daemon.wait(1)
+
+        self.assertEqual(daemon.connection.keepalive.call_count, 2)
+
+    @patch('entity_emailer.daemon.signal.signal')
+    def test_install_signal_handlers(self, signal_mock):
+        daemon = EmailerDaemon()
+        daemon.install_signal_handlers()
+
+        self.assertEqual(signal_mock.call_count, 2)
+        signal_mock.call_args[0][1]()
+        self.assertTrue(daemon.stopping)
+
+
+class EmailerDaemonListenTest(SimpleTestCase):
+    def test_start_listening_without_channel(self):
+        self.assertIsNone(EmailerDaemon(listen=True).start_listening())
+
+    @override_settings(ENTITY_EMAILER_NOTIFY_CHANNEL='emails')
+    def test_start_listening_not_postgres(self):
+        with patch('entity_emailer.daemon.connections') as connections_mock:
+            connections_mock.create_connection.return_value.vendor = 'sqlite'
+            self.assertIsNone(EmailerDaemon(listen=True).start_listening())
+
+    @override_settings(ENTITY_EMAILER_NOTIFY_CHANNEL='emails')
+    def test_start_listening_unsupported_driver(self):
+        with patch('entity_emailer.daemon.connections') as connections_mock:
+            listen_connection = connections_mock.create_connection.return_value
+            listen_connection.vendor = 'postgresql'
+            listen_connection.connection = object()
+            self.assertIsNone(EmailerDaemon(listen=True).start_listening())
+
+        listen_connection.close.assert_called_once_with()
+
+    @override_settings(ENTITY_EMAILER_NOTIFY_CHANNEL='emails')
+    def test_start_listening(self):
+        with patch('entity_emailer.daemon.connections') as connections_mock:
+            listen_connection = connections_mock.create_connection.return_value
+            listen_connection.vendor = 'postgresql'
+            listen_connection.ops.quote_name.return_value = '"emails"'
+            self.assertEqual(EmailerDaemon(listen=True).start_listening(), listen_connection)
+
+        cursor = listen_connection.cursor.return_value.__enter__.return_value
+        cursor.execute.assert_called_once_with('LISTEN "emails"')
+
+    @patch('entity_emailer.daemon.select.select')
+    def test_wait_for_notification(self, select_mock):
+        daemon = EmailerDaemon(listen=True)
+        daemon.listen_connection = MagicMock()
+        raw_connection = daemon.listen_connection.connection
+        raw_connection.notifies = ['notification']
+        select_mock.return_value = ([raw_connection], [], [])
+
+        self.assertTrue(daemon.wait_for_notification(1))
+        raw_connection.poll.assert_called_once_with()
+        self.assertEqual(raw_connection.notifies, [])
+
+    @patch('entity_emailer.daemon.select.select', return_value=([], [], []))
+    def test_wait_for_notification_timeout(self, select_mock):
+        daemon = EmailerDaemon(listen=True)
+        daemon.listen_connection = MagicMock()
+
+        self.assertFalse(daemon.wait_for_notification(1))
+        daemon.listen_connection.connection.poll.assert_not_called()
+
+    def test_wait_returns_on_notification(self):
+        daemon = EmailerDaemon(listen=True)
+        with patch.object(daemon, 'wait_for_notification', return_value=True) as wait_mock:
+            daemon.wait(10)
+
+        wait_mock.assert_called_once_with(0.5)
+
+    @patch('entity_emailer.daemon.get_medium')
+    @patch('entity_emailer.daemon.mail.get_connection')
+    def test_setup_and_teardown(self, get_connection_mock, get_medium_mock):
+        daemon = EmailerDaemon(listen=True)
+        with patch.object(daemon, 'start_listening') as start_listening_mock:
+            daemon.setup()
+            daemon.teardown()
+
+        self.assertEqual(daemon.listen_connection, start_listening_mock.return_value)
+        start_listening_mock.return_value.close.assert_called_once_with()
+
+
+class RunEntityEmailerCommandTest(SimpleTestCase):
+    @patch('entity_emailer.management.commands.run_entity_emailer.EmailerDaemon')
+    def test_options(self, daemon_mock):
+        call_command(
+            'run_entity_emailer', '--max-runs', '3', '--listen', '--max-interval', '10', '--time-budget', '20'
+        )
+
+        daemon_mock.assert_called_once_with(
+            min_interval=0.5,
+            max_interval=10.0,
+            backoff=2.0,
+            listen=True,
+            max_runs=3,
+            time_budget=20.0,
+        )
+        daemon_mock.return_value.install_signal_handlers.assert_called_once_with()
+        daemon_mock.return_value.run.assert_called_once_with()
+
+
+class NotifyEmailsCreatedTest(SimpleTestCase):
+    @patch('entity_emailer.utils.connections')
+    def test_no_channel(self, connections_mock):
+        connections_mock.__getitem__.return_value.vendor = 'postgresql'
+        notify_emails_created()
+        connections_mock.__getitem__.return_value.cursor.assert_not_called()
+
+    @override_settings(ENTITY_EMAILER_NOTIFY_CHANNEL='emails')
+    @patch('entity_emailer.utils.connections')
+    def test_not_postgres(self, connections_mock):
+        connections_mock.__getitem__.return_value.vendor = 'sqlite'
+        notify_emails_created()
+        connections_mock.__getitem__.return_value.cursor.assert_not_called()
+
+    @override_settings(ENTITY_EMAILER_NOTIFY_CHANNEL='emails')
+    @patch('entity_emailer.utils.connections')
+    def test_notify(self, connections_mock):
+        connection = connections_mock.__getitem__.return_value
+        connection.vendor = 'postgresql'
+        connection.ops.quote_name.return_value = '"emails"'
+        notify_emails_created()
+
+        cursor = connection.cursor.return_value.__enter__.return_value
+        cursor.execute.assert_called_once_with('NOTIFY "emails"')
+
+
+class SendUnsentScheduledEmailsConnectionTest(TestCase):
+    @override_settings(DISABLE_DURABILITY_CHECKING=True)
+    @patch('entity_emailer.interface.get_subscribed_email_addresses', return_value=['test1@example.com'])
+    @patch.object(Event, 'render', spec_set=True, return_value=('text', '<p>html</p>'))
+    def test_uses_given_connection_and_medium(self, render_mock, address_mock):
+        email_medium = G(Medium, name='email')
+        g_email(context={}, scheduled=datetime.min)
+        connection = MagicMock()
+
+        with self.assertNumQueries(3):
+            summary = EntityEmailerInterface.send_unsent_scheduled_emails(
+                connection=connection,
+                email_medium=email_medium,
+            )
+
+        self.assertEqual(summary['processed'], 1)
+        connection.send_messages.assert_called_once()
+        connection.close.assert_not_called()
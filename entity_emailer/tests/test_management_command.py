@@ -1,7 +1,15 @@
+from datetime import datetime
+from io import StringIO
+import json
+
 from django.core.management import call_command
 from django.test import TestCase
+from django_dynamic_fixture import G
 from entity_event.models import Medium, Source
+from freezegun import freeze_time
 
+from entity_emailer.models import DeliveryStats, RenderedBody
+from entity_emailer.tests.utils import g_email
 from entity_emailer.utils import get_medium, get_admin_source
 
 
@@ -41,3 +49,59 @@ class EntityEmailerAdminSetupTest(TestCase):
             call_command('entity_emailer_admin_setup')
             source = get_admin_source()
         self.assertEqual(source.name, custom_source_name)
+
+
+class EntityEmailerDeliveryStatsTest(TestCase):
+    def test_prints_stats(self):
+        source = G(Source, name='source')
+        DeliveryStats.objects.increment(datetime(2014, 1, 5, 9), {(source.id, 'sent'): 2})
+        DeliveryStats.objects.increment(datetime(2014, 1, 5, 10), {(source.id, 'sent'): 5, (source.id, 'failed'): 1})
+        stdout = StringIO()
+
+        call_command(
+            'entity_emailer_delivery_stats', '--start', '2014-01-05T10:00', '--source', 'source', '--outcome', 'sent',
+            stdout=stdout,
+        )
+
+        self.assertEqual(stdout.getvalue(), '2014-01-05T10:00:00\tsource\tsent\t5\n')
+
+
+class BackfillEntityEmailerDeliveryStatsTest(TestCase):
+    @freeze_time('2014-01-05 10:30')
+    def test_backfill(self):
+        g_email(context={}, sent=datetime(2014, 1, 5, 9, 10))
+        stdout = StringIO()
+
+        call_command('backfill_entity_emailer_delivery_stats', '--end', '2014-01-05T10:00', stdout=stdout)
+
+        self.assertEqual(stdout.getvalue(), 'Saved 1 delivery stats\n')
+        self.assertEqual(DeliveryStats.objects.get().hour, datetime(2014, 1, 5, 9))
+
+
+class DeleteUnusedRenderedBodiesTest(TestCase):
+    def test_deletes_unused_bodies(self):
+        used_id, unused_id = RenderedBody.objects.store_bodies([('a', ''), ('b', '')])
+        g_email(context={}, rendered_body=RenderedBody.objects.get(id=used_id))
+        stdout = StringIO()
+
+        call_command('delete_unused_rendered_bodies', stdout=stdout)
+
+        self.assertEqual(stdout.getvalue().strip(), '1')
+        self.assertEqual(list(RenderedBody.objects.values_list('id', flat=True)), [used_id])
+
+
+class EntityEmailerQueueHealthTest(TestCase):
+    def test_prints_health(self):
+        g_email(context={}, scheduled=datetime(2014, 1, 1))
+        stdout = StringIO()
+
+        with freeze_time('2014-01-01 00:01'):
+            call_command('entity_emailer_queue_health', stdout=stdout)
+
+        self.assertEqual(json.loads(stdout.getvalue()), {
+            'pending': 1,
+            'oldest_due_seconds': 60.0,
+            'retrying': 0,
+            'failed': 0,
+            'approximate': [],
+        })
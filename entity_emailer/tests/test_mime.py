@@ -0,0 +1,126 @@
+from email import generator
+from email.mime.text import MIMEText
+
+from django.core import mail
+from django.test import SimpleTestCase
+from django.test.utils import override_settings
+
+from entity_emailer.mime import EmailMessage, EmailMultiAlternatives, SharedBodyMIMEBuilder, \
+    SharedBodyMIMEMessage
+
+
+class SharedBodyMessageTest(SimpleTestCase):
+    text = u'Hello récipient, this is the text of the email\n' * 20
+    html = u'<p>Hello récipient, this is the html of the email</p>\n' * 20
+    headers = {'Date': 'Sun, 05 Jan 2014 00:00:00 -0000', 'Message-ID': '<1@example.com>', 'X-Test': 'test'}
+
+    def get_messages(self, message_class, html=True, **kwargs):
+        """
+        Returns the same message built by django and built with a shared body
+        """
+        messages = []
+        for i in range(2):
+            message = message_class(
+                subject=u'Subjéct',
+                body=self.text,
+                from_email='from@example.com',
+                to=['to@example.com'],
+                cc=['cc@example.com'],
+                reply_to=['reply@example.com'],
+                headers=self.headers,
+                **kwargs
+            )
+            if html:
+                message.attach_alternative(self.html, 'text/html')
+            messages.append(message)
+
+        messages[1].mime_builder = SharedBodyMIMEBuilder()
+        return messages
+
+    def assert_same_message(self, django_message, shared_message):
+        django_mime = django_message.message()
+        shared_mime = shared_message.message()
+        self.assertIsInstance(shared_mime, SharedBodyMIMEMessage)
+        if shared_mime.is_multipart():
+            django_mime.set_boundary(shared_mime.get_boundary())
+
+        for linesep in ['\n', '\r\n']:
+            self.assertEqual(shared_mime.as_bytes(linesep=linesep), django_mime.as_bytes(linesep=linesep))
+            self.assertEqual(shared_mime.as_string(linesep=linesep), django_mime.as_string(linesep=linesep))
+        self.assertEqual(bytes(shared_mime), bytes(django_mime))
+        self.assertEqual(str(shared_mime), str(django_mime))
+        self.assertEqual(
+            [part.get_content_type() for part in shared_mime.walk()],
+            [part.get_content_type() for part in django_mime.walk()],
+        )
+
+    def test_same_as_django_multi_alternatives(self):
+        self.assert_same_message(*self.get_messages(EmailMultiAlternatives))
+
+    def test_same_as_django_text(self):
+        self.assert_same_message(*self.get_messages(EmailMessage, html=False))
+
+    def test_same_as_django_html_only(self):
+        django_message, shared_message = self.get_messages(EmailMultiAlternatives)
+        django_message.body = shared_message.body = ''
+        self.assert_same_message(django_message, shared_message)
+
+    def test_same_as_django_generated_headers(self):
+        django_message, shared_message = self.get_messages(EmailMessage, html=False)
+        django_message.extra_headers = {'From': 'other@example.com'}
+        shared_message.extra_headers = {'From': 'other@example.com'}
+
+        shared_mime = shared_message.message()
+        self.assertEqual(shared_mime['From'], 'other@example.com')
+        self.assertIn('Date', shared_mime)
+        self.assertIn('Message-ID', shared_mime)
+        self.assertEqual(shared_mime.keys(), django_message.message().keys())
+
+    def test_body_shared_between_copies(self):
+        django_message, shared_message = self.get_messages(EmailMultiAlternatives)
+        copy_message = EmailMultiAlternatives(
+            subject='Other subject', body=self.text, from_email='from@example.com', to=['other@example.com']
+        )
+        copy_message.attach_alternative(self.html, 'text/html')
+        copy_message.mime_builder = shared_message.mime_builder
+
+        shared_mime = shared_message.message()
+        copy_mime = copy_message.message()
+        self.assertIs(copy_mime.body, shared_mime.body)
+        self.assertEqual(copy_mime['To'], 'other@example.com')
+        # The body is serialized once per line separator and then reused
+        shared_mime.as_bytes(linesep='\r\n')
+        copy_mime.as_bytes(linesep='\r\n')
+        self.assertEqual(
+            set(shared_mime.body.serialized),
+            {(generator.BytesGenerator, '\n'), (generator.BytesGenerator, '\r\n')}
+        )
+        self.assertIs(shared_mime.body.as_bytes('\r\n'), copy_mime.body.as_bytes('\r\n'))
+        self.assertEqual(len(shared_message.mime_builder.bodies), 1)
+
+    def test_different_bodies(self):
+        django_message, shared_message = self.get_messages(EmailMessage, html=False)
+        other_message = EmailMessage(body='Other', to=['to@example.com'])
+        other_message.mime_builder = shared_message.mime_builder
+
+        self.assertIsNot(other_message.message().body, shared_message.message().body)
+        self.assertEqual(other_message.message().get_payload(), 'Other')
+
+    def test_attachments_built_by_django(self):
+        django_message, shared_message = self.get_messages(EmailMultiAlternatives)
+        shared_message.attach('test.txt', 'attachment', 'text/plain')
+
+        self.assertNotIsInstance(shared_message.message(), SharedBodyMIMEMessage)
+
+    def test_no_builder(self):
+        django_message, shared_message = self.get_messages(EmailMessage, html=False)
+
+        self.assertIsInstance(django_message.message(), MIMEText)
+        self.assertNotIsInstance(django_message.message(), SharedBodyMIMEMessage)
+
+    @override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend')
+    def test_send(self):
+        django_message, shared_message = self.get_messages(EmailMultiAlternatives)
+        shared_message.send()
+
+        self.assertEqual(mail.outbox, [shared_message])
@@ -1,12 +1,14 @@
 from datetime import datetime
 
 from django.test import TestCase
+from django.test.utils import override_settings
 from django_dynamic_fixture import G
 from entity.models import Entity
-from entity_event.models import Event
+from entity_event.models import Event, Source
 from freezegun import freeze_time
+from unittest.mock import patch
 
-from entity_emailer.models import Email
+from entity_emailer.models import DeliveryStats, Email, ExceptionFingerprint, RenderedBody
 
 
 class EmailManagerCreateEmailTest(TestCase):
@@ -51,3 +53,146 @@ class EmailManagerCreateEmailTest(TestCase):
         self.assertEqual(e.from_address, 'hi@hi.com')
         self.assertEqual(e.event.context, {'hi': 'hi'})
         self.assertIsNone(e.uid)
+
+
+@freeze_time('2013-2-3')
+@override_settings(ENTITY_EMAILER_SNAPSHOT_ADDRESSES=True)
+class EmailManagerSnapshotAddressesTest(TestCase):
+    def test_create_email(self):
+        e1 = G(Entity, entity_meta={'email': 'e1@example.com'})
+        e2 = G(Entity, entity_meta={})
+        email = Email.objects.create_email(recipients=[e1, e2], subject='hi', event=G(Event, context={}))
+
+        email.refresh_from_db()
+        self.assertEqual(email.to_addresses, ['e1@example.com'])
+        self.assertIsNone(email.sent)
+
+    def test_create_emails(self):
+        e1 = G(Entity, entity_meta={'email': 'e1@example.com'})
+        e2 = G(Entity, entity_meta={})
+        Email.objects.create_emails([
+            dict(recipients=[e1, e2], subject='hi', event=G(Event, context={})),
+            dict(recipients=[e2], subject='no address', event=G(Event, context={})),
+        ])
+
+        email = Email.objects.get(subject='hi')
+        self.assertEqual(email.to_addresses, ['e1@example.com'])
+        self.assertIsNone(email.sent)
+
+        # An email without any address is marked as sent right away
+        email = Email.objects.get(subject='no address')
+        self.assertEqual(email.to_addresses, [])
+        self.assertEqual(email.sent, datetime(2013, 2, 3))
+
+    @override_settings(ENTITY_EMAILER_SNAPSHOT_ADDRESSES=False)
+    def test_off(self):
+        e1 = G(Entity, entity_meta={'email': 'e1@example.com'})
+        email = Email.objects.create_email(recipients=[e1], subject='hi', event=G(Event, context={}))
+
+        email.refresh_from_db()
+        self.assertIsNone(email.to_addresses)
+
+
+class EmailManagerNotifyTest(TestCase):
+    @patch('entity_emailer.models.notify_emails_created')
+    def test_create_email_notifies(self, notify_mock):
+        Email.objects.create_email(subject='hi', event=G(Event, context={}))
+        notify_mock.assert_called_once_with(using='default')
+
+    @patch('entity_emailer.models.notify_emails_created')
+    def test_create_emails_notifies(self, notify_mock):
+        Email.objects.create_emails([dict(subject='hi', event=G(Event, context={}), recipients=[G(Entity)])])
+        notify_mock.assert_called_once_with(using='default')
+
+    @patch('entity_emailer.models.notify_emails_created')
+    def test_create_no_emails_does_not_notify(self, notify_mock):
+        self.assertEqual(Email.objects.create_emails([]), [])
+        notify_mock.assert_not_called()
+
+
+class RenderedBodyManagerTest(TestCase):
+    def test_store_bodies(self):
+        stored = RenderedBody.objects.create(hash=RenderedBody.get_hash('a', '<p>a</p>'), text='a', html='<p>a</p>')
+
+        body_ids = RenderedBody.objects.store_bodies([('a', '<p>a</p>'), ('b', ''), ('a', '<p>a</p>')])
+
+        self.assertEqual(RenderedBody.objects.count(), 2)
+        self.assertEqual(body_ids[0], stored.id)
+        self.assertEqual(body_ids[2], stored.id)
+        self.assertEqual(RenderedBody.objects.get(id=body_ids[1]).text, 'b')
+
+    def test_delete_unused(self):
+        used_id, unused_id = RenderedBody.objects.store_bodies([('a', ''), ('b', '')])
+        G(Email, event=G(Event, context={}), rendered_body=RenderedBody.objects.get(id=used_id))
+
+        RenderedBody.objects.delete_unused()
+
+        self.assertEqual(list(RenderedBody.objects.values_list('id', flat=True)), [used_id])
+
+
+class ExceptionFingerprintManagerTest(TestCase):
+    def test_get_fingerprint(self):
+        self.assertEqual(
+            ExceptionFingerprint.get_fingerprint('SMTPException', 'Rejected a@example.com after 30 seconds'),
+            ExceptionFingerprint.get_fingerprint('SMTPException', 'Rejected b@example.com after 5 seconds'),
+        )
+        self.assertNotEqual(
+            ExceptionFingerprint.get_fingerprint('SMTPException', 'Rejected'),
+            ExceptionFingerprint.get_fingerprint('ValueError', 'Rejected'),
+        )
+        self.assertNotEqual(
+            ExceptionFingerprint.get_fingerprint('SMTPException', 'Rejected'),
+            ExceptionFingerprint.get_fingerprint('SMTPException', 'Timed out'),
+        )
+
+    @freeze_time('2013-2-3')
+    def test_record(self):
+        with freeze_time('2013-2-1'):
+            existing_id = ExceptionFingerprint.objects.record([('ValueError', 'bad value 1')])[0]
+
+        fingerprint_ids = ExceptionFingerprint.objects.record([
+            ('ValueError', 'bad value 2'),
+            ('TypeError', 'bad type'),
+            ('ValueError', 'bad value 3'),
+        ])
+
+        self.assertEqual(fingerprint_ids[0], existing_id)
+        self.assertEqual(fingerprint_ids[2], existing_id)
+        existing = ExceptionFingerprint.objects.get(id=existing_id)
+        self.assertEqual(existing.message, 'bad value 1')
+        self.assertEqual(existing.count, 3)
+        self.assertEqual(existing.first_seen, datetime(2013, 2, 1))
+        self.assertEqual(existing.last_seen, datetime(2013, 2, 3))
+        self.assertEqual(ExceptionFingerprint.objects.get(id=fingerprint_ids[1]).count, 1)
+
+
+class EmailGetExceptionTest(TestCase):
+    def test_exception(self):
+        self.assertEqual(G(Email, event=G(Event, context={}), exception='error').get_exception(), 'error')
+        self.assertIsNone(G(Email, event=G(Event, context={})).get_exception())
+
+    def test_fingerprint(self):
+        fingerprint_id = ExceptionFingerprint.objects.record([('ValueError', 'bad value')])[0]
+        email = G(Email, event=G(Event, context={}), exception_fingerprint=ExceptionFingerprint.objects.get(
+            id=fingerprint_id
+        ))
+
+        self.assertEqual(email.get_exception(), 'bad value')
+
+
+class DeliveryStatsManagerTest(TestCase):
+    def test_increment(self):
+        source = G(Source)
+        other_source = G(Source)
+        hour = datetime(2013, 2, 3, 10)
+        DeliveryStats.objects.increment(hour, {(source.id, 'sent'): 2})
+
+        DeliveryStats.objects.increment(hour, {(source.id, 'sent'): 3, (other_source.id, 'failed'): 1})
+
+        self.assertEqual(
+            set(DeliveryStats.objects.values_list('hour', 'source_id', 'outcome', 'count')),
+            {(hour, source.id, 'sent', 5), (hour, other_source.id, 'failed', 1)},
+        )
+
+    def test_get_hour(self):
+        self.assertEqual(DeliveryStats.get_hour(datetime(2013, 2, 3, 10, 30, 5, 10)), datetime(2013, 2, 3, 10))
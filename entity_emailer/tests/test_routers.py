@@ -0,0 +1,17 @@
+from django.test import SimpleTestCase
+
+from entity_emailer.models import Email
+from entity_emailer.routers import ReadDatabaseRouter, read_from
+
+
+class ReadDatabaseRouterTest(SimpleTestCase):
+    def test_db_for_read(self):
+        router = ReadDatabaseRouter()
+
+        self.assertIsNone(router.db_for_read(Email))
+        with read_from('replica'):
+            self.assertEqual(router.db_for_read(Email), 'replica')
+            with read_from('default'):
+                self.assertEqual(router.db_for_read(Email), 'default')
+            self.assertEqual(router.db_for_read(Email), 'replica')
+        self.assertIsNone(router.db_for_read(Email))
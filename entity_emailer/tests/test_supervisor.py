@@ -0,0 +1,220 @@
+import json
+import queue
+from io import StringIO
+
+from django.core.management import call_command
+from django.test import SimpleTestCase
+from unittest.mock import patch
+
+from entity_emailer.supervisor import EmailerSupervisor, WorkerDaemon, run_worker
+
+
+class FakeProcess(object):
+    """
+    A worker process that sends the summary of one run when it is started and exits right away with ``exitcode``,
+    unless it is told to keep running. A terminated worker exits once it has been seen alive one more time.
+    """
+    def __init__(self, target, args, name, daemon, exitcode=0, keep_running=False):
+        self.target = target
+        self.args = args
+        self.name = name
+        self.daemon = daemon
+        self.exitcode = exitcode
+        self.keep_running = keep_running
+        self.alive = False
+        self.terminated = False
+
+    def start(self):
+        index, num_workers, daemon_options, stats_queue = self.args
+        stats_queue.put((index, {'processed': 2, 'sent': 1, 'failed': 1, 'remaining_due': 0}))
+        self.alive = self.keep_running
+
+    def is_alive(self):
+        alive = self.alive
+        if self.terminated:
+            self.alive = False
+        return alive
+
+    def join(self):
+        pass
+
+    def terminate(self):
+        self.terminated = True
+
+
+class FakeContext(object):
+    def __init__(self, exitcodes=None, keep_running=False):
+        self.exitcodes = list(exitcodes or [])
+        self.keep_running = keep_running
+        self.processes = []
+
+    def Queue(self):
+        return queue.Queue()
+
+    def Process(self, **kwargs):
+        exitcode = self.exitcodes.pop(0) if self.exitcodes else 0
+        process = FakeProcess(exitcode=exitcode, keep_running=self.keep_running, **kwargs)
+        self.processes.append(process)
+        return process
+
+
+@patch('entity_emailer.supervisor.connections')
+class EmailerSupervisorTest(SimpleTestCase):
+    def get_supervisor(self, context, num_workers=2, **kwargs):
+        supervisor = EmailerSupervisor(num_workers, context=context, **kwargs)
+        supervisor.poll_interval = 0
+        return supervisor
+
+    def test_run_until_workers_exit(self, connections_mock):
+        context = FakeContext()
+        supervisor = self.get_supervisor(context, daemon_options={'max_runs': 1})
+
+        stats = supervisor.run()
+
+        self.assertEqual(
+            [(process.name, process.args[:3], process.daemon) for process in context.processes],
+            [
+                ('entity_emailer_worker_0', (0, 2, {'max_runs': 1}), True),
+                ('entity_emailer_worker_1', (1, 2, {'max_runs': 1}), True),
+            ],
+        )
+        self.assertEqual(supervisor.finished, {0, 1})
+        self.assertEqual(connections_mock.close_all.call_count, 2)
+        self.assertEqual(
+            stats['workers'],
+            [{'runs': 1, 'processed': 2, 'sent': 1, 'failed': 1, 'crashes': 0}] * 2,
+        )
+        self.assertEqual(stats['total']['processed'], 4)
+        self.assertEqual(stats['total']['sent'], 2)
+
+    @patch('entity_emailer.supervisor.time.monotonic')
+    def test_restarts_crashed_worker(self, monotonic_mock, connections_mock):
+        monotonic_mock.return_value = 100.0
+        context = FakeContext(exitcodes=[1])
+        supervisor = self.get_supervisor(context, num_workers=1, restart_delay=5.0)
+
+        supervisor.check_workers()
+        supervisor.check_workers()
+
+        # The crashed worker waits for the restart delay
+        self.assertEqual(len(context.processes), 1)
+        self.assertEqual(supervisor.stats[0].crashes, 1)
+        supervisor.check_workers()
+        self.assertEqual(len(context.processes), 1)
+
+        monotonic_mock.return_value = 105.0
+        supervisor.check_workers()
+        self.assertEqual(len(context.processes), 2)
+        self.assertIsNot(supervisor.workers[0], context.processes[0])
+
+    def test_leaves_running_and_finished_workers(self, connections_mock):
+        context = FakeContext(keep_running=True)
+        supervisor = self.get_supervisor(context)
+        supervisor.check_workers()
+
+        context.processes[0].alive = False
+        supervisor.check_workers()
+        supervisor.check_workers()
+
+        self.assertEqual(len(context.processes), 2)
+        self.assertEqual(supervisor.finished, {0})
+        self.assertEqual(supervisor.workers, context.processes)
+
+    def test_stop_terminates_workers(self, connections_mock):
+        context = FakeContext(keep_running=True)
+        supervisor = self.get_supervisor(context)
+        supervisor.check_workers()
+
+        supervisor.stop()
+        stats = supervisor.run()
+
+        self.assertTrue(all(process.terminated for process in context.processes))
+        self.assertEqual(stats['total']['runs'], 2)
+
+    @patch('entity_emailer.supervisor.time.monotonic')
+    def test_get_stats(self, monotonic_mock, connections_mock):
+        supervisor = self.get_supervisor(FakeContext())
+        self.assertEqual(supervisor.get_stats()['total']['emails_per_second'], 0.0)
+
+        monotonic_mock.return_value = 10.0
+        supervisor.started = 8.0
+        supervisor.stats_queue.put((0, {'processed': 3, 'sent': 3, 'failed': 0, 'remaining_due': 0}))
+        supervisor.stats_queue.put((1, {'processed': 1, 'sent': 0, 'failed': 1, 'remaining_due': 0}))
+        supervisor.stats[1].crashes = 1
+        supervisor.collect_stats(0)
+
+        self.assertEqual(supervisor.get_stats()['total'], {
+            'runs': 2,
+            'processed': 4,
+            'sent': 3,
+            'failed': 1,
+            'crashes': 1,
+            'seconds': 2.0,
+            'emails_per_second': 2.0,
+        })
+
+    @patch('entity_emailer.supervisor.signal.signal')
+    def test_install_signal_handlers(self, signal_mock, connections_mock):
+        supervisor = self.get_supervisor(FakeContext())
+        supervisor.install_signal_handlers()
+
+        self.assertEqual(signal_mock.call_count, 2)
+        signal_mock.call_args[0][1]()
+        self.assertTrue(supervisor.stopping)
+
+
+class WorkerDaemonTest(SimpleTestCase):
+    @patch('entity_emailer.daemon.close_old_connections')
+    @patch('entity_emailer.daemon.EntityEmailerInterface.send_unsent_scheduled_emails')
+    def test_run_once_reports_summary(self, send_mock, close_mock):
+        stats_queue = queue.Queue()
+        daemon = WorkerDaemon(1, 3, stats_queue, time_budget=10)
+
+        summary = daemon.run_once()
+
+        self.assertEqual(send_mock.call_args[1]['shard'], (1, 3))
+        self.assertEqual(send_mock.call_args[1]['time_budget'], 10)
+        self.assertEqual(stats_queue.get_nowait(), (1, summary))
+
+    @patch('entity_emailer.supervisor.django.setup')
+    @patch('entity_emailer.supervisor.WorkerDaemon')
+    def test_run_worker(self, daemon_mock, setup_mock):
+        stats_queue = queue.Queue()
+        run_worker(0, 2, {'max_runs': 1}, stats_queue)
+
+        daemon_mock.assert_called_once_with(0, 2, stats_queue, max_runs=1)
+        daemon_mock.return_value.install_signal_handlers.assert_called_once_with()
+        daemon_mock.return_value.run.assert_called_once_with()
+        setup_mock.assert_not_called()
+
+    @patch('entity_emailer.supervisor.apps.ready', False)
+    @patch('entity_emailer.supervisor.django.setup')
+    @patch('entity_emailer.supervisor.WorkerDaemon')
+    def test_run_worker_sets_up_django(self, daemon_mock, setup_mock):
+        run_worker(0, 2, {}, queue.Queue())
+
+        setup_mock.assert_called_once_with()
+
+
+class RunEntityEmailerWorkersCommandTest(SimpleTestCase):
+    @patch('entity_emailer.management.commands.run_entity_emailer_workers.EmailerSupervisor')
+    def test_options(self, supervisor_mock):
+        supervisor_mock.return_value.run.return_value = {'total': {'processed': 0}}
+        stdout = StringIO()
+
+        call_command('run_entity_emailer_workers', '--workers', '4', '--max-runs', '3', stdout=stdout)
+
+        supervisor_mock.assert_called_once_with(
+            num_workers=4,
+            daemon_options={
+                'min_interval': 0.5,
+                'max_interval': 30.0,
+                'backoff': 2.0,
+                'listen': False,
+                'max_runs': 3,
+                'time_budget': None,
+            },
+            restart_delay=1.0,
+        )
+        supervisor_mock.return_value.install_signal_handlers.assert_called_once_with()
+        self.assertEqual(json.loads(stdout.getvalue()), {'total': {'processed': 0}})
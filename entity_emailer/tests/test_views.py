@@ -1,10 +1,27 @@
-from django.urls import reverse
+from datetime import datetime
+import importlib
+from unittest import skipUnless
+
+import django
+from django.core.cache import cache
+from django.urls import clear_url_caches, resolve, reverse
 from django.test import TestCase
+from django.test.utils import override_settings
 from django_dynamic_fixture import G
 from entity.models import Entity
 from entity_event.models import Medium, RenderingStyle, ContextRenderer, Source, Event
+from unittest.mock import patch
 
+from entity_emailer.models import Email, RenderedBody
+from entity_emailer.routers import read_database
 from entity_emailer.tests.utils import g_email
+from entity_emailer import urls
+from entity_emailer.views import AsyncEmailView, EmailView
+
+
+def reload_urls():
+    clear_url_caches()
+    importlib.reload(urls)
 
 
 class EmailViewTest(TestCase):
@@ -73,3 +90,248 @@ class EmailViewTest(TestCase):
         content = content.decode('utf8')
 
         self.assertEqual(content, '<html>Hi Swansonbot</html>')
+
+    def test_stored_body(self):
+        body_id = RenderedBody.objects.store_bodies([('Hi', '<html>Hi Stored</html>')])[0]
+        email = g_email(context={}, rendered_body=RenderedBody.objects.get(id=body_id))
+
+        with patch('entity_emailer.views.context_loader.load_contexts_and_renderers') as load_mock:
+            response = self.client.get(reverse('entity_emailer.email', args=[email.view_uid]))
+
+        load_mock.assert_not_called()
+        self.assertEqual(response.content.decode('utf8'), '<html>Hi Stored</html>')
+
+
+class EmailViewGetEmailTest(TestCase):
+    def test_only_loads_needed_columns(self):
+        email = g_email(context={}, subject='hi', exception='error')
+        view_email = EmailView(args=[str(email.view_uid)]).get_email()
+
+        self.assertEqual(view_email, email)
+        self.assertEqual(view_email.get_deferred_fields(), {'subject', 'from_address', 'uid', 'scheduled',
+                                                            'num_tries', 'exception', 'delivered_addresses',
+                                                            'claimed', 'attempt', 'to_addresses',
+                                                            'exception_fingerprint_id'})
+        with self.assertNumQueries(0):
+            self.assertEqual(view_email.event.source.group_id, email.event.source.group_id)
+
+
+@override_settings(ENTITY_EMAILER_READ_DATABASE='replica')
+class EmailViewReadDatabaseTest(TestCase):
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        self.email = g_email(context={})
+
+    def replicate(self, *instances):
+        for instance in instances:
+            instance.save(using='replica', force_insert=True)
+
+    def test_reads_from_replica(self):
+        source = self.email.event.source
+        self.replicate(source.group, source, self.email.event, self.email)
+
+        view_email = EmailView(args=[str(self.email.view_uid)]).get_email()
+
+        self.assertEqual(view_email, self.email)
+        self.assertEqual(view_email._state.db, 'replica')
+
+    def test_falls_back_to_default(self):
+        view_email = EmailView(args=[str(self.email.view_uid)]).get_email()
+
+        self.assertEqual(view_email, self.email)
+        self.assertEqual(view_email._state.db, 'default')
+
+    def test_missing(self):
+        with self.assertRaises(Email.DoesNotExist):
+            EmailView(args=['00000000-0000-0000-0000-000000000000']).get_email()
+
+        with self.settings(ENTITY_EMAILER_READ_DATABASE=None):
+            with self.assertRaises(Email.DoesNotExist):
+                EmailView(args=['00000000-0000-0000-0000-000000000000']).get_email()
+
+    @patch('entity_emailer.views.get_medium')
+    def test_loads_contexts_from_email_database(self, medium_mock):
+        def load_contexts_and_renderers(events, mediums):
+            self.assertEqual(read_database.get(), 'default')
+            self.email.event._context_renderers = {}
+        view = EmailView(args=[str(self.email.view_uid)])
+
+        with patch('entity_emailer.views.context_loader.load_contexts_and_renderers') as load_mock, \
+                patch.object(Email, 'render', return_value=('text', '')):
+            load_mock.side_effect = load_contexts_and_renderers
+            self.assertEqual(view.render_email(view.get_email())['content'], 'text')
+
+        self.assertEqual(load_mock.call_count, 1)
+        self.assertIsNone(read_database.get())
+
+
+class EmailViewCacheTest(TestCase):
+    def setUp(self):
+        self.rendering_style = G(RenderingStyle, name='email')
+        G(Medium, name='email', rendering_style=self.rendering_style)
+        self.source = G(Source)
+        G(
+            ContextRenderer, source=self.source, html_template_path='hi_template.html',
+            rendering_style=self.rendering_style, context_hints={
+                'entity': {
+                    'app_name': 'entity',
+                    'model_name': 'Entity',
+                }
+            })
+        self.person = G(Entity, display_name='Swansonbot')
+        self.event = G(Event, context={'entity': self.person.id}, source=self.source)
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    def test_sent_email_is_cached(self):
+        email = g_email(event=self.event, sent=datetime(2014, 1, 5, 10))
+        url = reverse('entity_emailer.email', args=[email.view_uid])
+        response = self.client.get(url)
+
+        self.person.display_name = 'Changed'
+        self.person.save()
+        with self.assertNumQueries(0):
+            cached_response = self.client.get(url)
+
+        self.assertEqual(cached_response.content.decode('utf8'), '<html>Hi Swansonbot</html>')
+        self.assertEqual(cached_response['ETag'], response['ETag'])
+        self.assertEqual(cached_response['Last-Modified'], 'Sun, 05 Jan 2014 10:00:00 GMT')
+
+    def test_unsent_email_is_not_cached(self):
+        email = g_email(event=self.event)
+        url = reverse('entity_emailer.email', args=[email.view_uid])
+        response = self.client.get(url)
+
+        self.person.display_name = 'Changed'
+        self.person.save()
+        uncached_response = self.client.get(url)
+
+        self.assertEqual(uncached_response.content.decode('utf8'), '<html>Hi Changed</html>')
+        self.assertNotEqual(uncached_response['ETag'], response['ETag'])
+        self.assertFalse(response.has_header('Last-Modified'))
+
+    @override_settings(ENTITY_EMAILER_VIEW_CACHE_TIMEOUT=0)
+    def test_caching_disabled(self):
+        email = g_email(event=self.event, sent=datetime(2014, 1, 5, 10))
+        url = reverse('entity_emailer.email', args=[email.view_uid])
+        self.client.get(url)
+
+        self.person.display_name = 'Changed'
+        self.person.save()
+        response = self.client.get(url)
+
+        self.assertEqual(response.content.decode('utf8'), '<html>Hi Changed</html>')
+
+    def test_if_none_match(self):
+        email = g_email(event=self.event, sent=datetime(2014, 1, 5, 10))
+        url = reverse('entity_emailer.email', args=[email.view_uid])
+        etag = self.client.get(url)['ETag']
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+        self.assertEqual(response['ETag'], etag)
+
+    def test_if_none_match_changed(self):
+        email = g_email(event=self.event, sent=datetime(2014, 1, 5, 10))
+        url = reverse('entity_emailer.email', args=[email.view_uid])
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH='"stale"')
+
+        self.assertEqual(response.status_code, 200)
+
+    def test_if_modified_since(self):
+        email = g_email(event=self.event, sent=datetime(2014, 1, 5, 10))
+        url = reverse('entity_emailer.email', args=[email.view_uid])
+
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE='Sun, 05 Jan 2014 10:00:00 GMT')
+        self.assertEqual(response.status_code, 304)
+
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE='Sun, 05 Jan 2014 09:00:00 GMT')
+        self.assertEqual(response.status_code, 200)
+
+
+@skipUnless(django.VERSION >= (4, 1), 'Async class based views require django 4.1')
+class AsyncEmailViewTest(TestCase):
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        self.rendering_style = G(RenderingStyle, name='email')
+        G(Medium, name='email', rendering_style=self.rendering_style)
+        self.source = G(Source)
+        G(
+            ContextRenderer, source=self.source, html_template_path='hi_template.html',
+            rendering_style=self.rendering_style, context_hints={
+                'entity': {
+                    'app_name': 'entity',
+                    'model_name': 'Entity',
+                }
+            })
+        self.person = G(Entity, display_name='Swansonbot')
+        self.event = G(Event, context={'entity': self.person.id}, source=self.source)
+        self.email = g_email(event=self.event)
+        self.sent_email = g_email(event=self.event, sent=datetime(2014, 1, 5, 10))
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+        with self.settings(ENTITY_EMAILER_ASYNC_VIEW=True):
+            reload_urls()
+        self.addCleanup(reload_urls)
+
+    async def get(self, email, **headers):
+        return await self.async_client.get(reverse('entity_emailer.email', args=[email.view_uid]), **headers)
+
+    async def test_renders_email(self):
+        response = await self.get(self.email)
+
+        self.assertEqual(response.content.decode('utf8'), '<html>Hi Swansonbot</html>')
+        self.assertFalse(response.has_header('Last-Modified'))
+
+    async def test_sent_email_is_cached(self):
+        response = await self.get(self.sent_email)
+
+        await Entity.objects.filter(id=self.person.id).aupdate(display_name='Changed')
+        cached_response = await self.get(self.sent_email)
+        not_modified_response = await self.get(self.sent_email, **{'If-None-Match': response['ETag']})
+
+        self.assertEqual(cached_response.content.decode('utf8'), '<html>Hi Swansonbot</html>')
+        self.assertEqual(cached_response['Last-Modified'], 'Sun, 05 Jan 2014 10:00:00 GMT')
+        self.assertEqual(not_modified_response.status_code, 304)
+
+    @override_settings(ENTITY_EMAILER_READ_DATABASE='replica')
+    async def test_falls_back_to_default(self):
+        response = await self.get(self.email)
+
+        self.assertEqual(response.content.decode('utf8'), '<html>Hi Swansonbot</html>')
+
+    async def test_missing(self):
+        view = AsyncEmailView(args=['00000000-0000-0000-0000-000000000000'])
+        with self.assertRaises(Email.DoesNotExist):
+            await view.aget_email()
+
+        with self.settings(ENTITY_EMAILER_READ_DATABASE='replica'):
+            with self.assertRaises(Email.DoesNotExist):
+                await view.aget_email()
+
+
+class EmailUrlsTest(TestCase):
+    def test_sync_view(self):
+        self.assertIs(resolve(reverse('entity_emailer.email', args=['abc'])).func.view_class, EmailView)
+
+    @patch.object(django, 'VERSION', (4, 1, 0, 'final', 0))
+    def test_async_view(self):
+        self.addCleanup(reload_urls)
+        with self.settings(ENTITY_EMAILER_ASYNC_VIEW=True):
+            reload_urls()
+
+            self.assertIs(resolve(reverse('entity_emailer.email', args=['abc'])).func.view_class, AsyncEmailView)
+
+    @patch.object(django, 'VERSION', (4, 0, 10, 'final', 0))
+    def test_async_view_before_django_4_1(self):
+        self.addCleanup(reload_urls)
+        with self.settings(ENTITY_EMAILER_ASYNC_VIEW=True):
+            reload_urls()
+
+            self.assertIs(resolve(reverse('entity_emailer.email', args=['abc'])).func.view_class, EmailView)
@@ -1,8 +1,16 @@
-from django.test import TestCase
+from datetime import datetime
+
+from django.test import SimpleTestCase, TestCase
+from django.test.utils import override_settings
 from django_dynamic_fixture import G
 from entity_event.models import Medium, Source
+from unittest.mock import MagicMock, patch
 
-from entity_emailer.utils import get_medium, get_admin_source
+from entity_emailer.backends.base import BatchResultsMixin
+from entity_emailer.backends.http import EmailBackend as HTTPEmailBackend
+from entity_emailer.models import Email
+from entity_emailer.tests.utils import g_email
+from entity_emailer.utils import count_rows, get_medium, get_admin_source, get_results_chunk_size, get_stop_time
 
 
 class GetMediumTest(TestCase):
@@ -33,3 +41,67 @@ class GetAdminSourceTest(TestCase):
         with self.settings(ENTITY_EMAILER_ADMIN_SOURCE_NAME=custom_admin_source_name):
             admin_source = get_admin_source()
         self.assertEqual(admin_source.name, custom_admin_source_name)
+
+
+@patch('entity_emailer.utils.time.monotonic', return_value=100)
+class GetStopTimeTest(SimpleTestCase):
+    def test_no_limit(self, monotonic_mock):
+        self.assertIsNone(get_stop_time(datetime(2014, 1, 5)))
+
+    def test_time_budget(self, monotonic_mock):
+        self.assertEqual(get_stop_time(datetime(2014, 1, 5), time_budget=30), 130)
+
+    def test_deadline(self, monotonic_mock):
+        self.assertEqual(get_stop_time(datetime(2014, 1, 5), deadline=datetime(2014, 1, 5, 0, 1)), 160)
+
+    def test_earliest_limit(self, monotonic_mock):
+        self.assertEqual(
+            get_stop_time(datetime(2014, 1, 5), time_budget=30, deadline=datetime(2014, 1, 5, 0, 0, 10)),
+            110,
+        )
+
+
+class GetResultsChunkSizeTest(SimpleTestCase):
+    def test_default(self):
+        self.assertEqual(get_results_chunk_size(), 100)
+        self.assertEqual(get_results_chunk_size(BatchResultsMixin()), 100)
+
+    def test_backend_chunk_size(self):
+        self.assertEqual(get_results_chunk_size(HTTPEmailBackend(url='http://localhost/')), 400)
+
+    @override_settings(ENTITY_EMAILER_RESULTS_CHUNK_SIZE=50)
+    def test_setting(self):
+        self.assertEqual(get_results_chunk_size(HTTPEmailBackend(url='http://localhost/')), 50)
+
+
+class CountRowsTest(TestCase):
+    def setUp(self):
+        g_email(context={})
+        g_email(context={})
+
+    def test_count(self):
+        self.assertEqual(count_rows(Email.objects.all(), threshold=1), (2, False))
+
+    def mock_postgres(self, connections_mock, plan):
+        connection = connections_mock.__getitem__.return_value
+        connection.vendor = 'postgresql'
+        cursor = connection.cursor.return_value.__enter__.return_value
+        cursor.fetchone.return_value = (plan,)
+        return cursor
+
+    @patch('entity_emailer.utils.connections')
+    def test_estimate(self, connections_mock):
+        cursor = self.mock_postgres(connections_mock, [{'Plan': {'Plan Rows': 20000}}])
+
+        self.assertEqual(count_rows(Email.objects.filter(num_tries=0), threshold=10000), (20000, True))
+        self.assertTrue(cursor.execute.call_args[0][0].startswith('EXPLAIN (FORMAT JSON) SELECT'))
+
+    @patch('entity_emailer.utils.connections')
+    def test_small_estimate_counted(self, connections_mock):
+        self.mock_postgres(connections_mock, '[{"Plan": {"Plan Rows": 5}}]')
+
+        self.assertEqual(count_rows(Email.objects.all(), threshold=10000), (2, False))
+
+    @patch('entity_emailer.utils.connections', MagicMock())
+    def test_no_threshold(self):
+        self.assertEqual(count_rows(Email.objects.all()), (2, False))
@@ -1,8 +1,14 @@
+import django
 from django.urls import re_path
 
-from entity_emailer.views import EmailView
+from entity_emailer.utils import get_async_email_view
+from entity_emailer.views import AsyncEmailView, EmailView
 
 
+# The async view is served instead when ENTITY_EMAILER_ASYNC_VIEW is set, under the same url name. Django versions
+# before 4.1 can not serve async class based views, so they keep serving the sync view.
+email_view = AsyncEmailView if get_async_email_view() and django.VERSION >= (4, 1) else EmailView
+
 urlpatterns = [
-    re_path(r'^([0-9a-z\-]+)/$', EmailView.as_view(), name='entity_emailer.email'),
+    re_path(r'^([0-9a-z\-]+)/$', email_view.as_view(), name='entity_emailer.email'),
 ]
@@ -1,22 +1,40 @@
+import copy
+import json
+import time
+
 from bs4 import BeautifulSoup
 from django.conf import settings
-from django.core import mail
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.utils.module_loading import import_string
 from entity_event.models import Medium, Source
 
+from entity_emailer.backends.base import BatchResultsMixin
+from entity_emailer.cache import get_address_cache, get_entity_address
+from entity_emailer.mime import EmailMessage, EmailMultiAlternatives
+
 
 constants = {
     'default_medium_name': 'email',
     'default_admin_source_name': 'admin',
 }
 
+RECIPIENT_MODES = ('to', 'individual', 'bcc')
+
+# How emails are handled whose sender stopped after handing them to the backend but before saving the result
+STALE_ATTEMPT_POLICIES = ('resend', 'uncertain', 'check')
+
+
+def get_medium_name():
+    """Get the name of the medium that the emailer associates with itself.
+    """
+    return getattr(settings, 'ENTITY_EMAILER_MEDIUM_NAME', constants['default_medium_name'])
+
 
 def get_medium():
     """Get the medium object that the emailer associates with itself.
     """
-    email_medium_name = getattr(
-        settings, 'ENTITY_EMAILER_MEDIUM_NAME', constants['default_medium_name']
-    )
-    email_medium = Medium.objects.get(name=email_medium_name)
+    email_medium = Medium.objects.get(name=get_medium_name())
     return email_medium
 
 
@@ -37,6 +55,202 @@ def get_from_email_address():
     return getattr(settings, 'ENTITY_EMAILER_FROM_EMAIL', settings.DEFAULT_FROM_EMAIL)
 
 
+def get_email_view_cache():
+    """
+    Get the alias of the cache that rendered emails are stored in for the email view.
+    """
+    return getattr(settings, 'ENTITY_EMAILER_VIEW_CACHE', 'default')
+
+
+def get_email_view_cache_timeout():
+    """
+    Get the number of seconds that rendered emails are cached for the email view. A value of 0 disables caching.
+    """
+    return getattr(settings, 'ENTITY_EMAILER_VIEW_CACHE_TIMEOUT', 3600)
+
+
+def get_max_recipients_per_message():
+    """
+    Get the largest number of recipients that a single sent message may have, or None if there is no limit.
+    """
+    return getattr(settings, 'ENTITY_EMAILER_MAX_RECIPIENTS_PER_MESSAGE', None)
+
+
+def get_recipient_mode():
+    """
+    Get how the recipients of an email are addressed when it is sent. One of 'to', 'individual' or 'bcc'.
+    """
+    recipient_mode = getattr(settings, 'ENTITY_EMAILER_RECIPIENT_MODE', 'to')
+    if recipient_mode not in RECIPIENT_MODES:
+        raise ImproperlyConfigured(
+            'ENTITY_EMAILER_RECIPIENT_MODE must be one of {0}'.format(', '.join(RECIPIENT_MODES))
+        )
+    return recipient_mode
+
+
+def get_results_chunk_size(connection=None):
+    """
+    Get the number of emails that are handed to the email backend at once before their results are saved, which
+    bounds how many delivered emails are sent again when a sender stops in the middle of a batch. When it is not
+    set, backends that send several requests at once get chunks large enough to keep every request busy.
+    """
+    chunk_size = getattr(settings, 'ENTITY_EMAILER_RESULTS_CHUNK_SIZE', None)
+    if chunk_size is not None:
+        return chunk_size
+    if isinstance(connection, BatchResultsMixin) and connection.results_chunk_size:
+        return max(100, connection.results_chunk_size)
+    return 100
+
+
+def get_claim_timeout():
+    """
+    Get the number of seconds after which the claim of a sender on an email expires, or None if emails are not
+    claimed before they are sent.
+    """
+    return getattr(settings, 'ENTITY_EMAILER_CLAIM_TIMEOUT', None)
+
+
+def get_stale_attempt_policy():
+    """
+    Get how emails are reconciled when their sender stopped while sending them. One of 'resend', 'uncertain'
+    or 'check'.
+    """
+    policy = getattr(settings, 'ENTITY_EMAILER_STALE_ATTEMPT_POLICY', 'resend')
+    if policy not in STALE_ATTEMPT_POLICIES:
+        raise ImproperlyConfigured(
+            'ENTITY_EMAILER_STALE_ATTEMPT_POLICY must be one of {0}'.format(', '.join(STALE_ATTEMPT_POLICIES))
+        )
+    return policy
+
+
+def get_attempt_checker():
+    """
+    Get the function that is given the emails of stale attempts and returns the ids of those that were delivered
+    """
+    checker = getattr(settings, 'ENTITY_EMAILER_ATTEMPT_CHECKER', None)
+    if checker is None:
+        raise ImproperlyConfigured(
+            'ENTITY_EMAILER_ATTEMPT_CHECKER must be set when ENTITY_EMAILER_STALE_ATTEMPT_POLICY is check'
+        )
+    return import_string(checker) if isinstance(checker, str) else checker
+
+
+def get_stop_time(current_time, time_budget=None, deadline=None):
+    """
+    Get the ``time.monotonic`` time at which a run that started at the utc datetime ``current_time`` has used up
+    its time budget in seconds or reached its utc datetime deadline, or None if it has neither.
+    """
+    seconds = [time_budget] if time_budget is not None else []
+    if deadline is not None:
+        seconds.append((deadline - current_time).total_seconds())
+    return time.monotonic() + min(seconds) if seconds else None
+
+
+def get_queue_events():
+    """
+    Get whether created events are queued to be converted by EntityEmailerInterface.convert_pending_events
+    """
+    return getattr(settings, 'ENTITY_EMAILER_QUEUE_EVENTS', False)
+
+
+def get_notify_channel():
+    """
+    Get the postgres channel that is notified when emails are created, or None if notifications are disabled.
+    """
+    return getattr(settings, 'ENTITY_EMAILER_NOTIFY_CHANNEL', None)
+
+
+def notify_emails_created(using=DEFAULT_DB_ALIAS):
+    """
+    Send a postgres NOTIFY on the configured channel so that listening senders wake up right away. The
+    notification is only delivered once the surrounding transaction commits. This is a no-op on other databases.
+    """
+    channel = get_notify_channel()
+    connection = connections[using]
+    if channel and connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('NOTIFY {0}'.format(connection.ops.quote_name(channel)))
+
+
+def get_snapshot_addresses():
+    """
+    Get whether the email addresses of the recipients are resolved and saved on emails when they are created
+    """
+    return getattr(settings, 'ENTITY_EMAILER_SNAPSHOT_ADDRESSES', False)
+
+
+def get_resolve_addresses_on_retry():
+    """
+    Get whether the email addresses saved on an email are resolved again from its recipients when it is retried
+    """
+    return getattr(settings, 'ENTITY_EMAILER_RESOLVE_ADDRESSES_ON_RETRY', False)
+
+
+def get_prerender():
+    """
+    Get whether the bodies of emails are rendered and stored when they are created
+    """
+    return getattr(settings, 'ENTITY_EMAILER_PRERENDER', False)
+
+
+def get_deduplicate_exceptions():
+    """
+    Get whether the exceptions of emails are stored once per fingerprint instead of on every email
+    """
+    return getattr(settings, 'ENTITY_EMAILER_DEDUPLICATE_EXCEPTIONS', False)
+
+
+def get_record_delivery_stats():
+    """
+    Get whether the number of emails sent and failed are counted in DeliveryStats as they are sent
+    """
+    return getattr(settings, 'ENTITY_EMAILER_DELIVERY_STATS', False)
+
+
+def get_approximate_count_threshold():
+    """
+    Get the number of rows above which the queue health counts use the estimate of the postgres planner instead of
+    counting rows, or None to always count them.
+    """
+    return getattr(settings, 'ENTITY_EMAILER_APPROXIMATE_COUNT_THRESHOLD', 10000)
+
+
+def count_rows(queryset, threshold=None):
+    """
+    Returns the number of rows of the queryset along with whether the number is approximate. On postgres, the
+    number of rows estimated by the planner from the table statistics is used when it is at least the threshold,
+    so that large counts do not have to read every row. Smaller counts and other databases count the rows.
+    """
+    connection = connections[queryset.db]
+    if threshold is not None and connection.vendor == 'postgresql':
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN (FORMAT JSON) {0}'.format(sql), params)
+            plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        estimate = int(plan[0]['Plan']['Plan Rows'])
+        if estimate >= threshold:
+            return estimate, True
+
+    return queryset.count(), False
+
+
+def get_read_database():
+    """
+    Get the alias of the database that read only queries, such as those of the email view and of reporting, are sent
+    to. This is usually a read replica and defaults to the default database.
+    """
+    return getattr(settings, 'ENTITY_EMAILER_READ_DATABASE', None) or DEFAULT_DB_ALIAS
+
+
+def get_async_email_view():
+    """
+    Get whether the entity emailer urls serve emails with the async email view
+    """
+    return getattr(settings, 'ENTITY_EMAILER_ASYNC_VIEW', False)
+
+
 def get_subscribed_email_addresses(email):
     """
     Given the email recipients, get the email address from the entity metadata.
@@ -45,27 +259,33 @@ def get_subscribed_email_addresses(email):
 
     If the user wishes to exclude certain entities from receiving emails, they can define
     which field in the entity metadata to use with the EXCLUDE_ENTITY_EMAILER_KEY field.
+
+    When the entity address cache is turned on with ENTITY_EMAILER_ADDRESS_CACHE_SIZE, the addresses are looked up in
+    the cache by recipient id, or taken from the ``recipient_addresses`` that were resolved for a whole batch.
     """
+    address_cache = get_address_cache()
+    if address_cache is None:
+        return get_email_addresses(email.recipients.all())
 
-    # Get the key to use to find the email address
-    email_key = getattr(settings, 'ENTITY_EMAILER_EMAIL_KEY', 'email')
+    recipient_addresses = getattr(email, 'recipient_addresses', None)
+    if recipient_addresses is None:
+        recipient_addresses = address_cache.resolve(email.recipients.values_list('id', flat=True))
+    return [
+        email_address
+        for email_address, excluded in recipient_addresses.values()
+        if email_address and not excluded
+    ]
 
-    # Get the exclude key
-    exclude_entity_key = getattr(settings, 'ENTITY_EMAILER_EXCLUDE_KEY', None)
 
-    # Get the email addresses from the recipient entities
+def get_email_addresses(entities):
+    """
+    Get the email addresses of the entities from their metadata, in the same way as get_subscribed_email_addresses
+    """
     email_addresses = []
-    for entity in email.recipients.all():
-        # Get the email address out of the entity meta data
-        email_address = entity.entity_meta.get(email_key, None)
-
-        # Make sure the email address exists and is not an empty string
-        if email_address is not None and len(email_address):
-            # If the exclude entity key is not set, or is set but the value is not none
-            if not exclude_entity_key or entity.entity_meta.get(exclude_entity_key):
-                email_addresses.append(email_address)
-
-    # Return the email addresses
+    for entity in entities:
+        email_address, excluded = get_entity_address(entity.entity_meta)
+        if email_address and not excluded:
+            email_addresses.append(email_address)
     return email_addresses
 
 
@@ -75,19 +295,20 @@ def create_email_message(to_emails, from_email, subject, text, html):
 
     Returns:
 
-       email - an instance of either `django.core.mail.EmailMessage` or
-       `django.core.mail.EmailMulitiAlternatives` based on whether or
-       not `html_message` is empty.
+       email - an instance of either `entity_emailer.mime.EmailMessage` or
+       `entity_emailer.mime.EmailMultiAlternatives` based on whether or
+       not `html_message` is empty. These are the django classes extended
+       to share their encoded body with copies sent in the same batch.
     """
     if not html:
-        email = mail.EmailMessage(
+        email = EmailMessage(
             subject=subject,
             body=text,
             to=to_emails,
             from_email=from_email,
         )
     else:
-        email = mail.EmailMultiAlternatives(
+        email = EmailMultiAlternatives(
             subject=subject,
             body=text,
             to=to_emails,
@@ -97,6 +318,45 @@ def create_email_message(to_emails, from_email, subject, text, html):
     return email
 
 
+def split_email_message(email_message, max_recipients=None, recipient_mode='to'):
+    """
+    Split a message addressed to many recipients into messages that each have at most ``max_recipients``
+    recipients.
+
+    In 'to' mode each message has a chunk of the recipients in its to list. In 'individual' mode one message is
+    made per recipient. In 'bcc' mode each message has a chunk of the recipients in its bcc list and an empty to
+    list. Any cc and bcc addresses of the original message are kept on the first message only.
+
+    The messages are shallow copies of the original, so the body and alternatives are shared between them
+    rather than copied.
+
+    Returns a list of (message, to addresses) tuples. The original message is returned unchanged when it does
+    not need to be split.
+    """
+    addresses = list(email_message.to)
+    chunk_size = 1 if recipient_mode == 'individual' else max_recipients or len(addresses) or 1
+    chunks = [addresses[i:i + chunk_size] for i in range(0, len(addresses), chunk_size)] or [[]]
+
+    if recipient_mode != 'bcc' and len(chunks) == 1:
+        return [(email_message, addresses)]
+
+    messages = []
+    for i, chunk in enumerate(chunks):
+        chunk_message = copy.copy(email_message)
+        chunk_message.extra_headers = dict(email_message.extra_headers)
+        chunk_message.cc = list(email_message.cc) if i == 0 else []
+        original_bcc = list(email_message.bcc) if i == 0 else []
+        if recipient_mode == 'bcc':
+            chunk_message.to = []
+            chunk_message.bcc = original_bcc + chunk
+        else:
+            chunk_message.to = chunk
+            chunk_message.bcc = original_bcc
+        messages.append((chunk_message, chunk))
+
+    return messages
+
+
 def extract_email_subject_from_html_content(email_content):
     """
     This function extracts an email subject from the rendered html email context.
@@ -1,22 +1,145 @@
+import calendar
+import hashlib
+
+from asgiref.sync import sync_to_async
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS
 from django.http import HttpResponse
+from django.utils.cache import get_conditional_response, quote_etag
+from django.utils.http import http_date
 from django.views.generic import View
 from entity_event import context_loader
+from entity_event.models import Medium
 
 from entity_emailer.models import Email
-from entity_emailer.utils import get_medium
+from entity_emailer.routers import read_from
+from entity_emailer.utils import get_medium, get_medium_name, get_email_view_cache, get_email_view_cache_timeout, \
+    get_read_database
 
 
 class EmailView(View):
     """
     Provides a basic view for emails that utilizes the html or text templates for rendering.
     Note that it is assumed a url argument of the email view_uid is passed in.
+
+    Sent emails always render the same content, so their rendered content is cached for
+    ENTITY_EMAILER_VIEW_CACHE_TIMEOUT seconds. Responses carry ETag and Last-Modified headers
+    so that repeat views can be answered with 304 Not Modified. Emails that were rendered ahead of sending are served
+    from their stored body.
+
+    Emails are read from the ENTITY_EMAILER_READ_DATABASE, and from the default database when they were not
+    replicated yet. The contexts of their events are loaded from the same database.
     """
     def get(self, request, *args, **kwargs):
-        email = self.get_email()
-        medium = get_medium()
-        context_loader.load_contexts_and_renderers([email.event], [medium])
-        txt, html = email.render(medium)
-        return HttpResponse(html if html else txt)
+        return self.get_response(request, self.get_rendered_email())
+
+    def get_response(self, request, rendered_email):
+        response = HttpResponse(rendered_email['content'])
+        response['ETag'] = quote_etag(rendered_email['etag'])
+        if rendered_email['last_modified'] is not None:
+            response['Last-Modified'] = http_date(rendered_email['last_modified'])
+
+        return get_conditional_response(
+            request,
+            etag=response['ETag'],
+            last_modified=rendered_email['last_modified'],
+            response=response,
+        )
+
+    def get_email_queryset(self):
+        # Only load the columns that are needed to render the email
+        return Email.objects.select_related(
+            'event__source',
+            'rendered_body',
+        ).only(
+            'view_uid',
+            'sent',
+            'event__context',
+            'event__source__group',
+            'rendered_body__text',
+            'rendered_body__html',
+        )
 
     def get_email(self):
-        return Email.objects.select_related('event').get(view_uid=self.args[0])
+        emails = self.get_email_queryset()
+        read_database = get_read_database()
+        try:
+            return emails.using(read_database).get(view_uid=self.args[0])
+        except Email.DoesNotExist:
+            if read_database == DEFAULT_DB_ALIAS:
+                raise
+            # The email may have been created after the last change that reached the read database
+            return emails.using(DEFAULT_DB_ALIAS).get(view_uid=self.args[0])
+
+    def get_cache_key(self):
+        return 'entity_emailer.email_view.{0}'.format(self.args[0])
+
+    def get_rendered_email(self):
+        """
+        Returns the rendered email content along with its etag and last modified timestamp, using the
+        cached copy when one exists.
+        """
+        cache = caches[get_email_view_cache()]
+        cache_key = self.get_cache_key()
+        rendered_email = cache.get(cache_key)
+        if rendered_email is None:
+            email = self.get_email()
+            rendered_email = self.render_email(email)
+
+            # Only sent emails are cached since they are the only ones that are guaranteed not to change
+            timeout = get_email_view_cache_timeout()
+            if email.sent is not None and timeout:
+                cache.set(cache_key, rendered_email, timeout)
+
+        return rendered_email
+
+    def render_email(self, email, medium=None):
+        medium = medium or get_medium()
+        if email.rendered_body_id is None:
+            with read_from(email._state.db):
+                context_loader.load_contexts_and_renderers([email.event], [medium])
+        txt, html = email.render(medium)
+        content = html if html else txt
+        return {
+            'content': content,
+            'etag': hashlib.md5(content.encode('utf-8')).hexdigest(),
+            'last_modified': calendar.timegm(email.sent.utctimetuple()) if email.sent else None,
+        }
+
+
+class AsyncEmailView(EmailView):
+    """
+    The email view for ASGI deployments. The email, the medium and the cached content are looked up with the
+    async apis of django, so that a request only occupies a thread while the contexts of the event are loaded and
+    the email is rendered, which django-entity-event only supports synchronously. Requires django 4.1 or later,
+    which is the first version that serves async class based views.
+    """
+    async def get(self, request, *args, **kwargs):
+        return self.get_response(request, await self.aget_rendered_email())
+
+    async def aget_email(self):
+        emails = self.get_email_queryset()
+        read_database = get_read_database()
+        try:
+            return await emails.using(read_database).aget(view_uid=self.args[0])
+        except Email.DoesNotExist:
+            if read_database == DEFAULT_DB_ALIAS:
+                raise
+            # The email may have been created after the last change that reached the read database
+            return await emails.using(DEFAULT_DB_ALIAS).aget(view_uid=self.args[0])
+
+    async def aget_rendered_email(self):
+        cache = caches[get_email_view_cache()]
+        cache_key = self.get_cache_key()
+        rendered_email = await cache.aget(cache_key)
+        if rendered_email is None:
+            email = await self.aget_email()
+            medium = await Medium.objects.aget(name=get_medium_name())
+            rendered_email = await sync_to_async(self.render_email)(email, medium)
+
+            # Only sent emails are cached since they are the only ones that are guaranteed not to change
+            timeout = get_email_view_cache_timeout()
+            if email.sent is not None and timeout:
+                await cache.aset(cache_key, rendered_email, timeout)
+
+        return rendered_email
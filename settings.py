@@ -39,10 +39,18 @@ def configure_settings():
         if os.environ.get('DB_SETTINGS'):
             db_config = json.loads(os.environ.get('DB_SETTINGS'))
 
+        # A separate database that stands in for a read replica, so that tests can read from it and see rows that
+        # were not replicated to it. Sqlite test databases are in memory and separate already.
+        replica_config = dict(db_config)
+        if 'sqlite' not in db_config['ENGINE']:
+            test_name = db_config.get('TEST', {}).get('NAME', 'test_{0}'.format(db_config['NAME']))
+            replica_config['TEST'] = {'NAME': '{0}_replica'.format(test_name)}
+
         settings.configure(
             ENTITY_EMAILER_MAX_SEND_MESSAGE_TRIES=3,
             DATABASES={
                 'default': db_config,
+                'replica': replica_config,
             },
             INSTALLED_APPS=(
                 'db_mutex',